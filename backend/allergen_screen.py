@@ -0,0 +1,359 @@
+"""
+Screens generated replies for ingredients a user must avoid.
+
+A profile's allergens and diets expand to a set of forbidden terms, which
+are compiled into one Aho-Corasick automaton (cached per distinct profile),
+so each reply is scanned in a single pass however many terms there are.
+Longer phrases win over the words inside them ("almond milk" is a tree nut,
+not dairy), and mentions like "dairy-free", "without eggs" or "your peanut
+allergy" are ignored.
+"""
+import json
+import re
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from backend.format_validator import RECIPE, _outer_closing_tags, find_sections, validate_recipe_text
+from backend.profile_utils import normalize_field
+from backend.text_utils import html_to_text
+
+
+# Allergen group -> terms (singular and plural where they differ).
+ALLERGEN_TERMS: Dict[str, Tuple[str, ...]] = {
+    "peanut": ("peanut", "peanuts", "peanut butter", "groundnut", "groundnuts", "satay"),
+    "tree nut": (
+        "almond", "almonds", "cashew", "cashews", "walnut", "walnuts", "pecan", "pecans", "pistachio",
+        "pistachios", "hazelnut", "hazelnuts", "macadamia", "brazil nut", "brazil nuts", "pine nuts",
+        "almond milk", "almond butter", "nutella", "praline", "marzipan", "pesto",
+    ),
+    "dairy": (
+        "milk", "cheese", "butter", "yogurt", "yoghurt", "greek yogurt", "cream", "sour cream", "whey",
+        "casein", "ghee", "parmesan", "mozzarella", "feta", "cheddar", "ricotta", "cottage cheese",
+        "cream cheese", "paneer", "kefir", "ice cream", "buttermilk",
+    ),
+    "egg": ("egg", "eggs", "egg white", "egg whites", "egg yolk", "mayonnaise", "mayo", "meringue", "aioli"),
+    "gluten": (
+        "wheat", "flour", "bread", "breadcrumbs", "pasta", "spaghetti", "noodles", "couscous", "barley",
+        "rye", "bulgur", "seitan", "tortilla", "tortillas", "pita", "bagel", "croutons", "soy sauce",
+    ),
+    "soy": ("soy", "soya", "soy sauce", "soy milk", "tofu", "tempeh", "edamame", "miso"),
+    "fish": ("fish", "salmon", "tuna", "cod", "tilapia", "trout", "sardine", "sardines", "anchovy", "anchovies", "mackerel", "halibut"),
+    "shellfish": (
+        "shrimp", "prawn", "prawns", "crab", "lobster", "scallop", "scallops", "mussel", "mussels",
+        "clam", "clams", "oyster", "oysters",
+    ),
+    "sesame": ("sesame", "sesame oil", "sesame seeds", "tahini", "hummus"),
+}
+
+MEAT_TERMS = (
+    "chicken", "beef", "ground beef", "steak", "pork", "bacon", "ham", "turkey", "lamb", "veal", "duck",
+    "sausage", "sausages", "salami", "pepperoni", "prosciutto", "chorizo", "venison", "meatballs", "gelatin",
+)
+PORK_TERMS = ("pork", "bacon", "ham", "lard", "prosciutto", "pepperoni", "chorizo", "salami", "gelatin")
+
+# Diet -> allergen groups it excludes plus extra forbidden terms.
+DIET_RULES: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+    "vegan": (("dairy", "egg", "fish", "shellfish"), MEAT_TERMS + ("honey",)),
+    "vegetarian": (("fish", "shellfish"), MEAT_TERMS),
+    "pescatarian": ((), MEAT_TERMS),
+    "halal": ((), PORK_TERMS + ("wine", "beer", "rum")),
+    "kosher": (("shellfish",), PORK_TERMS),
+    "gluten free": (("gluten",), ()),
+    "dairy free": (("dairy",), ()),
+    "lactose free": (("dairy",), ()),
+}
+
+# Names people use for an allergy -> the groups above they cover.
+ALLERGEN_ALIASES: Dict[str, Tuple[str, ...]] = {
+    **{group: (group,) for group in ALLERGEN_TERMS},
+    "peanuts": ("peanut",),
+    "tree nuts": ("tree nut",),
+    "nut": ("tree nut", "peanut"),
+    "nuts": ("tree nut", "peanut"),
+    "milk": ("dairy",),
+    "lactose": ("dairy",),
+    "eggs": ("egg",),
+    "wheat": ("gluten",),
+    "celiac": ("gluten",),
+    "coeliac": ("gluten",),
+    "soya": ("soy",),
+    "crustacean": ("shellfish",),
+    "shrimp": ("shellfish",),
+}
+
+# Ingredients that contain a forbidden word without being it, e.g. "coconut milk" for dairy.
+# They are neutral unless they also appear in a forbidden group.
+SAFE_PHRASES = (
+    "coconut milk", "oat milk", "rice milk", "coconut cream", "cream of tartar", "cocoa butter",
+    "vegan cheese", "vegan butter", "vegan mayo", "egg replacer", "flax egg", "chia egg",
+    "gluten free pasta", "gluten free bread", "gluten free flour", "rice noodles", "coconut flour",
+    "chickpea flour", "rice flour", "buckwheat", "plant based",
+    # Not dairy despite the name.
+    "butter beans", "butter bean", "butter lettuce", "apple butter", "nut butter", "seed butter",
+    "sunflower butter", "shea butter", "cashew cream", "coconut yogurt", "cream of mushroom",
+)
+
+_VOCABULARY = frozenset(
+    [term for terms in ALLERGEN_TERMS.values() for term in terms]
+    + list(MEAT_TERMS)
+    + list(PORK_TERMS)
+    + [term for _, terms in DIET_RULES.values() for term in terms]
+    + list(SAFE_PHRASES)
+)
+
+# Words right before or after a match that mean it is being excluded (or talked about) rather than used:
+# "no cheese", "allergic to peanuts", "dairy-free", "your peanut allergy". Verbs match in any form
+# ("replaced the chicken", "swapping the beef").
+_NEGATION_BEFORE_RE = re.compile(
+    r"(?:\bno|\bwithout|\bavoid\w*|\bfree of|\bfree from|\binstead of|\breplac\w*|\bswap\w*|\bskip\w*|\bnot"
+    r"|\ballergic to|\ballerg(?:y|ies) to|\bintoleran(?:t|ce) to|\bsensitive to)\s+(?:\w+\s+){0,2}$"
+)
+_NEGATION_AFTER_RE = re.compile(r"^\s?(?:free|allerg(?:y|ies|ic)|intoleran(?:t|ce)|sensitivity)\b")
+_WORD_CHAR = re.compile(r"[a-z0-9]")
+_ALLERGY_HINT_RE = re.compile(r"allerg|intoleran|celiac|coeliac|\bno\b|\bavoid|\bfree\b|can't eat|cannot eat|don't eat")
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.lower().replace("-", " ").split())
+
+
+class AhoCorasick:
+    """Dict-based Aho-Corasick automaton: every pattern occurrence in one left-to-right pass."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = next_node
+        self._out[node].append(pattern)
+
+    def _build(self) -> None:
+        # Breadth-first so a node's fail link is resolved before its children need it.
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def iter_matches(self, text: str) -> Iterable[Tuple[int, int, str]]:
+        """Yield (start, end, pattern) for every occurrence in `text`."""
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for pattern in self._out[node]:
+                yield position - len(pattern) + 1, position + 1, pattern
+
+
+@dataclass
+class Violation:
+    term: str
+    reasons: Tuple[str, ...]
+
+
+class Screener:
+    """Matches the whole ingredient vocabulary so longer phrases shadow the words inside them."""
+
+    def __init__(self, forbidden: Dict[str, Tuple[str, ...]]):
+        self.forbidden = forbidden
+        self._automaton = AhoCorasick(_VOCABULARY | set(forbidden))
+
+    def scan(self, text: str) -> List[Violation]:
+        """Forbidden terms in plain text, using leftmost-longest whole-word matches."""
+        text = _normalize_text(text)
+        candidates = []
+        for start, end, term in self._automaton.iter_matches(text):
+            if start > 0 and _WORD_CHAR.match(text[start - 1]):
+                continue
+            if end < len(text) and _WORD_CHAR.match(text[end]):
+                continue
+            candidates.append((start, start - end, end, term))
+        candidates.sort()
+
+        violations = []
+        covered_until = -1
+        for start, _, end, term in candidates:
+            if start < covered_until:
+                continue
+            covered_until = end
+            reasons = self.forbidden.get(term)
+            if not reasons:
+                continue
+            if _NEGATION_AFTER_RE.match(text[end:end + 16]) or _NEGATION_BEFORE_RE.search(text[max(start - 30, 0):start]):
+                continue
+            violations.append(Violation(term, reasons))
+        return violations
+
+
+def allergen_groups(name: str) -> Tuple[str, ...]:
+    """Allergen groups for a user-supplied allergy name; unknown names are screened literally."""
+    name = _normalize_text(name)
+    return ALLERGEN_ALIASES.get(name) or ALLERGEN_ALIASES.get(name.rstrip("s")) or ()
+
+
+def restrictions_from_text(text: Optional[str]) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """Allergies and diets recognisable in the free-text dietary_restrictions field."""
+    if not text:
+        return frozenset(), frozenset()
+    text = _normalize_text(text)
+    diets = {diet for diet in DIET_RULES if re.search(rf"\b{diet}\b", text)}
+    allergens = set()
+    # Only clauses that say something is avoided: "I love fish, allergic to nuts" forbids nuts, not fish.
+    for clause in re.split(r"[,.;\n]", text):
+        if not _ALLERGY_HINT_RE.search(clause):
+            continue
+        for alias in ALLERGEN_ALIASES:
+            # "gluten free" is a diet, not an allergy to the word before "free".
+            if re.search(rf"\b{re.escape(alias)}\b(?! free)", clause):
+                allergens.add(alias)
+    return frozenset(allergens), frozenset(diets)
+
+
+def profile_restrictions(profile: Optional[Dict]) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    profile = profile or {}
+    text_allergens, text_diets = restrictions_from_text(profile.get("dietary_restrictions"))
+    allergens = frozenset(normalize_field("allergens", profile.get("allergens")) or ()) | text_allergens
+    diets = frozenset(normalize_field("diets", profile.get("diets")) or ()) | text_diets
+    return allergens, diets
+
+
+@lru_cache(maxsize=1024)
+def compile_screener(allergens: FrozenSet[str], diets: FrozenSet[str]) -> Optional[Screener]:
+    """Build (once per distinct allergen/diet set) the screener for a profile; None when nothing is forbidden."""
+    forbidden: Dict[str, set] = {}
+
+    def forbid(terms: Iterable[str], reason: str) -> None:
+        for term in terms:
+            forbidden.setdefault(term, set()).add(reason)
+
+    for allergen in allergens:
+        groups = allergen_groups(allergen)
+        if not groups:
+            forbid([_normalize_text(allergen)], allergen)
+        for group in groups:
+            forbid(ALLERGEN_TERMS[group], group)
+    for diet in diets:
+        groups, terms = DIET_RULES.get(_normalize_text(diet), ((), ()))
+        for group in groups:
+            forbid(ALLERGEN_TERMS[group], diet)
+        forbid(terms, diet)
+    if not forbidden:
+        return None
+    return Screener({term: tuple(sorted(reasons)) for term, reasons in forbidden.items()})
+
+
+def screener_for_profile(profile: Optional[Dict]) -> Optional[Screener]:
+    return compile_screener(*profile_restrictions(profile))
+
+
+REPAIR_PROMPT = (
+    "The recipe below contains ingredients this user must avoid ({terms}; restrictions: {reasons}). "
+    "Rewrite only this recipe with safe substitutes, in the exact Recipe Format, rendered as HTML. "
+    "Reply with the recipe only.\n\n{fragment}"
+)
+
+
+def _warning(reply: str, violations: List[Violation]) -> str:
+    terms = ", ".join(sorted({violation.term for violation in violations}))
+    reasons = ", ".join(sorted({group for violation in violations for group in violation.reasons}))
+    text = f"Note: this reply mentions {terms}, which conflicts with your restrictions ({reasons}). Please swap or skip it."
+    return f"{reply}\n<p><strong>{text}</strong></p>" if "<" in reply else f"{reply}\n\n{text}"
+
+
+class ScreenStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record(self, violations: List[Violation], repaired: int, flagged: bool) -> None:
+        with self._lock:
+            self._counts["replies_screened"] += 1
+            if violations:
+                self._counts["replies_with_violations"] += 1
+                self._counts["violations"] += len(violations)
+            self._counts["sections_repaired"] += repaired
+            self._counts["replies_flagged"] += flagged
+        if violations:
+            print(
+                "allergen_screen",
+                json.dumps({"terms": sorted({v.term for v in violations}), "repaired": repaired, "flagged": flagged}),
+            )
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+def screen_reply(
+    reply: str,
+    profile: Optional[Dict],
+    mode: str,
+    regenerate: Optional[Callable[[str], str]] = None,
+    stats: Optional[ScreenStats] = None,
+) -> str:
+    """
+    "flag": append a warning when the reply mentions forbidden ingredients.
+    "repair": regenerate each offending recipe first, then flag whatever is left.
+    """
+    if mode not in ("flag", "repair"):
+        return reply
+    screener = screener_for_profile(profile)
+    if screener is None:
+        return reply
+
+    violations = screener.scan(html_to_text(reply))
+    repaired = 0
+    if violations and mode == "repair" and regenerate is not None:
+        for section in reversed(find_sections(reply)):
+            if section.kind != RECIPE:
+                continue
+            fragment = reply[section.start:section.end]
+            found = screener.scan(html_to_text(fragment))
+            if not found:
+                continue
+            prompt = REPAIR_PROMPT.format(
+                terms=", ".join(sorted({v.term for v in found})),
+                reasons=", ".join(sorted({g for v in found for g in v.reasons})),
+                fragment=fragment,
+            )
+            try:
+                replacement = (regenerate(prompt) or "").strip()
+            except Exception as exc:
+                print("Allergen repair failed:", exc)
+                continue
+            text = html_to_text(replacement)
+            if not replacement or screener.scan(text) or validate_recipe_text(text[max(text.find("Recipe:"), 0):]):
+                continue
+            reply = reply[:section.start] + replacement + _outer_closing_tags(fragment) + reply[section.end:]
+            repaired += 1
+
+    remaining = screener.scan(html_to_text(reply)) if repaired else violations
+    if remaining:
+        reply = _warning(reply, remaining)
+    if stats is not None:
+        stats.record(violations, repaired, bool(remaining))
+    return reply
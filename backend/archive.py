@@ -0,0 +1,228 @@
+"""
+Cold storage for old messages.
+
+Messages older than the live window are packed, oldest first, into
+zlib-compressed JSON blobs in `message_archives`, one row per chunk. The
+row's first/last timestamps and message count are the chunk index; blobs
+are only fetched when a reader pages back past the hot `messages` rows.
+
+    python -m backend.archive --live-window 200 --chunk-size 200
+"""
+import argparse
+import base64
+import json
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+ARCHIVE_TABLE = "message_archives"
+ARCHIVE_ENCODING = "zlib+json/v1"
+ARCHIVE_COLUMNS = "id,role,content,created_at,user_id"
+DEFAULT_LIVE_WINDOW = 200
+DEFAULT_CHUNK_SIZE = 200
+# Don't bother compacting a conversation until this many messages sit outside the live window.
+DEFAULT_MIN_BATCH = 50
+# Separates the timestamp and message id in a paging cursor.
+CURSOR_SEPARATOR = "|"
+
+
+def _check(response) -> List[Dict[str, Any]]:
+    error = getattr(response, "error", None)
+    if error:
+        raise RuntimeError(str(error))
+    return list(getattr(response, "data", None) or [])
+
+
+def pack_messages(rows: List[Dict[str, Any]]) -> str:
+    raw = json.dumps(rows, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+
+
+def unpack_messages(blob: str) -> List[Dict[str, Any]]:
+    return json.loads(zlib.decompress(base64.b64decode(blob)).decode("utf-8"))
+
+
+def compact_conversation(
+    client,
+    conversation_id: str,
+    live_window: int = DEFAULT_LIVE_WINDOW,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    min_batch: int = DEFAULT_MIN_BATCH,
+) -> int:
+    """
+    Move messages older than the newest `live_window` into archive blobs.
+    The archive row is written before the hot rows are deleted, so a crash
+    in between only leaves duplicates, which readers drop by message id.
+    Returns the number of messages archived.
+    """
+    archived = 0
+    while True:
+        rows = _check(
+            client.table("messages")
+            .select(ARCHIVE_COLUMNS)
+            .eq("conversation_id", conversation_id)
+            # Same (created_at, id) order as read_page, so archived rows are always older than hot ones.
+            .order("created_at", desc=True)
+            .order("id", desc=True)
+            .range(live_window, live_window + chunk_size - 1)
+            .execute()
+        )
+        if not rows or (archived == 0 and len(rows) < min_batch):
+            return archived
+        rows.reverse()
+
+        _check(
+            client.table(ARCHIVE_TABLE)
+            .insert(
+                {
+                    "id": str(uuid.uuid4()),
+                    "conversation_id": conversation_id,
+                    "first_created_at": rows[0]["created_at"],
+                    "last_created_at": rows[-1]["created_at"],
+                    "message_count": len(rows),
+                    "encoding": ARCHIVE_ENCODING,
+                    "blob": pack_messages(rows),
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                }
+            )
+            .execute()
+        )
+        _check(client.table("messages").delete().in_("id", [row["id"] for row in rows]).execute())
+        archived += len(rows)
+        if len(rows) < chunk_size:
+            return archived
+
+
+def iter_archives(client, conversation_id: str, before: Optional[str] = None, newest_first: bool = True) -> Iterator[Dict[str, Any]]:
+    """Yield archive index rows (no blobs) for a conversation."""
+    query = (
+        client.table(ARCHIVE_TABLE)
+        .select("id,first_created_at,last_created_at,message_count")
+        .eq("conversation_id", conversation_id)
+    )
+    if before:
+        # Inclusive: an archive starting at `before` may still hold rows sharing that timestamp.
+        query = query.lte("first_created_at", before)
+    yield from _check(query.order("last_created_at", desc=newest_first).execute())
+
+
+def load_archive(client, archive_id: str) -> List[Dict[str, Any]]:
+    rows = _check(client.table(ARCHIVE_TABLE).select("blob").eq("id", archive_id).limit(1).execute())
+    return unpack_messages(rows[0]["blob"]) if rows else []
+
+
+def make_cursor(row: Dict[str, Any]) -> str:
+    """Paging cursor just before `row`: its timestamp and id, so rows sharing a timestamp aren't skipped."""
+    return f"{row['created_at']}{CURSOR_SEPARATOR}{row['id']}"
+
+
+def parse_cursor(before: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+    """(created_at, id) of a cursor; a bare timestamp (older clients) pages strictly before that time."""
+    if not before:
+        return None
+    created_at, _, message_id = before.partition(CURSOR_SEPARATOR)
+    return created_at, message_id or None
+
+
+def _is_before(row: Dict[str, Any], cursor: Optional[Tuple[str, Optional[str]]]) -> bool:
+    if cursor is None:
+        return True
+    created_at, message_id = cursor
+    if message_id is None:
+        return row["created_at"] < created_at
+    return (row["created_at"], row["id"]) < (created_at, message_id)
+
+
+def read_page(
+    client,
+    conversation_id: str,
+    before: Optional[str],
+    limit: int,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Return up to `limit` messages older than the `before` cursor (oldest first)
+    and the cursor for the next page. Hot rows are read first; archive blobs
+    are fetched one at a time, newest first, only if the hot table runs out.
+    """
+    cursor = parse_cursor(before)
+
+    def hot_rows():
+        return client.table("messages").select("id,role,content,created_at").eq("conversation_id", conversation_id)
+
+    collected: List[Dict[str, Any]] = []
+    if cursor is not None and cursor[1] is not None:
+        # Rows at the cursor's own timestamp with a smaller id come first (newest-first order is by time, then id).
+        collected = _check(
+            hot_rows().eq("created_at", cursor[0]).lt("id", cursor[1]).order("id", desc=True).limit(limit).execute()
+        )
+    if len(collected) < limit:
+        query = hot_rows()
+        if cursor is not None:
+            query = query.lt("created_at", cursor[0])
+        collected += _check(
+            query.order("created_at", desc=True).order("id", desc=True).limit(limit - len(collected)).execute()
+        )
+
+    if len(collected) < limit:
+        seen = {row["id"] for row in collected}
+        oldest = collected[-1] if collected else None
+        if oldest is not None:
+            cursor = (oldest["created_at"], oldest["id"])
+        for archive in iter_archives(client, conversation_id, before=cursor[0] if cursor else None):
+            older = [row for row in load_archive(client, archive["id"]) if row["id"] not in seen and _is_before(row, cursor)]
+            older.sort(key=lambda row: (row["created_at"], row["id"]), reverse=True)
+            for row in older[: limit - len(collected)]:
+                seen.add(row["id"])
+                collected.append(row)
+            if len(collected) >= limit:
+                break
+
+    collected.sort(key=lambda row: (row["created_at"], row["id"]))
+    next_before = make_cursor(collected[0]) if len(collected) >= limit else None
+    return collected, next_before
+
+
+def iter_conversation_ids(client, page_size: int = 500) -> Iterator[str]:
+    start = 0
+    while True:
+        rows = _check(
+            client.table("conversations").select("id").order("id").range(start, start + page_size - 1).execute()
+        )
+        for row in rows:
+            yield row["id"]
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Archive messages older than the live window.")
+    parser.add_argument("--live-window", type=int, default=DEFAULT_LIVE_WINDOW)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--min-batch", type=int, default=DEFAULT_MIN_BATCH)
+    args = parser.parse_args(argv)
+
+    import backend.server as server
+
+    if args.live_window < server.MAX_TURNS * 2:
+        parser.error(f"--live-window must keep at least MAX_TURNS * 2 = {server.MAX_TURNS * 2} messages hot")
+
+    started = time.perf_counter()
+    conversations = compacted = messages = 0
+    for conversation_id in iter_conversation_ids(server.supabase):
+        conversations += 1
+        count = compact_conversation(server.supabase, conversation_id, args.live_window, args.chunk_size, args.min_batch)
+        if count:
+            compacted += 1
+            messages += count
+    print(
+        f"Scanned {conversations} conversations, archived {messages} messages "
+        f"from {compacted} in {time.perf_counter() - started:.1f}s"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,264 @@
+"""
+Offline weekly meal-plan precomputation.
+
+Reads every row of `user_profiles`, groups users whose goals, restrictions,
+allergens, diets and daily targets match so each group costs a single Gemini
+generation, and writes the plan into a fresh conversation for every user in
+the group. Plans go through the same format check and allergen screen as
+chat replies.
+
+    python -m backend.batch_meal_plans --concurrency 4 --progress .meal_plan_progress.jsonl
+
+Progress is appended to a small log after every generation and every user
+write, so an interrupted run can be restarted with the same progress file.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import backend.server as server
+from backend.profile_utils import LIST_FIELDS, STRUCTURED_FIELDS, TARGET_FIELDS, normalize_field
+from backend.usage import usage_scope
+
+WEEKLY_PLAN_PROMPT = (
+    "Create my meal plan for the coming week (Monday to Sunday), one meal plan per day, "
+    "tailored to my profile. Finish with a single grocery list for the whole week."
+)
+PROFILE_PAGE_SIZE = 500
+# Scheduler identity for batch generations, so they queue as one background user.
+BATCH_USER_ID = "__batch_meal_plans__"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _normalize_field(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    return _WHITESPACE_RE.sub(" ", value.strip().lower())
+
+
+def profile_group_key(profile: Dict[str, Any]) -> Tuple[str, ...]:
+    """Users with the same normalized goals/restrictions and structured fields share one generation."""
+    key = [
+        _normalize_field(profile.get("fitness_goals")),
+        _normalize_field(profile.get("dietary_restrictions")),
+    ]
+    for name in LIST_FIELDS:
+        key.append(",".join(normalize_field(name, profile.get(name)) or ()))
+    for name in TARGET_FIELDS:
+        key.append(str(normalize_field(name, profile.get(name)) or ""))
+    return tuple(key)
+
+
+def group_id(key: Tuple[str, ...]) -> str:
+    return hashlib.sha1("\x1f".join(key).encode("utf-8")).hexdigest()[:16]
+
+
+def iter_profiles(page_size: int = PROFILE_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+    """Yield every profile, reading `user_profiles` one page at a time."""
+    start = 0
+    while True:
+        response = (
+            server.supabase.table("user_profiles")
+            .select(",".join(("user_id", "fitness_goals", "dietary_restrictions") + STRUCTURED_FIELDS))
+            .order("user_id")
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        if getattr(response, "error", None):
+            raise RuntimeError(str(response.error))
+        rows = response.data or []
+        yield from rows
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+
+def group_profiles(profiles) -> Dict[str, Dict[str, Any]]:
+    groups: Dict[str, Dict[str, Any]] = {}
+    for profile in profiles:
+        key = profile_group_key(profile)
+        gid = group_id(key)
+        group = groups.setdefault(gid, {"profile": profile, "user_ids": []})
+        group["user_ids"].append(profile["user_id"])
+    return groups
+
+
+@dataclass
+class BatchProgress:
+    """
+    Resumable checkpoint: generated plans per group and users already written.
+
+    Stored as an append-only JSON-lines log (one line per plan or user), so a
+    checkpoint costs one short write instead of rewriting everything so far.
+    """
+
+    path: Optional[str]
+    plans: Dict[str, str] = field(default_factory=dict)
+    users_done: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "BatchProgress":
+        progress = cls(path=path)
+        if not path or not os.path.exists(path):
+            return progress
+        with open(path, "r", encoding="utf-8") as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash; everything before it is intact.
+                    continue
+                if "group" in entry:
+                    progress.plans[entry["group"]] = entry["plan"]
+                elif "user" in entry:
+                    progress.users_done[entry["user"]] = entry["conversation_id"]
+        return progress
+
+    def _append(self, entry: Dict[str, str]) -> None:
+        if not self.path:
+            return
+        with open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(json.dumps(entry) + "\n")
+
+    def record_plan(self, gid: str, plan: str) -> None:
+        self.plans[gid] = plan
+        self._append({"group": gid, "plan": plan})
+
+    def record_user(self, user_id: str, conversation_id: str) -> None:
+        self.users_done[user_id] = conversation_id
+        self._append({"user": user_id, "conversation_id": conversation_id})
+
+
+@dataclass
+class BatchReport:
+    profiles: int = 0
+    groups: int = 0
+    generations: int = 0
+    reused_plans: int = 0
+    users_written: int = 0
+    users_skipped: int = 0
+    failures: List[str] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-9)
+        return "\n".join(
+            [
+                f"Profiles:            {self.profiles}",
+                f"Distinct groups:     {self.groups}",
+                f"Generations:         {self.generations} ({self.reused_plans} reused from progress)",
+                f"Users written:       {self.users_written} ({self.users_skipped} already done)",
+                f"Failures:            {len(self.failures)}",
+                f"Elapsed:             {self.elapsed:.1f}s",
+                f"Generation rate:     {self.generations / elapsed * 60:.1f}/min",
+                f"User write rate:     {self.users_written / elapsed:.1f}/s",
+                f"Generations saved:   {max(self.profiles - self.groups, 0)} by grouping",
+            ]
+        )
+
+
+def _generate_plan(profile: Dict[str, Any]) -> str:
+    history = [{"role": "user", "parts": [WEEKLY_PLAN_PROMPT]}]
+    with server.gemini_scheduler.slot(BATCH_USER_ID, server.BACKGROUND), usage_scope(BATCH_USER_ID, None):
+        response = server.generate_chat_with_rotation(profile, history)
+        # Format repair and allergen screening may regenerate sections, so they stay inside the slot.
+        reply = server.polish_reply(profile, response.text or "(no response)", server.MODEL)
+    return server.reconcile_reply(reply, server.NUTRITION_CHECK_MODE)
+
+
+def _write_plan(user_id: str, plan: str, title: str) -> str:
+    conversation = server.create_conversation(user_id, title)
+    conversation_id = conversation["id"]
+    server.record_message(user_id, conversation_id, "user", WEEKLY_PLAN_PROMPT)
+    server.record_message(user_id, conversation_id, "model", plan)
+    server.touch_conversation(conversation_id, plan)
+    return conversation_id
+
+
+async def run_batch(
+    profiles,
+    progress: BatchProgress,
+    concurrency: int,
+    title: Optional[str] = None,
+) -> BatchReport:
+    report = BatchReport()
+    started = time.perf_counter()
+    groups = group_profiles(profiles)
+    report.profiles = sum(len(group["user_ids"]) for group in groups.values())
+    report.groups = len(groups)
+    title = title or f"Weekly meal plan ({date.today().isoformat()})"
+
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    checkpoint_lock = asyncio.Lock()
+
+    async def checkpoint(record, *args):
+        async with checkpoint_lock:
+            await asyncio.to_thread(record, *args)
+
+    async def process_group(gid: str, group: Dict[str, Any]) -> None:
+        pending = [uid for uid in group["user_ids"] if uid not in progress.users_done]
+        report.users_skipped += len(group["user_ids"]) - len(pending)
+        if not pending:
+            return
+
+        plan = progress.plans.get(gid)
+        if plan is None:
+            async with semaphore:
+                try:
+                    plan = await asyncio.to_thread(_generate_plan, group["profile"])
+                except Exception as exc:
+                    report.failures.append(f"group {gid}: {exc}")
+                    return
+            report.generations += 1
+            await checkpoint(progress.record_plan, gid, plan)
+        else:
+            report.reused_plans += 1
+
+        for user_id in pending:
+            try:
+                conversation_id = await asyncio.to_thread(_write_plan, user_id, plan, title)
+            except Exception as exc:
+                report.failures.append(f"user {user_id}: {exc}")
+                continue
+            report.users_written += 1
+            await checkpoint(progress.record_user, user_id, conversation_id)
+
+    await asyncio.gather(*(process_group(gid, group) for gid, group in groups.items()))
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Precompute weekly meal plans for every user.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=len(server.GEMINI_API_KEYS),
+        help="Maximum generations in flight (defaults to the number of Gemini keys).",
+    )
+    parser.add_argument("--progress", default=".meal_plan_progress.jsonl", help="Checkpoint file for resuming.")
+    parser.add_argument("--title", default=None, help="Conversation title for the generated plans.")
+    args = parser.parse_args(argv)
+
+    progress = BatchProgress.load(args.progress)
+    report = asyncio.run(run_batch(iter_profiles(), progress, args.concurrency, args.title))
+    try:
+        server.usage_meter.flush()
+    except Exception as exc:
+        print("Token usage flush failed:", exc)
+    print(report.summary())
+    for failure in report.failures:
+        print("  failed:", failure)
+    return 1 if report.failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,145 @@
+"""
+Microbenchmarks for the pure helpers that run on every request or generation,
+on realistic generated inputs (60-message histories, week-long HTML meal plans).
+
+    python -m backend.benchmarks.bench_hot_paths                      # compare with the baseline
+    python -m backend.benchmarks.bench_hot_paths --update-baseline    # after an intended change
+
+Timings are divided by a fixed pure-Python calibration loop measured in the
+same run, so the stored baseline carries over between machines. The check
+fails (exit code 1) when a case is more than `--threshold` slower than its
+baseline.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from backend.benchmarks.fixtures import message_rows, profile, profile_update_json, recipe_html, week_plan_html
+from backend.format_validator import validate_recipe_text, validate_reply
+from backend.profile_utils import diff_profile, format_profile_context, parse_profile_update
+from backend.system_prompt import detect_formats
+from backend.text_utils import html_to_text
+from backend.usage import rows_to_history
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+
+
+def cases() -> Dict[str, Tuple[Callable[..., Any], tuple]]:
+    stored = profile()
+    update = parse_profile_update(profile_update_json())
+    recipe = html_to_text(recipe_html(random.Random(7), "Salmon Quinoa Bowl"))
+    return {
+        "format_profile_context": (format_profile_context, (stored,)),
+        "parse_profile_update": (parse_profile_update, (profile_update_json(),)),
+        "diff_profile": (diff_profile, (stored, update)),
+        "rows_to_history (60 messages)": (rows_to_history, (message_rows(turns=30),)),
+        "detect_formats (60 messages)": (detect_formats, (rows_to_history(message_rows(turns=30)),)),
+        "validate_recipe_text": (validate_recipe_text, (recipe,)),
+        "validate_reply (week plan)": (validate_reply, (week_plan_html(),)),
+    }
+
+
+def _workload():
+    data = {}
+    for n in range(4_000):
+        data[f"key{n % 512}"] = str(n).zfill(6)
+    return sorted(data.values())
+
+
+def calibrate(rounds: int = 5) -> float:
+    """Seconds for a fixed mix of dict, string and list work; the unit every case is measured in."""
+    return best_time(_workload, (), rounds=rounds, number=1)
+
+
+def best_time(fn: Callable[..., Any], args: tuple, rounds: int = 7, number: int = 0) -> float:
+    """Fastest of `rounds` runs, per call; `number` calls per run is picked to take about 10 ms when 0."""
+    if not number:
+        number, elapsed = 1, 0.0
+        while elapsed < 0.01:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn(*args)
+            elapsed = time.perf_counter() - start
+            if elapsed < 0.01:
+                number *= 2
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def measure(fn: Callable[..., Any], args: tuple) -> Tuple[float, float]:
+    """(seconds per call, in calibration units). The unit is measured right before and after the
+    case, so a CPU that changes speed during the run (frequency scaling, noisy neighbours) skews both alike."""
+    before = calibrate()
+    seconds = best_time(fn, args)
+    unit = min(before, calibrate())
+    return seconds, seconds / unit
+
+
+def run(names=None) -> Dict[str, Tuple[float, float]]:
+    return {name: measure(fn, args) for name, (fn, args) in cases().items() if names is None or name in names}
+
+
+def regressions(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    slower = []
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if reference and value > reference * (1 + threshold):
+            slower.append(f"{name}: {value / reference - 1:+.0%} (limit {threshold:+.0%})")
+    return slower
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Dict[str, float]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the per-request helpers against the stored baseline.")
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the new baseline.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown (0.25 = 25%%).")
+    parser.add_argument("--retries", type=int, default=2, help="Re-measure slow cases this many times before failing.")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args(argv)
+
+    measured = run()
+    baseline = load_baseline(args.baseline)
+    results = {name: units for name, (_, units) in measured.items()}
+    for name, (seconds, units) in measured.items():
+        reference = baseline.get(name)
+        change = f"{units / reference - 1:+7.1%}" if reference else "    new"
+        print(f"  {name:32} {seconds * 1e6:10.1f} us  {units:9.4f} units  {change}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as handle:
+            json.dump({name: round(value, 4) for name, value in results.items()}, handle, indent=2, sort_keys=True)
+            handle.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    # A single slow sample on a busy machine is not a regression; only one that repeats is.
+    for _ in range(args.retries):
+        slow = {line.split(":")[0] for line in regressions(results, baseline, args.threshold)}
+        if not slow:
+            break
+        for name, (_, units) in run(slow).items():
+            results[name] = min(results[name], units)
+
+    slower = regressions(results, baseline, args.threshold)
+    for line in slower:
+        print("  regression:", line)
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,129 @@
+"""
+Prompt tokens and latency of per-turn system prompts against the full one,
+over a scripted conversation, with a fake model whose latency grows with the
+prompt it is sent (a fixed cost plus a prefill cost per prompt token).
+
+    python -m backend.benchmarks.bench_prompt_sections
+    python -m backend.benchmarks.bench_prompt_sections --base-ms 400 --prefill-us-per-token 60
+
+Only the system prompt differs between the two runs; the history sent with it
+is the same, so the savings are diluted by long conversations as they would be
+in production.
+"""
+import argparse
+import random
+import statistics
+import time
+from typing import Any, Dict, List, Tuple
+
+from backend.benchmarks.fixtures import DAYS, meal_plan_html, profile, recipe_html
+from backend.profile_utils import format_profile_context
+from backend.system_prompt import build_system_prompt, detect_formats, full_system_prompt
+from backend.usage import estimate_tokens, trim_history
+
+GROCERY_HTML = (
+    "<section><h2>Grocery List</h2><h3>Proteins:</h3><ul><li>chicken breast (1 kg)</li><li>eggs (12)</li></ul>"
+    "<h3>Carbohydrates:</h3><ul><li>rolled oats (500 g)</li></ul><h3>Vegetables:</h3><ul><li>spinach (2 bags)</li></ul>"
+    "<h3>Fruits:</h3><ul><li>blueberries (2 cups)</li></ul><h3>Pantry:</h3><ul><li>olive oil (1 bottle)</li></ul>"
+    "<h3>Other:</h3><ul><li>greek yogurt (1 kg)</li></ul></section>"
+)
+ANSWER = "<p>Aim for roughly 1.6–2.2 g of protein per kg of body weight, spread over your meals.</p>"
+
+# (user message, kind of reply the model gives)
+SCRIPT: Tuple[Tuple[str, str], ...] = (
+    ("Hi! I want to lose weight and I'm vegetarian on weekdays.", "answer"),
+    ("Can you make me a high protein meal plan for tomorrow?", "plan"),
+    ("Swap the dinner for something without tofu.", "plan"),
+    ("What should I buy for this week?", "grocery"),
+    ("How much protein do I need to build muscle?", "answer"),
+    ("Is it okay to drink coffee before a workout?", "answer"),
+    ("Give me a quick recipe with salmon.", "recipe"),
+    ("Make it dairy free please.", "recipe"),
+    ("Thanks! Are bananas good after running?", "answer"),
+    ("How many calories are in an avocado?", "answer"),
+    ("Plan my meals for Monday", "plan"),
+    ("What's a good breakfast before the gym?", "recipe"),
+)
+
+
+def conversation(seed: int = 7) -> List[List[Dict[str, Any]]]:
+    """The history sent on each turn of SCRIPT (oldest first, ending with the user's message)."""
+    rng = random.Random(seed)
+    history: List[Dict[str, Any]] = []
+    turns = []
+    for n, (message, kind) in enumerate(SCRIPT):
+        history.append({"role": "user", "parts": [message]})
+        turns.append(list(history))
+        if kind == "plan":
+            reply = meal_plan_html(rng, DAYS[n % len(DAYS)])
+        elif kind == "recipe":
+            reply = recipe_html(rng, "Salmon Quinoa Bowl")
+        elif kind == "grocery":
+            reply = GROCERY_HTML
+        else:
+            reply = ANSWER
+        history.append({"role": "model", "parts": [reply]})
+    return turns
+
+
+class FakeModel:
+    """Sleeps `base + prompt tokens * per_token` seconds per call, like time to first token of a hosted model."""
+
+    def __init__(self, system_instruction: str, base: float, per_token: float):
+        self.system_instruction = system_instruction
+        self.base = base
+        self.per_token = per_token
+
+    def generate_content(self, history) -> int:
+        tokens = estimate_tokens(self.system_instruction)
+        tokens += sum(estimate_tokens(str(part)) for turn in history for part in turn["parts"])
+        time.sleep(self.base + tokens * self.per_token)
+        return tokens
+
+
+def run(sectioned: bool, base: float, per_token: float, max_history_tokens: int) -> Tuple[List[int], List[float]]:
+    context = format_profile_context(profile())
+    tokens, latencies = [], []
+    for history in conversation():
+        started = time.perf_counter()
+        history = trim_history(history, max_history_tokens)
+        system_prompt = build_system_prompt(detect_formats(history)) if sectioned else full_system_prompt()
+        model = FakeModel(f"{system_prompt}\n\n{context}", base, per_token)
+        tokens.append(model.generate_content(history))
+        latencies.append(time.perf_counter() - started)
+    return tokens, latencies
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare per-turn system prompts with the full one.")
+    parser.add_argument("--base-ms", type=float, default=50.0, help="Fixed latency of a fake model call.")
+    parser.add_argument("--prefill-us-per-token", type=float, default=40.0, help="Added latency per prompt token.")
+    parser.add_argument("--max-history-tokens", type=int, default=24000, help="History budget (HISTORY_MAX_TOKENS).")
+    args = parser.parse_args(argv)
+    base, per_token = args.base_ms / 1000, args.prefill_us_per_token / 1e6
+
+    full_tokens, full_latency = run(False, base, per_token, args.max_history_tokens)
+    tokens, latency = run(True, base, per_token, args.max_history_tokens)
+    saved = [before - after for before, after in zip(full_tokens, tokens)]
+    full_system = estimate_tokens(full_system_prompt())
+    print(f"Turns:                       {len(SCRIPT)}")
+    print(f"System prompt (full):        {full_system} tokens")
+    print(f"System prompt (per turn):    {statistics.mean(full_system - s for s in saved):.0f} tokens on average")
+    print(f"Prompt tokens saved:         {statistics.mean(saved):.0f} per call on average "
+          f"({sum(saved) / sum(full_tokens):.1%} of all prompt tokens)")
+    print(f"Turns without format specs:  {sum(1 for s in saved if s == max(saved))}")
+    print(f"Mean latency (full):         {statistics.mean(full_latency) * 1000:.1f} ms")
+    print(f"Mean latency (per turn):     {statistics.mean(latency) * 1000:.1f} ms "
+          f"({statistics.mean(latency) / statistics.mean(full_latency) - 1:+.1%})")
+
+    started = time.perf_counter()
+    histories = conversation()
+    for _ in range(200):
+        for history in histories:
+            build_system_prompt(detect_formats(history))
+    print(f"Detection + assembly:        {(time.perf_counter() - started) / (200 * len(histories)) * 1e6:.1f} us per turn")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
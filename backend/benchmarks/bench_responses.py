@@ -0,0 +1,61 @@
+"""
+Compare response encoding for a 60-message history and a long HTML chat reply:
+FastAPI's default path (jsonable_encoder + stdlib json) against the fast encoder,
+with and without gzip/brotli.
+
+    python -m backend.benchmarks.bench_responses
+"""
+import gzip
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from backend.benchmarks.fixtures import history, week_plan_html
+from backend.http_utils import BROTLI_QUALITY, GZIP_LEVEL, brotli, dumps, orjson
+
+
+def default_encode(payload):
+    return json.dumps(
+        jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def cpu_time(fn, payload, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        result = fn(payload)
+    return (time.process_time() - start) / repeat * 1000, result
+
+
+def report(label, payload, repeat=200):
+    print(f"\n{label}")
+    default_ms, default_body = cpu_time(default_encode, payload, repeat)
+    fast_ms, fast_body = cpu_time(dumps, payload, repeat)
+    encoder = "orjson" if orjson is not None else "stdlib json (orjson not installed)"
+    print(f"  default encode:      {default_ms:7.3f} ms  {len(default_body):>8} bytes")
+    print(f"  fast encode:         {fast_ms:7.3f} ms  {len(fast_body):>8} bytes  [{encoder}]")
+
+    gzip_ms, gzipped = cpu_time(lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL), fast_body, repeat)
+    print(
+        f"  + gzip level {GZIP_LEVEL}:      {fast_ms + gzip_ms:7.3f} ms  {len(gzipped):>8} bytes  "
+        f"({1 - len(gzipped) / len(fast_body):.0%} smaller)"
+    )
+    if brotli is not None:
+        br_ms, compressed = cpu_time(lambda body: brotli.compress(body, quality=BROTLI_QUALITY), fast_body, repeat)
+        print(
+            f"  + brotli q{BROTLI_QUALITY}:         {fast_ms + br_ms:7.3f} ms  {len(compressed):>8} bytes  "
+            f"({1 - len(compressed) / len(fast_body):.0%} smaller)"
+        )
+
+
+def main():
+    report("GET /messages (60-message history)", history(turns=30))
+    report(
+        "POST /api/chat (week-long meal plan reply)",
+        {"reply": week_plan_html(), "conversation_id": "00000000-0000-0000-0000-000000000000", "model": "gemini"},
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Realistic generated inputs for the benchmarks: HTML meal plans, recipes and chat histories."""
+import random
+from typing import Any, Dict, List
+
+DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+INGREDIENTS = (
+    "200 g chicken breast", "1 cup cooked rice", "1 tbsp olive oil", "2 large eggs",
+    "1/2 cup rolled oats", "1 cup spinach", "150 g salmon fillet", "1 medium sweet potato",
+    "1 cup broccoli", "1/2 avocado", "1 cup greek yogurt", "1/2 cup blueberries",
+    "100 g firm tofu", "1 cup cooked quinoa", "2 cloves garlic", "1 bell pepper",
+)
+USER_PROMPTS = (
+    "Can you make me a high protein meal plan for tomorrow?",
+    "I'm vegetarian now, please adjust.",
+    "What should I buy for this week?",
+    "Give me a quick recipe with salmon.",
+    "How much protein do I need to build muscle?",
+)
+
+
+def recipe_html(rng: random.Random, name: str) -> str:
+    ingredients = "".join(f"<li>{item}</li>" for item in rng.sample(INGREDIENTS, 6))
+    steps = "".join(f"<li>Step {n}: prepare and cook the {name.lower()} components.</li>" for n in range(1, 5))
+    return (
+        f"<section><h3>Recipe: {name}</h3>"
+        f"<p><strong>Ingredients:</strong></p><ul>{ingredients}</ul>"
+        f"<p><strong>Instructions:</strong></p><ol>{steps}</ol>"
+        f"<p>Time: {rng.randint(10, 45)} minutes</p><p>Servings: {rng.randint(1, 4)}</p>"
+        f"<p><strong>Estimated Calories Per Serving:</strong> {rng.randint(300, 700)}</p>"
+        "<p><strong>Macros (per serving):</strong></p>"
+        f"<ul><li>Protein: {rng.randint(15, 50)} g</li><li>Carbs: {rng.randint(20, 80)} g</li>"
+        f"<li>Fats: {rng.randint(5, 30)} g</li></ul></section>"
+    )
+
+
+def meal_plan_html(rng: random.Random, day: str) -> str:
+    meals = "".join(
+        f"<h3>{meal}:</h3>{recipe_html(rng, f'{day} {meal} Bowl')}" for meal in ("Breakfast", "Lunch", "Dinner")
+    )
+    return (
+        f"<section><h2>Meal Plan: {day}</h2>{meals}"
+        f"<p><strong>Estimated Daily Calories:</strong> {rng.randint(1600, 2800)}</p></section>"
+    )
+
+
+def week_plan_html(seed: int = 7) -> str:
+    rng = random.Random(seed)
+    return "".join(meal_plan_html(rng, day) for day in DAYS)
+
+
+def message_rows(turns: int = 30, seed: int = 7) -> List[Dict[str, Any]]:
+    """Newest-first rows as returned by the messages query (turns user+model pairs)."""
+    rng = random.Random(seed)
+    rows = []
+    for turn in range(turns):
+        rows.append({"role": "user", "content": rng.choice(USER_PROMPTS)})
+        rows.append({"role": "model", "content": meal_plan_html(rng, DAYS[turn % len(DAYS)])})
+    return rows[::-1]
+
+
+def history(turns: int = 30, seed: int = 7) -> List[Dict[str, Any]]:
+    """Oldest-first Gemini-style history, as returned by /messages."""
+    return [{"role": row["role"], "parts": [row["content"]]} for row in reversed(message_rows(turns, seed))]
+
+
+def profile() -> Dict[str, Any]:
+    """A fully filled-in profile row, structured fields included."""
+    return {
+        "user_id": "00000000-0000-0000-0000-000000000000",
+        "fitness_goals": "Lose 5 kg  by summer while keeping my strength up for climbing",
+        "dietary_restrictions": "Vegetarian on weekdays, no spicy food",
+        "allergens": ["Peanut", "tree nuts", "Shellfish"],
+        "diets": ["vegetarian", "low-FODMAP"],
+        "calorie_target": 2100,
+        "protein_target_g": 140,
+        "carbs_target_g": "220",
+        "fats_target_g": 70.0,
+    }
+
+
+def profile_update_json() -> str:
+    """A profile-extraction reply as the model returns it."""
+    return (
+        '{"fitness_goals": "  Build muscle and run a half marathon in the spring ", '
+        '"dietary_restrictions": null, "allergens": ["Peanut", "sesame"], "diets": ["Pescatarian"], '
+        '"calorie_target": "2400", "protein_target_g": 160, "carbs_target_g": null, "fats_target_g": 80}'
+    )
@@ -0,0 +1,297 @@
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from backend.shared_state import MemoryState, SharedState
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_INDEX = "deferred:index"
+_INDEX_LOCK = "deferred:index:lock"
+_INDEX_LOCK_SECONDS = 5.0
+
+
+class CapacityUnavailable(Exception):
+    """Raised by a job's work function when Gemini still has no capacity; the job is retried later."""
+
+
+class DeferredQueueFull(Exception):
+    """Too many deferred replies are already waiting."""
+
+
+@dataclass
+class DeferredJob:
+    id: str
+    user_id: str
+    conversation_id: str
+    message: str
+    created_at: float
+    history: List[Dict[str, Any]] = field(default_factory=list, repr=False)
+    status: str = QUEUED
+    attempts: int = 0
+    next_attempt_at: float = 0.0
+    finished_at: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def public(self) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
+            "job_id": self.id,
+            "status": self.status,
+            "conversation_id": self.conversation_id,
+            "attempts": self.attempts,
+        }
+        if self.result is not None:
+            payload["result"] = self.result
+        if self.error is not None:
+            payload["error"] = self.error
+        return payload
+
+
+class DeferredQueue:
+    """
+    Chat replies that couldn't be generated when they were asked for.
+
+    The user's message is already stored; `work(job)` generates and stores the
+    reply from `job.history`, the conversation as it was when the job was
+    queued. `workers` threads run due jobs oldest first. When `work` raises
+    CapacityUnavailable the job is retried with exponential backoff until it is
+    `max_age` seconds old; any other error fails it. Finished jobs stay
+    readable for `ttl_seconds`.
+
+    Jobs are kept as JSON in `state`, with a small index of unfinished jobs and
+    their next attempt time. With a shared state every worker process can
+    answer polls for any job and run any due job, and jobs outlive a restart;
+    a job is run by whichever process claims it, and the claim of a process
+    that died mid-run lapses after `lease_seconds`. Without a state the jobs
+    live in this process only. With `autostart=False` the caller drives them
+    with `run_due()`.
+    """
+
+    def __init__(
+        self,
+        work: Callable[[DeferredJob], Dict[str, Any]],
+        max_jobs: int = 200,
+        retry_delay: float = 5.0,
+        max_retry_delay: float = 60.0,
+        max_age: float = 900.0,
+        ttl_seconds: float = 600.0,
+        clock: Callable[[], float] = time.time,
+        autostart: bool = True,
+        state: Optional[SharedState] = None,
+        workers: int = 4,
+        lease_seconds: float = 300.0,
+        poll_interval: float = 1.0,
+    ):
+        self.work = work
+        self.max_jobs = max_jobs
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self.autostart = autostart
+        self.state = state if state is not None else MemoryState()
+        self.workers = max(workers, 1)
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._changed = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+    # -- storage ----------------------------------------------------------------
+
+    @staticmethod
+    def _job_name(job_id: str) -> str:
+        return f"deferred:job:{job_id}"
+
+    def _load(self, job_id: str) -> Optional[DeferredJob]:
+        raw = self.state.get_value(self._job_name(job_id))
+        return DeferredJob(**json.loads(raw)) if raw is not None else None
+
+    def _save(self, job: DeferredJob) -> None:
+        ttl = self.ttl_seconds if job.finished else self.max_age + self.ttl_seconds
+        self.state.put_value(self._job_name(job.id), json.dumps(asdict(job)), ttl)
+
+    def _read_index(self) -> Dict[str, float]:
+        raw = self.state.get_value(_INDEX)
+        return json.loads(raw) if raw is not None else {}
+
+    def _update_index(self, update: Callable[[Dict[str, float]], Any]) -> Any:
+        """Read-modify-write of the index under a short lock shared by every process."""
+        while not self.state.put_value(_INDEX_LOCK, "1", _INDEX_LOCK_SECONDS, only_if_absent=True):
+            time.sleep(0.01)
+        try:
+            index = self._read_index()
+            outcome = update(index)
+            self.state.put_value(_INDEX, json.dumps(index), self.max_age + self.ttl_seconds)
+            return outcome
+        finally:
+            self.state.delete_value(_INDEX_LOCK)
+
+    def _claim_name(self, job_id: str) -> str:
+        return f"deferred:claim:{job_id}"
+
+    # -- public -----------------------------------------------------------------
+
+    def submit(self, user_id: str, conversation_id: str, message: str, history: Optional[List[Dict[str, Any]]] = None) -> DeferredJob:
+        now = self._clock()
+        job = DeferredJob(
+            uuid.uuid4().hex,
+            user_id,
+            conversation_id,
+            message,
+            created_at=now,
+            history=list(history or []),
+            next_attempt_at=now + self.retry_delay,
+        )
+
+        def add(index: Dict[str, float]) -> bool:
+            if len(index) >= self.max_jobs:
+                return False
+            index[job.id] = job.next_attempt_at
+            return True
+
+        self._save(job)
+        if not self._update_index(add):
+            self.state.delete_value(self._job_name(job.id))
+            with self._lock:
+                self._counts["rejected"] += 1
+            raise DeferredQueueFull("Too many replies are waiting for capacity")
+        with self._lock:
+            self._counts["submitted"] += 1
+            if self.autostart:
+                self._ensure_workers()
+            self._wake.notify()
+        return job
+
+    def get(self, job_id: str, user_id: str) -> Optional[DeferredJob]:
+        job = self._load(job_id)
+        return job if job is not None and job.user_id == user_id else None
+
+    def wait(self, job: DeferredJob, timeout: float) -> DeferredJob:
+        """The latest state of `job`, once it has finished or `timeout` seconds have passed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._load(job.id) or job
+            remaining = deadline - time.monotonic()
+            if job.finished or remaining <= 0:
+                return job
+            # Jobs finished in this process wake the waiter at once; others are noticed on the next poll.
+            with self._changed:
+                self._changed.wait(min(remaining, self.poll_interval))
+
+    def retry_after(self, job: DeferredJob) -> int:
+        return max(int(job.next_attempt_at - self._clock()) + 1, 1)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            counts = dict(self._counts)
+        counts["waiting"] = len(self._read_index())
+        return counts
+
+    def start(self) -> None:
+        """Start the workers now, so jobs queued before a restart run without waiting for a new submission."""
+        if self.autostart:
+            with self._lock:
+                self._ensure_workers()
+
+    def run_due(self) -> int:
+        """Run every job whose retry time has come, each at most once; returns how many were attempted."""
+        attempted: set = set()
+        while True:
+            job = self._claim(self._clock(), attempted)
+            if job is None:
+                return len(attempted)
+            attempted.add(job.id)
+            self._attempt(job)
+
+    # -- running ----------------------------------------------------------------
+
+    def _claim(self, now: float, skip: set) -> Optional[DeferredJob]:
+        due = sorted((at, job_id) for job_id, at in self._read_index().items() if at <= now and job_id not in skip)
+        for _, job_id in due:
+            claim = self._claim_name(job_id)
+            if not self.state.put_value(claim, "1", self.lease_seconds, only_if_absent=True):
+                continue
+            job = self._load(job_id)
+            if job is None or job.finished:
+                self._update_index(lambda index: index.pop(job_id, None))
+                self.state.delete_value(claim)
+                continue
+            if job.next_attempt_at > now:
+                # Another worker retried it between reading the index and claiming it.
+                self.state.delete_value(claim)
+                continue
+            # A job still marked running here was left behind by a worker whose claim lapsed.
+            job.status = RUNNING
+            job.attempts += 1
+            self._save(job)
+            return job
+        return None
+
+    def _attempt(self, job: DeferredJob) -> None:
+        try:
+            result = self.work(job)
+        except CapacityUnavailable as exc:
+            now = self._clock()
+            if now - job.created_at >= self.max_age:
+                self._finish(job, error=f"Gave up waiting for capacity: {exc}")
+                self._count("expired")
+            else:
+                job.status = QUEUED
+                job.next_attempt_at = now + min(self.retry_delay * 2 ** job.attempts, self.max_retry_delay)
+                self._save(job)
+                self._update_index(lambda index: index.__setitem__(job.id, job.next_attempt_at))
+                self.state.delete_value(self._claim_name(job.id))
+                self._count("retries")
+            return
+        except Exception as exc:
+            self._finish(job, error=str(exc) or exc.__class__.__name__)
+            self._count("failed")
+            return
+        self._finish(job, result=result)
+        self._count("completed")
+
+    def _finish(self, job: DeferredJob, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        job.result, job.error = result, error
+        job.status = DONE if error is None else FAILED
+        job.finished_at = self._clock()
+        self._save(job)
+        self._update_index(lambda index: index.pop(job.id, None))
+        self.state.delete_value(self._claim_name(job.id))
+        with self._changed:
+            self._changed.notify_all()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def _ensure_workers(self) -> None:
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f"deferred-replies-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self) -> None:
+        while True:
+            # Jobs queued or retried by other processes are only seen by polling the index.
+            with self._lock:
+                self._wake.wait(self.poll_interval)
+            try:
+                self.run_due()
+            except Exception as exc:
+                print("Deferred reply worker failed:", exc)
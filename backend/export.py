@@ -0,0 +1,179 @@
+"""
+Full data export of one user's conversations as NDJSON.
+
+`export_records()` yields one record per line: an `export` header, then each
+conversation followed by all of its messages, oldest first, and an `end`
+trailer with the counts. A stream without the trailer was cut short.
+
+Conversations are read in keyset pages by id. Messages are read from the
+archive blobs, oldest first, one blob at a time, then from the hot
+`messages` rows in keyset pages by `created_at`. Memory therefore holds one
+page or one blob, however long the history is. A row that is both archived
+and still hot, because compaction was interrupted, is exported once.
+
+Support staff can export any user with the server's service-role client:
+
+    python -m backend.export --user-id <uuid> --output export.ndjson.gz
+"""
+import argparse
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+from backend.archive import _check, iter_archives, load_archive
+from backend.http_utils import GZIP_LEVEL, dumps
+
+EXPORT_FORMAT = "easydiet-export/v1"
+CONVERSATION_COLUMNS = "id,title,created_at,updated_at,last_message_preview"
+MESSAGE_COLUMNS = "id,role,content,created_at"
+DEFAULT_PAGE_SIZE = 500
+# Encoded lines are sent in chunks of about this size, so a response isn't thousands of tiny writes.
+CHUNK_BYTES = 64 * 1024
+
+
+class _Cursor:
+    """Keyset position in one conversation: the newest `created_at` exported and the ids exported at it."""
+
+    def __init__(self):
+        self.created_at: Optional[str] = None
+        self.ids_at: Set[str] = set()
+
+    def is_new(self, row: Dict[str, Any]) -> bool:
+        if self.created_at is None or row["created_at"] > self.created_at:
+            return True
+        return row["created_at"] == self.created_at and row["id"] not in self.ids_at
+
+    def advance(self, row: Dict[str, Any]) -> None:
+        if row["created_at"] != self.created_at:
+            self.created_at, self.ids_at = row["created_at"], set()
+        self.ids_at.add(row["id"])
+
+
+def iter_conversations(client, user_id: str, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+    after = None
+    while True:
+        query = client.table("conversations").select(CONVERSATION_COLUMNS).eq("user_id", user_id)
+        if after is not None:
+            query = query.gt("id", after)
+        rows = _check(query.order("id").limit(page_size).execute())
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1]["id"]
+
+
+def iter_messages(
+    client,
+    conversation_id: str,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    pending: Iterable[Dict[str, Any]] = (),
+) -> Iterator[Dict[str, Any]]:
+    """
+    Every message of a conversation, oldest first: archived, then hot, then
+    `pending` (rows not stored yet, e.g. from the write-behind journal).
+    """
+    cursor = _Cursor()
+    for archive in iter_archives(client, conversation_id, newest_first=False):
+        rows = load_archive(client, archive["id"])
+        rows.sort(key=lambda row: (row["created_at"], row["id"]))
+        for row in rows:
+            if cursor.is_new(row):
+                cursor.advance(row)
+                yield row
+
+    limit = page_size
+    while True:
+        query = client.table("messages").select(MESSAGE_COLUMNS).eq("conversation_id", conversation_id)
+        if cursor.created_at is not None:
+            # Rows sharing the last timestamp come back again and are skipped by id.
+            query = query.gte("created_at", cursor.created_at)
+        rows = _check(query.order("created_at").order("id").limit(limit).execute())
+        fresh = [row for row in rows if cursor.is_new(row)]
+        for row in fresh:
+            cursor.advance(row)
+            yield row
+        if len(rows) < limit:
+            break
+        # A page holding nothing but rows already exported is a run of equal timestamps; read past it.
+        limit = page_size if fresh else limit * 2
+
+    for row in sorted(pending, key=lambda row: (row["created_at"], row["id"])):
+        if cursor.is_new(row):
+            cursor.advance(row)
+            yield row
+
+
+def export_records(
+    client,
+    user_id: str,
+    profile: Optional[Dict[str, Any]] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    pending: Optional[Callable[[str], List[Dict[str, Any]]]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """The records of a user's export, read lazily; `pending(conversation_id)` adds unstored messages."""
+    yield {"type": "export", "format": EXPORT_FORMAT, "user_id": user_id, "exported_at": datetime.now(timezone.utc).isoformat()}
+    if profile is not None:
+        yield {"type": "profile", **profile}
+    conversations = messages = 0
+    for conversation in iter_conversations(client, user_id, page_size):
+        conversations += 1
+        yield {"type": "conversation", **conversation}
+        extra = pending(conversation["id"]) if pending is not None else ()
+        for row in iter_messages(client, conversation["id"], page_size, extra):
+            messages += 1
+            yield {
+                "type": "message",
+                "conversation_id": conversation["id"],
+                **{key: row.get(key) for key in ("id", "role", "content", "created_at")},
+            }
+    yield {"type": "end", "conversations": conversations, "messages": messages}
+
+
+def encode_lines(records: Iterable[Dict[str, Any]], chunk_bytes: int = CHUNK_BYTES) -> Iterator[bytes]:
+    """NDJSON bytes for `records`, in chunks of about `chunk_bytes`."""
+    buffer: List[bytes] = []
+    size = 0
+    for record in records:
+        line = dumps(record) + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = GZIP_LEVEL) -> Iterator[bytes]:
+    """Compress a byte stream into one gzip member as it goes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export one user's conversations and messages as NDJSON.")
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--output", required=True, help="Output file; a .gz suffix writes gzip.")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    import backend.server as server
+
+    client = server.supabase
+    profile = _check(client.table("user_profiles").select("*").eq("user_id", args.user_id).limit(1).execute())
+    chunks = encode_lines(export_records(client, args.user_id, profile[0] if profile else None, args.page_size))
+    if args.output.endswith(".gz"):
+        chunks = gzip_chunks(chunks)
+    with open(args.output, "wb") as handle:
+        for chunk in chunks:
+            handle.write(chunk)
+    print(f"Export written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,310 @@
+"""
+Checks model replies against the strict formats in backend/prompts/.
+
+Replies are HTML, so each structured block (a recipe, a grocery list) is
+located in the raw reply and validated on its plain-text rendering. A block
+that breaks the format can be regenerated on its own and spliced back into
+the reply in place of the broken one, instead of regenerating the whole reply.
+"""
+import json
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from backend.text_utils import html_to_text
+
+
+RECIPE = "recipe"
+GROCERY_LIST = "grocery_list"
+
+# Rough token estimate for metrics; good enough to compare full vs partial regeneration.
+CHARS_PER_TOKEN = 4
+
+# Opening tags directly in front of a label belong to the block that label starts.
+_OPENING_TAGS = r"(?:<(?!/)[^>]*>\s*)*"
+_BLOCK_TAGS = r"<(?:h[1-6]|p|li|div|section|article|header|td|th|tr|table|ul|ol|br)\b[^>]*>\s*"
+# A label only starts a block at the start of a line or of a block element, never mid-sentence.
+_LABEL_START = rf"(?:^[ \t]*{_OPENING_TAGS}|(?:{_BLOCK_TAGS})+{_OPENING_TAGS})"
+_RECIPE_ANCHOR_RE = re.compile(_LABEL_START + r"Recipe:", re.MULTILINE)
+# The grocery heading stands alone: nothing but its closing tags follows it on its line.
+_GROCERY_ANCHOR_RE = re.compile(_LABEL_START + r"Grocery List\b:?[ \t]*(?:</[^>]+>\s*)*(?=<|\n|$)", re.MULTILINE)
+_BOUNDARY_RE = re.compile(
+    _LABEL_START + r"(?:Recipe:|Grocery List\b|Meal Plan:|(?:Breakfast|Lunch|Dinner):|Estimated Daily Calories)",
+    re.MULTILINE,
+)
+# Last single-line fields of a recipe; text after them (and their closing tags) is not part of it.
+_RECIPE_TAIL_RE = re.compile(
+    r"(?:Time|Servings|Estimated Calories Per Serving|Protein|Carbs|Fats):[^\n]*?(?=<|\n|$)(?:\s*</[^>]+>)*"
+)
+_TAG_NAME_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*?(/?)>")
+_TAG_RE = re.compile(r"<[^>]+>")
+_VOID_TAGS = frozenset({"br", "hr", "img", "meta", "input", "wbr"})
+
+_NUMBER = r"~?\s*\d[\d,]*(?:\.\d+)?(?:\s*[-–]\s*\d[\d,]*(?:\.\d+)?)?"
+
+# (label, pattern) in the order the recipe format requires them.
+RECIPE_FIELDS: Tuple[Tuple[str, re.Pattern], ...] = tuple(
+    (label, re.compile(pattern, re.IGNORECASE | re.MULTILINE))
+    for label, pattern in (
+        ("Recipe", r"^Recipe:[ \t]*\S"),
+        ("Ingredients", r"^Ingredients:"),
+        ("Instructions", r"^Instructions:"),
+        ("Time", rf"^Time:\s*{_NUMBER}\s*(?:mins?|minutes?|hours?|hrs?)\b"),
+        ("Servings", rf"^Servings:\s*{_NUMBER}"),
+        ("Estimated Calories Per Serving", rf"^Estimated Calories Per Serving:\s*{_NUMBER}"),
+        ("Macros (per serving)", r"^Macros \(per serving\):"),
+        ("Protein", rf"^Protein:\s*{_NUMBER}\s*g\b"),
+        ("Carbs", rf"^Carbs:\s*{_NUMBER}\s*g\b"),
+        ("Fats", rf"^Fats:\s*{_NUMBER}\s*g\b"),
+    )
+)
+
+GROCERY_CATEGORIES = ("Proteins", "Carbohydrates", "Vegetables", "Fruits", "Pantry", "Other")
+_GROCERY_FIELDS: Tuple[Tuple[str, re.Pattern], ...] = tuple(
+    (label, re.compile(rf"^{label}:", re.IGNORECASE | re.MULTILINE)) for label in GROCERY_CATEGORIES
+)
+_GROCERY_ITEM_RE = re.compile(r"^[^\n:]+\([^)\n]+\)\s*$", re.MULTILINE)
+
+_MEAL_RE = {meal: re.compile(rf"^{meal}:", re.MULTILINE) for meal in ("Breakfast", "Lunch", "Dinner")}
+_DAILY_CALORIES_RE = re.compile(rf"^Estimated Daily Calories:\s*{_NUMBER}", re.MULTILINE)
+_SNACK_RE = re.compile(r"^Snacks?\b", re.IGNORECASE | re.MULTILINE)
+
+RECIPE_REPAIR_PROMPT = (
+    "The recipe below does not follow the strict Recipe Format ({problems}). "
+    "Rewrite only this recipe in the exact Recipe Format, keeping the same dish, ingredients and quantities "
+    "where possible, rendered as HTML. Reply with the recipe only, no introduction or closing text.\n\n{fragment}"
+)
+GROCERY_REPAIR_PROMPT = (
+    "The grocery list below does not follow the strict Grocery List Format ({problems}). "
+    "Rewrite only this grocery list in the exact Grocery List Format, keeping the same items, rendered as HTML. "
+    "Reply with the grocery list only, no introduction or closing text.\n\n{fragment}"
+)
+
+
+@dataclass
+class Section:
+    kind: str
+    start: int
+    end: int
+    problems: List[str] = field(default_factory=list)
+
+
+def _ordered_problems(text: str, fields: Tuple[Tuple[str, re.Pattern], ...]) -> List[str]:
+    problems = []
+    last_position = -1
+    for label, pattern in fields:
+        match = pattern.search(text)
+        if match is None:
+            problems.append(f"missing {label}")
+        elif match.start() < last_position:
+            problems.append(f"{label} out of order")
+        else:
+            last_position = match.start()
+    return problems
+
+
+def _lines_between(text: str, start_label: str, end_label: str) -> List[str]:
+    start = re.search(rf"^{start_label}:[^\n]*\n?", text, re.MULTILINE)
+    end = re.search(rf"^{end_label}:", text, re.MULTILINE)
+    if start is None or end is None or end.start() < start.end():
+        return []
+    return [line for line in text[start.end():end.start()].splitlines() if line.strip()]
+
+
+def validate_recipe_text(text: str) -> List[str]:
+    """Problems with one recipe in plain text; empty when it follows the format."""
+    problems = _ordered_problems(text, RECIPE_FIELDS)
+    if "missing Ingredients" not in problems and "missing Instructions" not in problems:
+        if not _lines_between(text, "Ingredients", "Instructions"):
+            problems.append("no ingredients listed")
+        if not _lines_between(text, "Instructions", "Time"):
+            problems.append("no instruction steps")
+    return problems
+
+
+def validate_grocery_text(text: str) -> List[str]:
+    problems = _ordered_problems(text, _GROCERY_FIELDS)
+    if not problems and not _GROCERY_ITEM_RE.search(text):
+        problems.append("no items in 'item (quantity)' form")
+    return problems
+
+
+def validate_meal_plan_text(text: str) -> List[str]:
+    """Meal-plan level checks (meals, snacks, daily total); recipes are validated separately."""
+    problems = [f"missing {meal}" for meal, pattern in _MEAL_RE.items() if not pattern.search(text)]
+    if text.count("Recipe:") < 3:
+        problems.append("fewer than three recipes")
+    if _SNACK_RE.search(text):
+        problems.append("includes snacks")
+    if not _DAILY_CALORIES_RE.search(text):
+        problems.append("missing Estimated Daily Calories")
+    return problems
+
+
+def _block_end(reply: str, after: int) -> int:
+    match = _BOUNDARY_RE.search(reply, after)
+    return match.start() if match else len(reply)
+
+
+def _recipe_end(reply: str, start: int, end: int) -> int:
+    tails = list(_RECIPE_TAIL_RE.finditer(reply, start, end))
+    if not tails or not re.search(r"\S", _TAG_RE.sub("", reply[tails[-1].end():end])):
+        return end
+    # Trailing chat ("Enjoy!") stays outside the block so a repair doesn't drop it.
+    return tails[-1].end()
+
+
+def find_sections(reply: str) -> List[Section]:
+    """Locate recipe and grocery-list blocks in a (possibly HTML) reply, in reply order."""
+    sections = []
+    for kind, anchor in ((RECIPE, _RECIPE_ANCHOR_RE), (GROCERY_LIST, _GROCERY_ANCHOR_RE)):
+        for match in anchor.finditer(reply):
+            end = _block_end(reply, match.end())
+            if kind == RECIPE:
+                end = _recipe_end(reply, match.start(), end)
+            sections.append(Section(kind, match.start(), end))
+    sections.sort(key=lambda section: section.start)
+    return sections
+
+
+def _outer_closing_tags(fragment: str) -> str:
+    """Closing tags in `fragment` for elements opened before it (e.g. a wrapping </section>)."""
+    stack: List[str] = []
+    outer = []
+    for match in _TAG_NAME_RE.finditer(fragment):
+        closing, name, self_closing = match.group(1), match.group(2).lower(), match.group(3)
+        if name in _VOID_TAGS or self_closing:
+            continue
+        if not closing:
+            stack.append(name)
+        elif name in stack:
+            while stack and stack.pop() != name:
+                pass
+        else:
+            outer.append(match.group(0))
+    return "".join(outer)
+
+
+@dataclass
+class ValidationReport:
+    sections: List[Section]
+    meal_plan_problems: List[str]
+
+    @property
+    def invalid_sections(self) -> List[Section]:
+        return [section for section in self.sections if section.problems]
+
+    @property
+    def ok(self) -> bool:
+        return not self.meal_plan_problems and not self.invalid_sections
+
+
+def validate_reply(reply: str) -> ValidationReport:
+    sections = find_sections(reply)
+    for section in sections:
+        text = html_to_text(reply[section.start:section.end])
+        section.problems = validate_recipe_text(text) if section.kind == RECIPE else validate_grocery_text(text)
+    plain = html_to_text(reply)
+    meal_plan_problems = validate_meal_plan_text(plain) if "Meal Plan:" in plain else []
+    return ValidationReport(sections, meal_plan_problems)
+
+
+def _repair_section(reply: str, section: Section, regenerate: Callable[[str], str]) -> Optional[str]:
+    fragment = reply[section.start:section.end]
+    template = RECIPE_REPAIR_PROMPT if section.kind == RECIPE else GROCERY_REPAIR_PROMPT
+    prompt = template.format(problems="; ".join(section.problems), fragment=fragment)
+    replacement = (regenerate(prompt) or "").strip()
+    if not replacement:
+        return None
+    text = html_to_text(replacement)
+    if section.kind == RECIPE:
+        # Drop any chatter before the recipe itself.
+        position = text.find("Recipe:")
+        still_broken = position < 0 or validate_recipe_text(text[position:])
+    else:
+        still_broken = validate_grocery_text(text)
+    if still_broken:
+        return None
+    return replacement + _outer_closing_tags(fragment)
+
+
+class FormatStats:
+    """Counters for /api/health: how often replies break format and what repair costs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record(self, report: ValidationReport, repaired: int, failed: int, regenerated_chars: int, reply_chars: int) -> None:
+        with self._lock:
+            self._counts["replies_checked"] += 1
+            self._counts["replies_invalid"] += not report.ok
+            self._counts["meal_plan_problems"] += bool(report.meal_plan_problems)
+            for section in report.invalid_sections:
+                self._counts[f"{section.kind}_invalid"] += 1
+            self._counts["sections_repaired"] += repaired
+            self._counts["repair_failures"] += failed
+            if repaired:
+                self._counts["replies_repaired"] += 1
+                self._counts["tokens_regenerated"] += regenerated_chars // CHARS_PER_TOKEN
+                # What a full regeneration of the reply would have cost instead.
+                self._counts["tokens_saved"] += max(reply_chars - regenerated_chars, 0) // CHARS_PER_TOKEN
+        if not report.ok:
+            print(
+                "format_check",
+                json.dumps(
+                    {
+                        "sections": [[section.kind, section.problems] for section in report.invalid_sections],
+                        "meal_plan": report.meal_plan_problems,
+                        "repaired": repaired,
+                        "failed": failed,
+                    }
+                ),
+            )
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            counts = dict(self._counts)
+        checked = counts.get("replies_checked", 0)
+        counts["invalid_rate"] = counts.get("replies_invalid", 0) / checked if checked else None
+        return counts
+
+
+def check_reply(
+    reply: str,
+    mode: str,
+    regenerate: Optional[Callable[[str], str]] = None,
+    stats: Optional[FormatStats] = None,
+    max_repairs: int = 3,
+) -> str:
+    """
+    Validate a reply ("check") and, in "repair" mode, regenerate only the
+    broken recipes/grocery lists via `regenerate(prompt)`, splicing each fixed
+    block back in place. Blocks that can't be fixed are left as they were.
+    """
+    if mode not in ("check", "repair") or ("Recipe:" not in reply and "Grocery List" not in reply):
+        return reply
+
+    report = validate_reply(reply)
+    repaired = failed = regenerated_chars = 0
+    updated = reply
+    if mode == "repair" and regenerate is not None:
+        # Splice from the end so earlier offsets stay valid.
+        for section in reversed(report.invalid_sections[:max_repairs]):
+            try:
+                replacement = _repair_section(updated, section, regenerate)
+            except Exception as exc:
+                print("Format repair failed:", exc)
+                replacement = None
+            if replacement is None:
+                failed += 1
+                continue
+            repaired += 1
+            regenerated_chars += len(replacement)
+            updated = updated[:section.start] + replacement + updated[section.end:]
+
+    if stats is not None:
+        stats.record(report, repaired, failed, regenerated_chars, len(reply))
+    return updated
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from backend.shared_state import SharedState
+
+_RUNNING = "running"
+_DONE = "done"
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request, or its first request is still running."""
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    expires_at: float
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+def request_fingerprint(*parts: Any) -> str:
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Single-flight execution keyed by (user, Idempotency-Key, conversation).
+
+    The first request for a key runs the work; duplicates arriving while it is
+    in flight wait for that result, and later duplicates get the stored result
+    until it expires. Failed runs are forgotten so a retry can try again.
+
+    With a shared `state` the key is also claimed across worker processes and
+    the finished result (which must be JSON-serializable) is stored there, so
+    a retry that lands on another worker joins or replays the same run. The
+    claim of a worker that died mid-run lapses after `lease_seconds`.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 600.0,
+        max_entries: int = 10_000,
+        clock: Callable[[], float] = time.monotonic,
+        state: Optional[SharedState] = None,
+        lease_seconds: float = 300.0,
+        poll_interval: float = 0.2,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.state = state
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _purge(self, now: float) -> None:
+        # Finished entries are moved to the end, so they are ordered by expiry;
+        # in-flight entries can sit anywhere and are stepped over.
+        for key, entry in list(self._entries.items()):
+            if not entry.done.is_set():
+                continue
+            if entry.expires_at <= now or len(self._entries) > self.max_entries:
+                del self._entries[key]
+            else:
+                break
+
+    @staticmethod
+    def _shared_name(key: Hashable) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return "idempotency:" + request_fingerprint(*parts)
+
+    def _join_shared(self, name: str, fingerprint: str, wait_timeout: Optional[float]) -> Tuple[bool, Any]:
+        """Claim `name` for this run, or wait for the worker that holds it. Returns (claimed, stored result)."""
+        deadline = None if wait_timeout is None else time.monotonic() + wait_timeout
+        claim = json.dumps({"fingerprint": fingerprint, "status": _RUNNING})
+        while True:
+            if self.state.put_value(name, claim, self.lease_seconds, only_if_absent=True):
+                return True, None
+            raw = self.state.get_value(name)
+            if raw is None:
+                # Released (the other run failed) between the two calls; try to claim it again.
+                continue
+            record = json.loads(raw)
+            if record["fingerprint"] != fingerprint:
+                raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+            if record["status"] == _DONE:
+                return False, record["result"]
+            if deadline is not None and time.monotonic() >= deadline:
+                raise IdempotencyConflict("A request with this Idempotency-Key is still in progress")
+            time.sleep(self.poll_interval)
+
+    def run(
+        self,
+        key: Hashable,
+        fingerprint: str,
+        work: Callable[[], Any],
+        wait_timeout: Optional[float] = None,
+    ) -> Tuple[Any, bool]:
+        """Return (result, replayed). `replayed` is True when the result came from another request."""
+        with self._lock:
+            now = self._clock()
+            self._purge(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry.done.is_set() and entry.expires_at <= now:
+                del self._entries[key]
+                entry = None
+            leader = entry is None
+            if leader:
+                entry = _Entry(fingerprint=fingerprint, expires_at=now + self.ttl_seconds)
+                self._entries[key] = entry
+
+        if not leader:
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+            if not entry.done.wait(wait_timeout):
+                raise IdempotencyConflict("A request with this Idempotency-Key is still in progress")
+            if entry.error is not None:
+                raise entry.error
+            return entry.result, True
+
+        name = self._shared_name(key) if self.state is not None else None
+        claimed = replayed = False
+        try:
+            if name is not None:
+                try:
+                    claimed, shared_result = self._join_shared(name, fingerprint, wait_timeout)
+                    replayed = not claimed
+                except IdempotencyConflict:
+                    raise
+                except Exception as exc:
+                    print("Idempotency shared state unavailable:", exc)
+            if replayed:
+                entry.result = shared_result
+            else:
+                entry.result = work()
+        except BaseException as exc:
+            entry.error = exc
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            if claimed:
+                self._release_shared(name)
+            raise
+        finally:
+            with self._lock:
+                entry.expires_at = self._clock() + self.ttl_seconds
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+            entry.done.set()
+        if claimed:
+            self._store_shared(name, fingerprint, entry.result)
+        return entry.result, replayed
+
+    def _store_shared(self, name: str, fingerprint: str, result: Any) -> None:
+        try:
+            record = json.dumps({"fingerprint": fingerprint, "status": _DONE, "result": result})
+            self.state.put_value(name, record, self.ttl_seconds)
+        except Exception as exc:
+            print("Could not store idempotent result:", exc)
+            self._release_shared(name)
+
+    def _release_shared(self, name: str) -> None:
+        try:
+            self.state.delete_value(name)
+        except Exception as exc:
+            print("Could not release idempotency claim:", exc)
@@ -0,0 +1,144 @@
+import csv
+import json
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional
+
+from backend.nutrition import NUTRIENTS_CSV
+
+
+# Must match the fixed reply the system prompt asks for.
+OFF_TOPIC_REPLY = "I'm here to help with nutrition-related questions."
+ACKNOWLEDGEMENT_REPLY = "You're welcome! Let me know whenever you'd like a meal plan, recipe, or grocery list."
+
+OFF_TOPIC = "off_topic"
+ACKNOWLEDGEMENT = "acknowledgement"
+MODEL = "model"
+
+_WORD_RE = re.compile(r"[a-z]+")
+
+NUTRITION_WORDS = frozenset(
+    """
+    allergy allergies allergic bulk bulking breakfast brunch calorie calories carb carbs carbohydrate
+    carbohydrates cook cooking cut cutting deficit diet dietary diets dinner drink eat eating fat fats
+    fiber fibre fitness food foods gluten grocery groceries halal healthy hungry ingredient ingredients
+    keto kosher lactose lunch macro macros meal meals muscle nutrient nutrients nutrition nutritional
+    paleo plan portion portions prep protein recipe recipes restriction restrictions serving servings
+    shopping snack snacks sodium sugar supplement supplements vegan vegetarian vitamin vitamins weight
+    workout hydration water budget cheap gain lose maintain pescatarian dairy nut nuts
+    """.split()
+)
+
+OFF_TOPIC_WORDS = frozenset(
+    """
+    bitcoin crypto stock stocks javascript python java code coding programming compile debug
+    football soccer basketball baseball nba nfl movie movies film lyrics song songs album weather
+    election president politics senator capital homework essay poem poetry novel translate
+    translation car cars mortgage insurance physics chemistry algebra calculus geometry laptop
+    iphone android playstation xbox minecraft fortnite horoscope astrology
+    """.split()
+)
+
+OFF_TOPIC_PATTERNS = (
+    re.compile(r"\b(write|debug|fix|review)\s+(?:\w+\s+){0,3}?(code|program|function|script|essay|poem|story)\b"),
+    re.compile(r"\bcapital\s+of\b"),
+    re.compile(r"\bwho\s+(won|is\s+the\s+president|invented)\b"),
+    re.compile(r"\b(tell|give)\s+me\s+a\s+joke\b"),
+    re.compile(r"\bwhat\s+time\s+is\s+it\b"),
+    re.compile(r"\b(solve|calculate)\s+(this\s+)?(equation|integral|derivative)\b"),
+)
+
+_ACK_RE = re.compile(
+    r"^(?:(?:ok(?:ay)?|cool|great|perfect|awesome|nice|got\s+it|sounds\s+good)[\s,!.]*)?"
+    r"(?:thanks(?:\s+a\s+lot)?|thank\s+you(?:\s+(?:so|very)\s+much)?|thx|ty|cheers|much\s+appreciated)"
+    r"(?:[\s,!.]*(?:bye|goodbye))?[\s!.:)]*$"
+    r"|^(?:bye|goodbye|see\s+you|see\s+ya)[\s!.]*$"
+)
+
+
+@dataclass
+class RouteDecision:
+    intent: str
+    confidence: float
+    reply: Optional[str] = None
+
+
+@lru_cache(maxsize=1)
+def _food_words() -> FrozenSet[str]:
+    """Nutrition vocabulary plus every word of every ingredient name/alias in the nutrient table."""
+    words = set(NUTRITION_WORDS)
+    with open(NUTRIENTS_CSV, "r", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            for name in [row["name"], *row.get("aliases", "").split("|")]:
+                words.update(_WORD_RE.findall(name.lower()))
+    return frozenset(words)
+
+
+def classify_message(message: str) -> RouteDecision:
+    """Cheap local intent classification; anything uncertain goes to the model."""
+    normalized = " ".join(message.lower().split())
+    if not normalized:
+        return RouteDecision(MODEL, 0.0)
+
+    if len(normalized) <= 60 and _ACK_RE.match(normalized):
+        return RouteDecision(ACKNOWLEDGEMENT, 0.97, ACKNOWLEDGEMENT_REPLY)
+
+    words = _WORD_RE.findall(normalized)
+    food_words = _food_words()
+    if any(word in food_words for word in words):
+        return RouteDecision(MODEL, 0.0)
+
+    word_hits = sum(1 for word in words if word in OFF_TOPIC_WORDS)
+    pattern_hits = sum(1 for pattern in OFF_TOPIC_PATTERNS if pattern.search(normalized))
+    if not word_hits and not pattern_hits:
+        return RouteDecision(MODEL, 0.0)
+    # Topic words alone ("I play football") stay at 0.8 at most: only a request pattern
+    # makes a message confident enough to skip the model.
+    confidence = min(0.5 + min(0.1 * word_hits, 0.3) + 0.4 * pattern_hits, 0.99)
+    return RouteDecision(OFF_TOPIC, confidence, OFF_TOPIC_REPLY)
+
+
+class RouterStats:
+    """Shadow-mode bookkeeping: how often the router's call matches the model's reply."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record_shadow(self, decision: RouteDecision, model_reply: str, threshold: float) -> None:
+        model_off_topic = model_reply.strip() == OFF_TOPIC_REPLY
+        would_route = decision.reply is not None and decision.confidence >= threshold
+        with self._lock:
+            self._counts["messages"] += 1
+            self._counts["model_off_topic"] += model_off_topic
+            if decision.intent == OFF_TOPIC and would_route:
+                self._counts["routed_off_topic"] += 1
+                self._counts["off_topic_agree" if model_off_topic else "off_topic_disagree"] += 1
+            elif decision.intent == ACKNOWLEDGEMENT and would_route:
+                self._counts["routed_acknowledgement"] += 1
+            elif model_off_topic:
+                self._counts["off_topic_missed"] += 1
+        print(
+            "intent_router_shadow",
+            json.dumps(
+                {
+                    "intent": decision.intent,
+                    "confidence": round(decision.confidence, 2),
+                    "would_route": would_route,
+                    "model_off_topic": model_off_topic,
+                    "model_reply_chars": len(model_reply),
+                }
+            ),
+        )
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            counts = dict(self._counts)
+        routed = counts.get("routed_off_topic", 0)
+        counts["off_topic_precision"] = counts.get("off_topic_agree", 0) / routed if routed else None
+        model_off = counts.get("model_off_topic", 0)
+        counts["off_topic_recall"] = counts.get("off_topic_agree", 0) / model_off if model_off else None
+        return counts
@@ -0,0 +1,285 @@
+"""
+Write-behind journal for chat messages.
+
+`append()` writes entries as JSON lines to a local append-only file and
+returns once they are fsynced; concurrent appends share one fsync. A
+background thread hands pending entries to `writer(entries)` in batches and
+records which ones were stored. Entries still pending at a restart are
+replayed from the file, so `writer` must be idempotent (messages carry their
+own id and are upserted).
+
+Each process owns one file in `directory`, locked while it runs. At start-up
+it also adopts the files of processes that are gone, so their pending
+entries are flushed too. Without `fcntl` (Windows) a single `journal.jsonl`
+is used.
+
+Pending entries are also published per conversation in `state`, so with a
+shared state every worker's `pending()` sees the entries of every other
+worker until they are stored.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+from backend.shared_state import MemoryState, SharedState
+
+MESSAGE = "message"
+TOUCH = "touch"
+_FLUSHED = "flushed"
+_LOCK_SECONDS = 5.0
+
+
+def _lock(handle) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def read_entries(path: str) -> List[Dict[str, Any]]:
+    """Entries of a journal file that were never marked as stored; a torn last line is skipped."""
+    entries: Dict[str, Dict[str, Any]] = {}
+    with open(path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get("op") == _FLUSHED:
+                for entry_id in entry["ids"]:
+                    entries.pop(entry_id, None)
+            else:
+                entries[entry["id"]] = entry
+    return list(entries.values())
+
+
+def merge_pending(rows: List[Dict[str, Any]], pending: Iterable[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """
+    Newest-first message rows with the journal's pending messages mixed in by
+    `created_at`; a message that was stored while the rows were read appears once.
+    """
+    seen = {row.get("id") for row in rows}
+    extra = [entry for entry in pending if entry["id"] not in seen]
+    if not extra:
+        return rows
+    merged = rows + [{key: entry[key] for key in ("id", "role", "content", "created_at")} for entry in extra]
+    merged.sort(key=lambda row: row.get("created_at") or "", reverse=True)
+    return merged[:limit]
+
+
+class MessageJournal:
+    def __init__(
+        self,
+        directory: str,
+        writer: Callable[[List[Dict[str, Any]]], None],
+        flush_interval: float = 0.2,
+        batch_size: int = 200,
+        autostart: bool = True,
+        state: Optional[SharedState] = None,
+        pending_ttl: float = 86400.0,
+    ):
+        self.directory = directory
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.autostart = autostart
+        self.state = state if state is not None else MemoryState()
+        self.pending_ttl = pending_ttl
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        os.makedirs(directory, exist_ok=True)
+        name = f"journal-{uuid.uuid4().hex}.jsonl" if fcntl is not None else "journal.jsonl"
+        self.path = os.path.join(directory, name)
+        self._file = open(self.path, "a", encoding="utf-8")
+        _lock(self._file)
+        self._adopt()
+
+    def _adopt(self) -> None:
+        """Take over the entries of journal files whose process is gone."""
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".jsonl") or path == self.path:
+                continue
+            try:
+                handle = open(path, "r+", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with handle:
+                # Held by a live process, or already adopted by another one that is starting up.
+                if not _lock(handle) or not os.path.exists(path):
+                    continue
+                entries = read_entries(path)
+                if entries:
+                    self._write(entries)
+                os.remove(path)
+        if fcntl is None and os.path.getsize(self.path):
+            entries = read_entries(self.path)
+            self._file.seek(0)
+            self._file.truncate()
+            self._write(entries)
+
+    @staticmethod
+    def _shared_name(conversation_id: str) -> str:
+        return f"journal:pending:{conversation_id}"
+
+    def _update_shared(self, conversation_id: str, update: Callable[[Dict[str, Dict[str, Any]]], None]) -> None:
+        """Read-modify-write of a conversation's shared pending entries under a short lock."""
+        name = self._shared_name(conversation_id)
+        lock = f"{name}:lock"
+        while not self.state.put_value(lock, "1", _LOCK_SECONDS, only_if_absent=True):
+            time.sleep(0.01)
+        try:
+            raw = self.state.get_value(name)
+            entries = json.loads(raw) if raw is not None else {}
+            update(entries)
+            if entries:
+                self.state.put_value(name, json.dumps(entries), self.pending_ttl)
+            else:
+                self.state.delete_value(name)
+        finally:
+            self.state.delete_value(lock)
+
+    def _publish(self, entries: List[Dict[str, Any]]) -> None:
+        by_conversation: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            by_conversation.setdefault(entry["conversation_id"], []).append(entry)
+        for conversation_id, added in by_conversation.items():
+            self._update_shared(conversation_id, lambda shared, added=added: shared.update((entry["id"], entry) for entry in added))
+
+    def _unpublish(self, entries: List[Dict[str, Any]]) -> None:
+        by_conversation: Dict[str, List[str]] = {}
+        for entry in entries:
+            by_conversation.setdefault(entry["conversation_id"], []).append(entry["id"])
+        for conversation_id, ids in by_conversation.items():
+            self._update_shared(conversation_id, lambda shared, ids=ids: [shared.pop(entry_id, None) for entry_id in ids])
+
+    def _write(self, entries: List[Dict[str, Any]]) -> None:
+        with self._cond:
+            for entry in entries:
+                self._file.write(json.dumps(entry) + "\n")
+                self._pending[entry["id"]] = entry
+            self._written += 1
+            self._sync(self._written)
+        self._publish(entries)
+        with self._cond:
+            stored = [entry for entry in entries if entry["id"] not in self._pending]
+        if stored:
+            # A flush stored them while they were being published.
+            self._unpublish(stored)
+
+    def _sync(self, seq: int) -> None:
+        """Wait until write number `seq` is on disk; whoever finds no fsync running does one for everybody. Holds `_cond`."""
+        while self._synced < seq:
+            if self._syncing:
+                self._cond.wait()
+                continue
+            self._syncing = True
+            target = self._written
+            try:
+                self._file.flush()
+                fd = self._file.fileno()
+                self._cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                self._synced = max(self._synced, target)
+            finally:
+                self._syncing = False
+                self._cond.notify_all()
+
+    def append(self, *entries: Dict[str, Any]) -> None:
+        """Make `entries` durable locally; each needs an `op`, a unique `id` and a `conversation_id`."""
+        self._write(list(entries))
+        if self.autostart:
+            self.start()
+
+    def pending(self, conversation_id: str, op: str = MESSAGE) -> List[Dict[str, Any]]:
+        """Entries of a conversation not stored yet, from any worker sharing `state`."""
+        raw = self.state.get_value(self._shared_name(conversation_id))
+        entries = json.loads(raw).values() if raw is not None else ()
+        return [entry for entry in entries if entry["op"] == op]
+
+    def discard(self, conversation_id: str) -> None:
+        """Forget pending entries of a conversation that was deleted."""
+        with self._cond:
+            dropped = [entry_id for entry_id, entry in self._pending.items() if entry["conversation_id"] == conversation_id]
+            for entry_id in dropped:
+                del self._pending[entry_id]
+            if dropped:
+                self._file.write(json.dumps({"op": _FLUSHED, "ids": dropped}) + "\n")
+                self._file.flush()
+        self.state.delete_value(self._shared_name(conversation_id))
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Hand pending entries to `writer` in batches; returns how many were stored."""
+        stored = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = list(self._pending.values())[: self.batch_size]
+                if not batch:
+                    break
+                self.writer(batch)
+                stored += len(batch)
+                with self._cond:
+                    for entry in batch:
+                        self._pending.pop(entry["id"], None)
+                    if self._pending:
+                        # Losing this marker in a crash only means the batch is written again.
+                        self._file.write(json.dumps({"op": _FLUSHED, "ids": [entry["id"] for entry in batch]}) + "\n")
+                        self._file.flush()
+                    elif not self._syncing:
+                        self._file.seek(0)
+                        self._file.truncate()
+                        self._file.flush()
+                # After they left `_pending`, so `_write` can tell when it published entries already stored.
+                self._unpublish(batch)
+        return stored
+
+    def start(self) -> None:
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="message-journal", daemon=True)
+                    self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        except Exception as exc:
+            print("Message journal flush failed:", exc)
+        self._file.close()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as exc:
+                # Entries stay pending and are retried on the next pass.
+                print("Message journal flush failed:", exc)
@@ -0,0 +1,326 @@
+import csv
+import hashlib
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from fractions import Fraction
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.text_utils import html_to_text
+
+
+BASE_DIR = os.path.dirname(__file__)
+NUTRIENTS_CSV = os.path.join(BASE_DIR, "data", "nutrients.csv")
+CACHE_DIR = os.getenv("NUTRITION_CACHE_DIR", os.path.join(BASE_DIR, ".cache"))
+
+# Column order of the nutrient matrix; values are per 100 g.
+NUTRIENT_COLUMNS = ("calories", "protein", "carbs", "fats")
+
+DEFAULT_CUP_GRAMS = 240.0
+DEFAULT_UNIT_GRAMS = 100.0
+
+# Mass/volume units, expressed in grams or in cups for volume measures.
+MASS_UNITS = {
+    "g": 1.0, "gram": 1.0, "grams": 1.0,
+    "kg": 1000.0, "kilogram": 1000.0, "kilograms": 1000.0,
+    "oz": 28.35, "ounce": 28.35, "ounces": 28.35,
+    "lb": 453.6, "lbs": 453.6, "pound": 453.6, "pounds": 453.6,
+    "ml": 1.0, "milliliter": 1.0, "milliliters": 1.0,
+    "l": 1000.0, "liter": 1000.0, "liters": 1000.0,
+}
+VOLUME_UNITS = {
+    "cup": 1.0, "cups": 1.0,
+    "tbsp": 1 / 16, "tablespoon": 1 / 16, "tablespoons": 1 / 16,
+    "tsp": 1 / 48, "teaspoon": 1 / 48, "teaspoons": 1 / 48,
+}
+PIECE_UNITS = {
+    "piece", "pieces", "slice", "slices", "clove", "cloves", "scoop", "scoops",
+    "whole", "small", "medium", "large", "fillet", "fillets", "breast", "breasts",
+}
+CAN_GRAMS = 400.0
+
+_QUANTITY_RE = re.compile(
+    r"^\s*[-*•]?\s*(?P<qty>\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?)(?:\s*[-–]\s*\d+(?:\.\d+)?)?\s*(?P<rest>.*)$"
+)
+_UNIT_RE = re.compile(r"^(?P<unit>[a-zA-Z]+)\.?\s+(?:of\s+)?(?P<name>.+)$")
+_FRACTION_CHARS = {"½": " 1/2", "¼": " 1/4", "¾": " 3/4", "⅓": " 1/3", "⅔": " 2/3"}
+_NAME_NOISE_RE = re.compile(r"\(.*?\)|,.*$")
+_WORD_RE = re.compile(r"[a-z]+(?:-[a-z]+)?")
+
+_RECIPE_SPLIT_RE = re.compile(r"(?=^Recipe:)", re.MULTILINE)
+_SERVINGS_RE = re.compile(r"Servings:\s*(\d+(?:\.\d+)?)", re.IGNORECASE)
+_CALORIES_HTML_RE = re.compile(r"(Estimated Calories Per Serving:\s*(?:</?\w+>\s*)*~?\s*)(\d[\d,]*(?:\.\d+)?)")
+_MACRO_HTML_RE = {
+    name: re.compile(rf"({label}:\s*(?:</?\w+>\s*)*~?\s*)(\d+(?:\.\d+)?)(\s*g\b)")
+    for name, label in (("protein", "Protein"), ("carbs", "Carbs"), ("fats", "Fats"))
+}
+
+
+@dataclass
+class ParsedRecipe:
+    name: str
+    servings: float
+    ingredients: List[Tuple[float, str]] = field(default_factory=list)
+    unparsed: List[str] = field(default_factory=list)
+
+
+class NutritionTable:
+    """Nutrient matrix (per 100 g) backed by memory-mapped NumPy arrays, plus a name index."""
+
+    def __init__(self, csv_path: str = NUTRIENTS_CSV, cache_dir: str = CACHE_DIR):
+        with open(csv_path, "r", encoding="utf-8") as handle:
+            rows = list(csv.DictReader(handle))
+
+        self.names: List[str] = [row["name"].strip().lower() for row in rows]
+        self.index: Dict[str, int] = {}
+        for position, row in enumerate(rows):
+            for alias in [row["name"], *row.get("aliases", "").split("|")]:
+                alias = alias.strip().lower()
+                if alias:
+                    self.index.setdefault(alias, position)
+        self.max_name_words = max(len(name.split()) for name in self.index)
+
+        values, unit_grams, cup_grams = self._load_arrays(csv_path, cache_dir, rows)
+        self.values = values
+        self.unit_grams = unit_grams
+        self.cup_grams = cup_grams
+
+    @staticmethod
+    def _load_arrays(csv_path: str, cache_dir: str, rows: List[Dict[str, str]]):
+        with open(csv_path, "rb") as handle:
+            digest = hashlib.sha1(handle.read()).hexdigest()[:12]
+        cache_path = os.path.join(cache_dir, f"nutrients-{digest}.npy")
+
+        if not os.path.exists(cache_path):
+            matrix = np.array(
+                [
+                    [
+                        float(row["kcal"]),
+                        float(row["protein"]),
+                        float(row["carbs"]),
+                        float(row["fat"]),
+                        float(row["unit_g"] or DEFAULT_UNIT_GRAMS),
+                        float(row["cup_g"] or DEFAULT_CUP_GRAMS),
+                    ]
+                    for row in rows
+                ],
+                dtype=np.float64,
+            )
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as handle:
+                    np.save(handle, matrix)
+                os.replace(tmp_path, cache_path)
+            except OSError as exc:
+                print(f"Nutrient cache not writable ({exc}); using in-memory table")
+                return matrix[:, :4], matrix[:, 4], matrix[:, 5]
+
+        mapped = np.load(cache_path, mmap_mode="r")
+        return mapped[:, :4], mapped[:, 4], mapped[:, 5]
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Return the row for an ingredient name, matching the longest known phrase in it."""
+        cleaned = _NAME_NOISE_RE.sub("", name.lower())
+        words = _WORD_RE.findall(cleaned)
+        for size in range(min(len(words), self.max_name_words), 0, -1):
+            for start in range(len(words) - size, -1, -1):
+                phrase = " ".join(words[start:start + size])
+                row = self.index.get(phrase)
+                if row is None and phrase.endswith("s"):
+                    row = self.index.get(phrase[:-1])
+                if row is not None:
+                    return row
+        return None
+
+    def grams_for(self, quantity: float, unit: Optional[str], row: int) -> float:
+        """Convert a quantity + unit into grams for the given ingredient row."""
+        if unit is None or unit in PIECE_UNITS:
+            return quantity * float(self.unit_grams[row])
+        if unit in MASS_UNITS:
+            return quantity * MASS_UNITS[unit]
+        if unit in VOLUME_UNITS:
+            return quantity * VOLUME_UNITS[unit] * float(self.cup_grams[row])
+        if unit in ("can", "cans"):
+            return quantity * CAN_GRAMS
+        return quantity * float(self.unit_grams[row])
+
+
+_table: Optional[NutritionTable] = None
+_table_lock = threading.Lock()
+
+
+def get_table() -> NutritionTable:
+    """Load the bundled nutrient table once per process."""
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = NutritionTable()
+    return _table
+
+
+def _parse_quantity(text: str) -> float:
+    total = 0.0
+    for part in text.split():
+        total += float(Fraction(part))
+    return total
+
+
+def parse_ingredient(line: str, table: NutritionTable) -> Optional[Tuple[float, int]]:
+    """Parse a "quantity item" line into (grams, table row), or None if it can't be resolved."""
+    for char, replacement in _FRACTION_CHARS.items():
+        line = line.replace(char, replacement)
+    match = _QUANTITY_RE.match(line)
+    if not match:
+        return None
+    quantity = _parse_quantity(match.group("qty"))
+    rest = match.group("rest").strip()
+
+    unit = None
+    name = rest
+    unit_match = _UNIT_RE.match(rest)
+    if unit_match:
+        candidate = unit_match.group("unit").lower()
+        if candidate in MASS_UNITS or candidate in VOLUME_UNITS or candidate in PIECE_UNITS or candidate in ("can", "cans"):
+            unit = candidate
+            name = unit_match.group("name")
+
+    row = table.lookup(name)
+    if row is None and unit in PIECE_UNITS:
+        # "2 large eggs" / "1 chicken breast": the "unit" is part of the name.
+        row = table.lookup(rest)
+    if row is None:
+        return None
+    return table.grams_for(quantity, unit, row), row
+
+
+def parse_recipes(content: str, table: Optional[NutritionTable] = None) -> List[ParsedRecipe]:
+    """Extract recipes written in the strict recipe format from a (possibly HTML) reply."""
+    table = table or get_table()
+    text = html_to_text(content)
+    recipes: List[ParsedRecipe] = []
+    for block in _RECIPE_SPLIT_RE.split(text):
+        if not block.startswith("Recipe:"):
+            continue
+        lines = block.splitlines()
+        recipe_name = lines[0][len("Recipe:"):].strip()
+
+        servings_match = _SERVINGS_RE.search(block)
+        servings = float(servings_match.group(1)) if servings_match else 1.0
+        recipe = ParsedRecipe(name=recipe_name, servings=max(servings, 1.0))
+
+        in_ingredients = False
+        for line in lines[1:]:
+            stripped = line.strip()
+            if stripped.startswith("Ingredients:"):
+                in_ingredients = True
+                stripped = stripped[len("Ingredients:"):].strip()
+                if not stripped:
+                    continue
+            elif stripped.startswith("Instructions:"):
+                break
+            if not in_ingredients or not stripped:
+                continue
+            parsed = parse_ingredient(stripped, table)
+            if parsed is None:
+                recipe.unparsed.append(stripped)
+            else:
+                recipe.ingredients.append(parsed)
+        recipes.append(recipe)
+    return recipes
+
+
+def compute_recipe_nutrition(
+    recipes: Sequence[ParsedRecipe],
+    table: Optional[NutritionTable] = None,
+) -> List[Dict[str, float]]:
+    """Compute per-serving calories and macros for a batch of parsed recipes in one pass."""
+    table = table or get_table()
+    if not recipes:
+        return []
+
+    recipe_idx: List[int] = []
+    rows: List[int] = []
+    grams: List[float] = []
+    for position, recipe in enumerate(recipes):
+        for amount, row in recipe.ingredients:
+            recipe_idx.append(position)
+            rows.append(row)
+            grams.append(amount)
+
+    totals = np.zeros((len(recipes), len(NUTRIENT_COLUMNS)), dtype=np.float64)
+    if rows:
+        contributions = table.values[np.asarray(rows)] * (np.asarray(grams)[:, None] / 100.0)
+        np.add.at(totals, np.asarray(recipe_idx), contributions)
+    servings = np.array([recipe.servings for recipe in recipes], dtype=np.float64)
+    per_serving = totals / servings[:, None]
+
+    results = []
+    for recipe, values in zip(recipes, per_serving):
+        matched = len(recipe.ingredients)
+        total_lines = matched + len(recipe.unparsed)
+        result = {column: round(float(value), 1) for column, value in zip(NUTRIENT_COLUMNS, values)}
+        result["calories"] = round(result["calories"])
+        result["coverage"] = matched / total_lines if total_lines else 0.0
+        results.append(result)
+    return results
+
+
+def _replace_nth(pattern: re.Pattern, text: str, values: List[Optional[str]]) -> str:
+    counter = {"n": 0}
+
+    def substitute(match: re.Match) -> str:
+        position = counter["n"]
+        counter["n"] += 1
+        if position >= len(values) or values[position] is None:
+            return match.group(0)
+        suffix = match.group(3) if match.lastindex and match.lastindex >= 3 else ""
+        return f"{match.group(1)}{values[position]}{suffix}"
+
+    return pattern.sub(substitute, text)
+
+
+def reconcile_reply(reply: str, mode: str, min_coverage: float = 1.0) -> str:
+    """
+    Check ("check") or overwrite ("overwrite") the model's per-serving estimates
+    with values computed from the local table. Recipes whose ingredients are not
+    fully recognized (below `min_coverage`) are left untouched.
+    """
+    if mode not in ("check", "overwrite") or "Recipe:" not in reply:
+        return reply
+
+    table = get_table()
+    recipes = parse_recipes(reply, table)
+    computed = compute_recipe_nutrition(recipes, table)
+    trusted = [result if result["coverage"] >= min_coverage else None for result in computed]
+
+    if mode == "check":
+        for recipe, result in zip(recipes, computed):
+            print(
+                f"Nutrition check for {recipe.name!r}: {result['calories']} kcal, {result['protein']} g protein, "
+                f"{result['carbs']} g carbs, {result['fats']} g fats (coverage {result['coverage'] * 100:.0f}%)"
+            )
+        return reply
+
+    if len(_CALORIES_HTML_RE.findall(reply)) != len(recipes):
+        # Labels and recipes don't line up one-to-one; overwriting could hit the wrong recipe.
+        return reply
+
+    updated = _replace_nth(
+        _CALORIES_HTML_RE,
+        reply,
+        [str(result["calories"]) if result else None for result in trusted],
+    )
+    for column, pattern in _MACRO_HTML_RE.items():
+        if len(pattern.findall(updated)) != len(recipes):
+            continue
+        updated = _replace_nth(
+            pattern,
+            updated,
+            [f"{result[column]:g}" if result else None for result in trusted],
+        )
+    return updated
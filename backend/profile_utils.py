@@ -1,7 +1,19 @@
 import json
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 
 PROFILE_FIELDS = ("fitness_goals", "dietary_restrictions")
+# Structured fields next to the free-text ones: sets of allergen/diet names and daily targets.
+LIST_FIELDS = ("allergens", "diets")
+TARGET_FIELDS = ("calorie_target", "protein_target_g", "carbs_target_g", "fats_target_g")
+STRUCTURED_FIELDS = LIST_FIELDS + TARGET_FIELDS
+ALL_PROFILE_FIELDS = PROFILE_FIELDS + STRUCTURED_FIELDS
+
+_TARGET_LABELS = {
+    "calorie_target": ("Daily Calorie Target", "kcal"),
+    "protein_target_g": ("Daily Protein Target", "g"),
+    "carbs_target_g": ("Daily Carbs Target", "g"),
+    "fats_target_g": ("Daily Fats Target", "g"),
+}
 
 
 def _normalize(value: Optional[str]) -> Optional[str]:
@@ -11,7 +23,37 @@ def _normalize(value: Optional[str]) -> Optional[str]:
     return cleaned if cleaned else None
 
 
-def format_profile_context(profile: Optional[Dict[str, Optional[str]]]) -> str:
+def _normalize_list(value: Any) -> Optional[List[str]]:
+    """Lowercased, de-duplicated, sorted names from a list or comma-separated string."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, (list, tuple, set, frozenset)):
+        return None
+    items = sorted({" ".join(str(item).lower().replace("_", " ").split()) for item in value if isinstance(item, str)} - {""})
+    return items
+
+
+def _normalize_target(value: Any) -> Optional[int]:
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        number = int(round(float(value)))
+    except ValueError:
+        return None
+    return number if number > 0 else None
+
+
+def normalize_field(field: str, value: Any) -> Any:
+    if field in LIST_FIELDS:
+        return _normalize_list(value)
+    if field in TARGET_FIELDS:
+        return _normalize_target(value)
+    return _normalize(value) if isinstance(value, str) else None
+
+
+def format_profile_context(profile: Optional[Dict[str, Any]]) -> str:
     """Return a readable summary of the user's profile."""
     profile = profile or {}
     lines = ["User Profile Context"]
@@ -19,17 +61,28 @@ def format_profile_context(profile: Optional[Dict[str, Optional[str]]]) -> str:
         label = field.replace("_", " ").title()
         value = _normalize(profile.get(field)) or "Not provided"
         lines.append(f"- {label}: {value}")
+    for field in LIST_FIELDS:
+        values = _normalize_list(profile.get(field))
+        if values:
+            lines.append(f"- {field.title()} (never include): {', '.join(values)}")
+    for field in TARGET_FIELDS:
+        value = _normalize_target(profile.get(field))
+        if value:
+            label, unit = _TARGET_LABELS[field]
+            lines.append(f"- {label}: {value} {unit}")
     return "\n".join(lines)
 
 
-def parse_profile_update(raw_text: str) -> Dict[str, str]:
+def parse_profile_update(raw_text: str) -> Dict[str, Any]:
     """Parse JSON returned by the language model into cleaned profile fields."""
     try:
         payload = json.loads(raw_text)
     except json.JSONDecodeError:
         return {}
+    if not isinstance(payload, dict):
+        return {}
 
-    updates: Dict[str, str] = {}
+    updates: Dict[str, Any] = {}
     for field in PROFILE_FIELDS:
         value = payload.get(field)
         if not isinstance(value, str):
@@ -37,14 +90,25 @@ def parse_profile_update(raw_text: str) -> Dict[str, str]:
         cleaned = _normalize(value)
         if cleaned:
             updates[field] = cleaned
+    for field in STRUCTURED_FIELDS:
+        value = payload.get(field)
+        cleaned = normalize_field(field, value)
+        # null means no change; an explicit [] clears the list ("no allergies after all").
+        if cleaned is None or (cleaned == [] and value != []):
+            continue
+        updates[field] = cleaned
     return updates
 
 
-def diff_profile(current: Optional[Dict[str, Optional[str]]], updates: Dict[str, str]) -> Dict[str, str]:
+def diff_profile(current: Optional[Dict[str, Any]], updates: Dict[str, Any]) -> Dict[str, Any]:
     """Return only the updates that differ from what is already stored."""
     current = current or {}
-    diff: Dict[str, str] = {}
+    diff: Dict[str, Any] = {}
     for field, new_value in updates.items():
+        if field in STRUCTURED_FIELDS:
+            if normalize_field(field, new_value) != normalize_field(field, current.get(field)):
+                diff[field] = new_value
+            continue
         existing = _normalize(current.get(field))
         if new_value != (existing or None):
             diff[field] = new_value
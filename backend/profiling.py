@@ -0,0 +1,185 @@
+"""
+Opt-in sampling profiler for chat requests.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>` or is
+picked by `PROFILE_SAMPLE_RATE`. `ProfilingMiddleware` wraps the whole
+request, so body parsing on the event loop is sampled too. Code that runs in
+other threads for the request (the auth dependency, the handler) joins the
+sample with `follow()`. While the request runs, a helper thread reads those
+threads' stacks every few milliseconds. When it finishes the samples are
+written as collapsed stacks (`outer;inner;leaf count`, the input of
+flamegraph.pl and speedscope) into a directory that keeps only the newest
+`max_files` dumps. Requests that aren't picked pay one attribute check.
+"""
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+SUFFIX = ".folded"
+
+# Sampler of the request being profiled; worker threads started for it inherit the context.
+_active_sampler: ContextVar[Optional["StackSampler"]] = ContextVar("active_sampler", default=None)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class StackSampler:
+    """Counts the stacks of a set of threads, sampled every `interval` seconds from a daemon thread."""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._thread_ids = {thread_id}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def add(self, thread_id: int) -> bool:
+        """Sample `thread_id` too; False if it was sampled already."""
+        with self._lock:
+            if thread_id in self._thread_ids:
+                return False
+            self._thread_ids.add(thread_id)
+            return True
+
+    def discard(self, thread_id: int) -> None:
+        with self._lock:
+            self._thread_ids.discard(thread_id)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                thread_ids = tuple(self._thread_ids)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                # An event loop waiting in select() is idle, not working on the request.
+                if stack and not stack[0].startswith("selectors."):
+                    self.samples[tuple(reversed(stack))] += 1
+
+
+class RequestProfiler:
+    def __init__(
+        self,
+        directory: str,
+        max_files: int = 50,
+        sample_rate: float = 0.0,
+        interval: float = 0.005,
+        token: str = "",
+    ):
+        self.directory = directory
+        self.max_files = max(max_files, 1)
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.token = token
+        self.enabled = bool(token) or sample_rate > 0
+
+    def wanted(self, header: Optional[str]) -> bool:
+        """Whether to profile a request that sent `header` as its X-Profile value."""
+        if not self.enabled:
+            return False
+        if self.token and header and hmac.compare_digest(header, self.token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, label: str, wanted: bool) -> Iterator[None]:
+        """Sample the calling thread for the duration of the block when `wanted`."""
+        if not wanted:
+            yield
+            return
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        started = time.perf_counter()
+        sampler.start()
+        token = _active_sampler.set(sampler)
+        try:
+            yield
+        finally:
+            _active_sampler.reset(token)
+            samples = sampler.stop()
+            try:
+                self.write(label, samples, time.perf_counter() - started)
+            except OSError as exc:
+                print("Profile dump failed:", exc)
+
+    @contextmanager
+    def follow(self) -> Iterator[None]:
+        """Sample the calling thread too during the block when it works for a request being profiled."""
+        sampler = _active_sampler.get()
+        if sampler is None:
+            yield
+            return
+        thread_id = threading.get_ident()
+        added = sampler.add(thread_id)
+        try:
+            yield
+        finally:
+            if added:
+                sampler.discard(thread_id)
+
+    def write(self, label: str, samples: Counter, elapsed: float) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.time_ns()}-{os.getpid()}-{label}-{elapsed * 1000:.0f}ms{SUFFIX}"
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as handle:
+            for stack, count in samples.most_common():
+                handle.write(f"{';'.join(stack)} {count}\n")
+        self._prune()
+        return path
+
+    def _prune(self) -> None:
+        dumps = sorted(name for name in os.listdir(self.directory) if name.endswith(SUFFIX))
+        for name in dumps[: max(len(dumps) - self.max_files, 0)]:
+            # Another worker sharing the directory may have removed it already.
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(self.directory, name))
+
+    def dumps(self) -> Tuple[str, ...]:
+        if not os.path.isdir(self.directory):
+            return ()
+        return tuple(sorted(name for name in os.listdir(self.directory) if name.endswith(SUFFIX)))
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles picked requests to the paths in `labels`
+    (path -> dump label) from the first byte received to the last byte sent.
+    `profiler` returns the RequestProfiler to use, so it can be swapped at runtime.
+    """
+
+    def __init__(self, app, profiler: Callable[[], RequestProfiler], labels: Dict[str, str]):
+        self.app = app
+        self.profiler = profiler
+        self.labels = labels
+
+    async def __call__(self, scope, receive, send):
+        label = self.labels.get(scope.get("path")) if scope["type"] == "http" else None
+        profiler = self.profiler() if label else None
+        if profiler is None or not profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+        header = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"x-profile"), None)
+        with profiler.profile(label, profiler.wanted(header)):
+            await self.app(scope, receive, send)
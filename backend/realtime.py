@@ -0,0 +1,135 @@
+"""
+Plumbing for the chat WebSocket: a bounded per-connection outbox and a
+per-user fan-out for events such as profile updates.
+"""
+import asyncio
+import concurrent.futures
+import threading
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+# Application close codes (4000-4999 are free for applications to use).
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_TOO_SLOW = 4408
+
+_CLOSE = object()
+
+Frame = Dict[str, Any]
+
+
+class Outbox:
+    """
+    Frames waiting to be written to one socket, at most `limit` at a time.
+
+    Chat turns run in worker threads and hand their frames over with
+    `put_threadsafe`, which blocks while the outbox is full, so a client that
+    stops reading slows its own generations down instead of growing memory.
+    If there is still no room after `send_timeout` seconds the client is
+    considered stuck: the outbox closes with CLOSE_TOO_SLOW and later frames
+    are dropped (the turns themselves still finish and are stored). All other
+    methods must be called on the event loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, limit: int = 256, send_timeout: float = 30.0):
+        self.limit = max(limit, 1)
+        self.send_timeout = send_timeout
+        self.closed = False
+        self.close_code: Optional[int] = None
+        self.dropped = 0
+        self._loop = loop
+        self._queue: "asyncio.Queue" = asyncio.Queue()
+        self._pending = 0
+        self._space = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def put(self, frame: Frame) -> bool:
+        while self._pending >= self.limit and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        return self.offer(frame)
+
+    def offer(self, frame: Frame) -> bool:
+        """Queue `frame` without waiting; it is dropped when the outbox is full or closed."""
+        if self.closed or self._pending >= self.limit:
+            self.dropped += 1
+            return False
+        self._pending += 1
+        self._queue.put_nowait(frame)
+        return True
+
+    def put_threadsafe(self, frame: Frame) -> bool:
+        if self.closed:
+            return False
+        future = asyncio.run_coroutine_threadsafe(self.put(frame), self._loop)
+        try:
+            return future.result(self.send_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self._loop.call_soon_threadsafe(self.close, CLOSE_TOO_SLOW)
+        except (concurrent.futures.CancelledError, RuntimeError):
+            pass
+        return False
+
+    def offer_threadsafe(self, frame: Frame) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self.offer, frame)
+        except RuntimeError:
+            # The connection's loop has already shut down.
+            pass
+
+    def close(self, code: Optional[int] = None) -> None:
+        """Stop accepting frames. With a `code` the connection is aborted instead of drained."""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        self._space.set()
+        self._queue.put_nowait(_CLOSE)
+        if code is not None and self._task is not None:
+            self._task.cancel()
+
+    def start(self, send: Callable[[Frame], Awaitable[None]]) -> "asyncio.Task":
+        self._task = self._loop.create_task(self._pump(send))
+        return self._task
+
+    async def _pump(self, send: Callable[[Frame], Awaitable[None]]) -> None:
+        while True:
+            frame = await self._queue.get()
+            if frame is _CLOSE:
+                return
+            self._pending -= 1
+            self._space.set()
+            await send(frame)
+
+
+class Subscribers:
+    """Callbacks per user for the sockets open in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: Dict[str, Set[Callable[[Frame], None]]] = defaultdict(set)
+
+    def subscribe(self, user_id: str, callback: Callable[[Frame], None]) -> Callable[[], None]:
+        with self._lock:
+            self._callbacks[user_id].add(callback)
+
+        def unsubscribe() -> None:
+            with self._lock:
+                callbacks = self._callbacks.get(user_id)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self._callbacks[user_id]
+
+        return unsubscribe
+
+    def publish(self, user_id: str, event: Frame) -> int:
+        with self._lock:
+            callbacks = list(self._callbacks.get(user_id, ()))
+        for callback in callbacks:
+            callback(event)
+        return len(callbacks)
+
+    def connections(self) -> int:
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._callbacks.values())
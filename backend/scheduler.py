@@ -0,0 +1,152 @@
+import itertools
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+# Priority classes: lower runs first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request can't be queued or waited too long for a slot."""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Ticket:
+    priority: int
+    start_tag: float
+    finish_tag: float
+    seq: int
+    user_id: str
+    admitted: bool = False
+
+    def sort_key(self):
+        return (self.priority, self.finish_tag, self.seq)
+
+
+class FairScheduler:
+    """
+    Admission control for Gemini calls.
+
+    At most `capacity` calls run at once and each user has at most
+    `per_user_limit` of them. When callers have to wait, interactive work goes
+    before background work, and within a priority class users are served by
+    weighted fair queueing (start-time fair queueing on per-user virtual
+    finish tags), so one busy user can't starve everyone else.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        per_user_limit: int,
+        max_queue: int = 64,
+        max_queue_per_user: int = 4,
+        queue_timeout: float = 30.0,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.capacity = max(capacity, 1)
+        self.per_user_limit = max(per_user_limit, 1)
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_timeout = queue_timeout
+        self.weights = dict(weights or {})
+
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._user_inflight: Counter = Counter()
+        self._user_queued: Counter = Counter()
+        self._waiting: List[_Ticket] = []
+        self._user_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"inflight": self._inflight, "queued": len(self._waiting), "capacity": self.capacity}
+
+    def _eligible(self, user_id: str) -> bool:
+        return self._user_inflight[user_id] < self.per_user_limit
+
+    def _dispatch(self) -> None:
+        # Admit the best eligible tickets while there is spare capacity.
+        admitted = False
+        while self._inflight < self.capacity:
+            candidates = [t for t in self._waiting if self._eligible(t.user_id)]
+            if not candidates:
+                break
+            ticket = min(candidates, key=_Ticket.sort_key)
+            self._waiting.remove(ticket)
+            self._user_queued[ticket.user_id] -= 1
+            self._admit(ticket)
+            admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def _admit(self, ticket: _Ticket) -> None:
+        ticket.admitted = True
+        self._inflight += 1
+        self._user_inflight[ticket.user_id] += 1
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+
+    def _new_ticket(self, user_id: str, priority: int, weight: Optional[float]) -> _Ticket:
+        weight = weight or self.weights.get(user_id, 1.0)
+        start = max(self._virtual_time, self._user_finish.get(user_id, 0.0))
+        finish = start + 1.0 / weight
+        self._user_finish[user_id] = finish
+        return _Ticket(priority, start, finish, next(self._seq), user_id)
+
+    def acquire(self, user_id: str, priority: int = INTERACTIVE, weight: Optional[float] = None) -> _Ticket:
+        with self._cond:
+            if not self._waiting and self._inflight < self.capacity and self._eligible(user_id):
+                ticket = self._new_ticket(user_id, priority, weight)
+                self._admit(ticket)
+                return ticket
+
+            if len(self._waiting) >= self.max_queue:
+                raise SchedulerOverloaded("Too many requests queued for generation")
+            if self._user_queued[user_id] >= self.max_queue_per_user:
+                raise SchedulerOverloaded("Too many of your requests are already queued")
+
+            ticket = self._new_ticket(user_id, priority, weight)
+            self._waiting.append(ticket)
+            self._user_queued[user_id] += 1
+            self._dispatch()
+
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket.admitted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    self._user_queued[user_id] -= 1
+                    raise SchedulerOverloaded("Timed out waiting for a generation slot")
+                self._cond.wait(remaining)
+            return ticket
+
+    def release(self, ticket: _Ticket) -> None:
+        with self._cond:
+            self._inflight -= 1
+            self._user_inflight[ticket.user_id] -= 1
+            if self._user_inflight[ticket.user_id] <= 0:
+                del self._user_inflight[ticket.user_id]
+                if not self._user_queued[ticket.user_id]:
+                    del self._user_queued[ticket.user_id]
+                    # An idle user's finish tag is behind virtual time and no longer matters.
+                    if self._user_finish.get(ticket.user_id, 0.0) <= self._virtual_time:
+                        self._user_finish.pop(ticket.user_id, None)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user_id: str, priority: int = INTERACTIVE, weight: Optional[float] = None) -> Iterator[None]:
+        ticket = self.acquire(user_id, priority, weight)
+        try:
+            yield
+        finally:
+            self.release(ticket)
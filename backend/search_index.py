@@ -0,0 +1,263 @@
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set
+
+from backend.text_utils import html_to_text
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_DOC_CHARS = 20_000
+SNIPPET_CHARS = 160
+# How long a search waits for another request that is already building the user's partition.
+LOAD_WAIT_SECONDS = 10.0
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    """
+    a an and are as at be but by can do for from how i if in into is it its me my of on or our so
+    that the their them then there these they this to was we were what when which who will with you
+    your last find
+    """.split()
+)
+
+
+def _stem(token: str) -> str:
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 4 and token.endswith("es") and token[-3] in "sxz":
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def normalize_text(content: str) -> str:
+    """Plain text of a stored message with accents folded (é -> e)."""
+    text = unicodedata.normalize("NFKD", html_to_text(content))
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, drop stopwords and apply light plural stemming."""
+    return [_stem(token) for token in _TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+@dataclass
+class IndexedMessage:
+    message_id: str
+    conversation_id: str
+    role: str
+    text: str
+    created_at: Optional[str]
+    length: int
+
+
+class UserIndex:
+    """Inverted index with BM25 ranking over one user's messages."""
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.docs: Dict[str, IndexedMessage] = {}
+        self.by_conversation: Dict[str, Set[str]] = {}
+        self.total_length = 0
+
+    def add(self, message_id: str, conversation_id: str, role: str, content: str, created_at: Optional[str]) -> None:
+        if message_id in self.docs:
+            return
+        text = normalize_text(content)[:MAX_DOC_CHARS]
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        self.docs[message_id] = IndexedMessage(message_id, conversation_id, role, text, created_at, length)
+        self.by_conversation.setdefault(conversation_id, set()).add(message_id)
+        self.total_length += length
+        for term, frequency in counts.items():
+            self.postings.setdefault(term, {})[message_id] = frequency
+
+    def remove(self, message_id: str) -> None:
+        doc = self.docs.pop(message_id, None)
+        if doc is None:
+            return
+        self.total_length -= doc.length
+        conversation_docs = self.by_conversation.get(doc.conversation_id)
+        if conversation_docs is not None:
+            conversation_docs.discard(message_id)
+            if not conversation_docs:
+                del self.by_conversation[doc.conversation_id]
+        for term in set(tokenize(doc.text)):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(message_id, None)
+                if not posting:
+                    del self.postings[term]
+
+    def remove_conversation(self, conversation_id: str) -> None:
+        for message_id in list(self.by_conversation.get(conversation_id, ())):
+            self.remove(message_id)
+
+    def search(self, query: str, limit: int = 20) -> List[Dict[str, object]]:
+        terms = set(tokenize(normalize_text(query)))
+        if not terms or not self.docs:
+            return []
+        n_docs = len(self.docs)
+        avg_length = self.total_length / n_docs or 1.0
+        scores: Dict[str, float] = {}
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for message_id, frequency in posting.items():
+                length = self.docs[message_id].length
+                norm = frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[message_id] = scores.get(message_id, 0.0) + idf * frequency * (BM25_K1 + 1) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        results = []
+        for message_id, score in ranked:
+            doc = self.docs[message_id]
+            results.append(
+                {
+                    "message_id": message_id,
+                    "conversation_id": doc.conversation_id,
+                    "role": doc.role,
+                    "created_at": doc.created_at,
+                    "score": round(score, 4),
+                    "snippet": _snippet(doc.text, terms),
+                }
+            )
+        return results
+
+
+def _snippet(text: str, terms: Set[str]) -> str:
+    lowered = text.lower()
+    position = -1
+    for match in _TOKEN_RE.finditer(lowered):
+        if _stem(match.group(0)) in terms:
+            position = match.start()
+            break
+    start = max(position - SNIPPET_CHARS // 3, 0) if position >= 0 else 0
+    snippet = " ".join(text[start:start + SNIPPET_CHARS].split())
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + SNIPPET_CHARS < len(text) else ""
+    return f"{prefix}{snippet}{suffix}"
+
+
+class _Partition:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = UserIndex()
+        self.loaded = False
+        self.loading = False
+        self.ready = threading.Event()
+        self.pending: List[tuple] = []
+        self.removed_conversations: Set[str] = set()
+
+
+class SearchIndex:
+    """
+    Per-user partitions of `UserIndex`, kept for the most recently active users.
+    A partition is built from storage on its first search; after that it is
+    updated incrementally as messages are written or conversations deleted.
+    """
+
+    def __init__(self, max_users: int = 1000):
+        self.max_users = max_users
+        self._partitions: "OrderedDict[str, _Partition]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._partitions
+
+    def _partition(self, user_id: str, create: bool) -> Optional[_Partition]:
+        with self._lock:
+            partition = self._partitions.get(user_id)
+            if partition is None and create:
+                partition = _Partition()
+                self._partitions[user_id] = partition
+                while len(self._partitions) > self.max_users:
+                    self._partitions.popitem(last=False)
+            if partition is not None:
+                self._partitions.move_to_end(user_id)
+            return partition
+
+    def add_message(
+        self,
+        user_id: str,
+        conversation_id: str,
+        message_id: str,
+        role: str,
+        content: str,
+        created_at: Optional[str] = None,
+    ) -> None:
+        partition = self._partition(user_id, create=False)
+        if partition is None:
+            # Not loaded yet: the first search reads this message from storage.
+            return
+        with partition.lock:
+            if partition.loading:
+                partition.pending.append((message_id, conversation_id, role, content, created_at))
+            else:
+                partition.index.add(message_id, conversation_id, role, content, created_at)
+
+    def remove_conversation(self, user_id: str, conversation_id: str) -> None:
+        partition = self._partition(user_id, create=False)
+        if partition is None:
+            return
+        with partition.lock:
+            if partition.loading:
+                partition.removed_conversations.add(conversation_id)
+            partition.index.remove_conversation(conversation_id)
+
+    def drop_user(self, user_id: str) -> None:
+        with self._lock:
+            self._partitions.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._partitions.clear()
+
+    def search(self, user_id: str, query: str, loader, limit: int = 20) -> List[Dict[str, object]]:
+        """Search a user's messages; `loader(user_id)` yields stored rows the first time."""
+        partition = self._partition(user_id, create=True)
+        with partition.lock:
+            needs_load = not partition.loaded and not partition.loading
+            if needs_load:
+                partition.loading = True
+                partition.ready.clear()
+        if needs_load:
+            self._load(partition, loader(user_id))
+        else:
+            partition.ready.wait(LOAD_WAIT_SECONDS)
+        with partition.lock:
+            return partition.index.search(query, limit)
+
+    @staticmethod
+    def _load(partition: _Partition, rows: Iterable[Dict[str, object]]) -> None:
+        index = UserIndex()
+        try:
+            for row in rows:
+                index.add(row["id"], row["conversation_id"], row.get("role", ""), row.get("content") or "", row.get("created_at"))
+        except Exception:
+            with partition.lock:
+                partition.loading = False
+                partition.pending.clear()
+                partition.removed_conversations.clear()
+            partition.ready.set()
+            raise
+        with partition.lock:
+            for conversation_id in partition.removed_conversations:
+                index.remove_conversation(conversation_id)
+            for message_id, conversation_id, role, content, created_at in partition.pending:
+                if conversation_id not in partition.removed_conversations:
+                    index.add(message_id, conversation_id, role, content, created_at)
+            partition.index = index
+            partition.pending.clear()
+            partition.removed_conversations.clear()
+            partition.loading = False
+            partition.loaded = True
+        partition.ready.set()
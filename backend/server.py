@@ -1,19 +1,63 @@
+import asyncio
+import contextvars
 import importlib
 import os
+import queue
+import threading
+import time
 import uuid
-from contextlib import suppress
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, suppress
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 from google.generativeai import types as genai_types
 from google.api_core import exceptions as gapi_exceptions
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, Header, HTTPException, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from backend.profile_utils import diff_profile, format_profile_context, parse_profile_update
+from backend.allergen_screen import ScreenStats, screen_reply, screener_for_profile
+from backend.archive import ARCHIVE_TABLE, iter_archives, load_archive, make_cursor, read_page
+from backend.deferred import DONE, CapacityUnavailable, DeferredJob, DeferredQueue, DeferredQueueFull
+from backend.export import encode_lines, export_records, gzip_chunks
+from backend.format_validator import FormatStats, check_reply
+from backend.http_utils import (
+    FastJSONResponse,
+    cache_headers,
+    dumps,
+    etag_matches,
+    json_response,
+    make_etag,
+    not_modified,
+    set_cache_headers,
+)
+from backend.idempotency import IdempotencyConflict, IdempotencyStore, request_fingerprint
+from backend.intent_router import RouterStats, classify_message
+from backend.journal import MESSAGE, TOUCH, MessageJournal, merge_pending
+from backend.nutrition import reconcile_reply
+from backend.profiling import ProfilingMiddleware, RequestProfiler
+from backend.realtime import CLOSE_UNAUTHORIZED, Outbox, Subscribers
+from backend.resilience import BreakerRegistry, LatencyTracker
+from backend.search_index import SearchIndex
+from backend.shared_state import FLUSH_ALL, InvalidationFeed, create_shared_state
+from backend.system_prompt import PromptStats, build_system_prompt, detect_formats, full_system_prompt
+from backend.usage import (
+    USAGE_TABLE,
+    UsageMeter,
+    days_back,
+    rows_to_history,
+    seconds_until_utc_midnight,
+    summarize,
+    trim_history,
+    usage_scope,
+)
+from backend.scheduler import BACKGROUND, INTERACTIVE, FairScheduler, SchedulerOverloaded
+from backend.profile_utils import STRUCTURED_FIELDS, diff_profile, format_profile_context, normalize_field, parse_profile_update
 
 jwt = importlib.import_module("jwt")
 supabase_module = importlib.import_module("supabase")
@@ -34,8 +78,47 @@ if not GEMINI_API_KEYS:
     raise RuntimeError("GEMINI_API_KEYS env var is required (comma-separated list)")
 
 MODEL = os.getenv("MODEL_NAME", "gemini-2.5-flash")
+# Cheaper/faster model tried when MODEL has no capacity left on any key; empty disables the tier.
+FALLBACK_MODEL_NAME = os.getenv("FALLBACK_MODEL_NAME", "").strip()
+
+# Model used by generations in the current context (see model_tier()).
+_active_model: contextvars.ContextVar = contextvars.ContextVar("gemini_model", default=None)
+
+
+def active_model() -> str:
+    return _active_model.get() or MODEL
+
+
+@contextmanager
+def model_tier(model_name: str):
+    """Run the generation helpers inside the block against `model_name`."""
+    token = _active_model.set(model_name)
+    try:
+        yield
+    finally:
+        _active_model.reset(token)
+
+
+def model_chain() -> List[str]:
+    return [MODEL] + ([FALLBACK_MODEL_NAME] if FALLBACK_MODEL_NAME and FALLBACK_MODEL_NAME != MODEL else [])
 
-_current_key_index = 0
+# Key cursor, per-key usage, cooldowns and cache invalidations shared across uvicorn workers.
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "memory://")
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", "10"))
+WORKER_ID = uuid.uuid4().hex
+shared_state = create_shared_state(SHARED_STATE_URL)
+invalidations = InvalidationFeed(shared_state, WORKER_ID)
+
+try:
+    # Workers start on different keys instead of all hitting key 0 first.
+    _current_key_index = shared_state.advance_key_cursor(len(GEMINI_API_KEYS))
+except Exception as exc:
+    print("Shared state unavailable at startup:", exc)
+    _current_key_index = 0
+
+
+# genai.configure() is process-global; hold this while configuring and pinning a client to a model.
+_genai_config_lock = threading.Lock()
 
 
 def _configure_genai():
@@ -43,10 +126,68 @@ def _configure_genai():
     genai.configure(api_key=GEMINI_API_KEYS[_current_key_index])
 
 
+def _configure_key(key_index: int):
+    """Configure google.generativeai with a specific key."""
+    genai.configure(api_key=GEMINI_API_KEYS[key_index])
+
+
+def _pin_client(model) -> None:
+    """
+    Bind the currently configured client to `model` so a concurrent configure()
+    for another key can't change which key this model's request uses.
+    """
+    if getattr(model, "_client", False) is None:
+        model._client = genai_client.get_default_generative_client()
+
+
 def _rotate_key():
-    """Advance to the next key in GEMINI_API_KEYS (round-robin)."""
+    """Advance to the next key in GEMINI_API_KEYS (round-robin across all workers)."""
     global _current_key_index
-    _current_key_index = (_current_key_index + 1) % len(GEMINI_API_KEYS)
+    try:
+        _current_key_index = shared_state.advance_key_cursor(len(GEMINI_API_KEYS))
+    except Exception as exc:
+        print("Shared key cursor unavailable, rotating locally:", exc)
+        _current_key_index = (_current_key_index + 1) % len(GEMINI_API_KEYS)
+
+
+def _key_breaker(key_index: int):
+    """Quotas are per model, so fallback-tier calls on a key have their own breaker."""
+    model = active_model()
+    return key_breakers.get(key_index if model == MODEL else (key_index, model))
+
+
+def _cooldown_name(key_index: int) -> str:
+    model = active_model()
+    return f"key:{key_index}" if model == MODEL else f"key:{key_index}:{model}"
+
+
+def _key_usable(key_index: int) -> bool:
+    """A key is skipped while any worker has it cooling down after a quota error, or its breaker is open."""
+    try:
+        if shared_state.cooldown_remaining(_cooldown_name(key_index)) > 0:
+            return False
+    except Exception as exc:
+        print("Shared key cooldown unavailable:", exc)
+    return _key_breaker(key_index).allow()
+
+
+def _record_key_use(key_index: int) -> None:
+    with suppress(Exception):
+        shared_state.record_key_use(key_index)
+
+
+def _record_usage(response, key_index: Optional[int], kind: str) -> None:
+    try:
+        usage_meter.record_response(response, key_index, kind)
+    except Exception as exc:
+        print("Token usage not recorded:", exc)
+
+
+def _cool_down_key(key_index: int) -> None:
+    if GEMINI_KEY_COOLDOWN_SECONDS <= 0:
+        return
+    with suppress(Exception):
+        shared_state.set_cooldown(_cooldown_name(key_index), GEMINI_KEY_COOLDOWN_SECONDS)
 
 
 # Configure once at startup
@@ -58,22 +199,178 @@ SUPABASE_JWT_SECRET = os.environ["SUPABASE_JWT_SECRET"]
 
 supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
-with open("backend/system_prompt.txt", "r", encoding="utf-8") as f:
-    SYSTEM_PROMPT = f.read()
+SYSTEM_PROMPT = full_system_prompt()
+# on: send only the format sections of the system prompt the turn may need | off: always send all of them
+PROMPT_SECTIONS_MODE = os.getenv("PROMPT_SECTIONS_MODE", "on").strip().lower()
+prompt_stats = PromptStats()
+# Format sections for conversation_model() in the current context (see prompt_formats()); None means all.
+_prompt_formats: contextvars.ContextVar = contextvars.ContextVar("prompt_formats", default=None)
+
+
+@contextmanager
+def prompt_formats(formats):
+    """Build conversation models inside the block with only the format sections in `formats` (None: all)."""
+    token = _prompt_formats.set(frozenset(formats) if formats is not None else None)
+    try:
+        yield
+    finally:
+        _prompt_formats.reset(token)
 
-PROFILE_EXTRACTION_PROMPT = """You receive the current nutrition profile and the user's latest message. If the message updates their fitness goals or dietary restrictions, return JSON with keys `fitness_goals` and `dietary_restrictions`. Use null when no change is present. Respond with JSON only."""
+PROFILE_EXTRACTION_PROMPT = """You receive the current nutrition profile and the user's latest message. If the message updates their fitness goals or dietary restrictions, return JSON with keys `fitness_goals` and `dietary_restrictions` (free text), `allergens` and `diets` (lists of short lowercase names such as "peanut", "shellfish", "vegan", "gluten free"; the full updated list) and `calorie_target`, `protein_target_g`, `carbs_target_g`, `fats_target_g` (daily integers). Use null for any key the message doesn't change. Respond with JSON only."""
 
 def profile_model() -> genai.GenerativeModel:
     return genai.GenerativeModel(
-        MODEL,
+        active_model(),
         system_instruction=PROFILE_EXTRACTION_PROMPT,
     )
 
 HTML_GENERATION_CONFIG = genai_types.GenerationConfig(response_mime_type="text/plain")
 
 MAX_GEMINI_ATTEMPTS = len(GEMINI_API_KEYS) or 2
+
+# Per-key circuit breakers: keys that keep failing or timing out are skipped until they recover.
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "3"))
+GEMINI_BREAKER_RECOVERY_SECONDS = float(os.getenv("GEMINI_BREAKER_RECOVERY_SECONDS", "30"))
+key_breakers = BreakerRegistry(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RECOVERY_SECONDS)
+
+# Optional hedging: if the first attempt is slower than the observed latency percentile,
+# race a second attempt on another healthy key and keep whichever answers first.
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0.95"))
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY", "8"))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "1"))
+generation_latency = LatencyTracker()
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="gemini-hedge")
+
+class NoHealthyKeys(RuntimeError):
+    """Every key is cooling down or has an open breaker for the current model."""
+
+
+# Errors that say something about the key or its backend, as opposed to the request itself.
+KEY_FAILURE_ERRORS = (
+    gapi_exceptions.ResourceExhausted,
+    gapi_exceptions.PermissionDenied,
+    gapi_exceptions.DeadlineExceeded,
+    gapi_exceptions.ServiceUnavailable,
+    gapi_exceptions.InternalServerError,
+)
+# Errors meaning the model has no capacity right now, so a fallback tier or a later retry may work.
+CAPACITY_ERRORS = (
+    gapi_exceptions.ResourceExhausted,
+    gapi_exceptions.ServiceUnavailable,
+    gapi_exceptions.DeadlineExceeded,
+    NoHealthyKeys,
+)
 MAX_TURNS = 30  # keep newest 30 user+model pairs
 ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",")]
+# off | check (log locally computed values) | overwrite (replace model estimates)
+NUTRITION_CHECK_MODE = os.getenv("NUTRITION_CHECK_MODE", "check").strip().lower()
+# off | check (validate and count) | repair (regenerate only the broken recipe/grocery list)
+FORMAT_CHECK_MODE = os.getenv("FORMAT_CHECK_MODE", "check").strip().lower()
+FORMAT_MAX_REPAIRS = int(os.getenv("FORMAT_MAX_REPAIRS", "3"))
+# off | flag (append a warning) | repair (regenerate the offending recipe, then flag what's left)
+ALLERGEN_SCREEN_MODE = os.getenv("ALLERGEN_SCREEN_MODE", "flag").strip().lower()
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+# Duplicates wait this long for the in-flight generation (longer than cli.py's 120 s timeout).
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "150"))
+
+# Claims and results live in shared_state, so a retry that lands on another worker still matches.
+chat_idempotency = IdempotencyStore(
+    ttl_seconds=IDEMPOTENCY_TTL_SECONDS, lease_seconds=IDEMPOTENCY_WAIT_SECONDS, state=shared_state
+)
+
+# off | shadow (classify and log agreement with the model) | on (answer confident routes locally)
+INTENT_ROUTER_MODE = os.getenv("INTENT_ROUTER_MODE", "shadow").strip().lower()
+INTENT_ROUTER_MIN_CONFIDENCE = float(os.getenv("INTENT_ROUTER_MIN_CONFIDENCE", "0.9"))
+LOCAL_ROUTER_MODEL = "local-router"
+router_stats = RouterStats()
+format_stats = FormatStats()
+allergen_stats = ScreenStats()
+
+# 0 disables the per-user daily token budget.
+USER_DAILY_TOKEN_BUDGET = int(os.getenv("USER_DAILY_TOKEN_BUDGET", "0"))
+# Oldest turns are dropped before the call once the history is estimated above this many tokens.
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "24000"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+usage_meter = UsageMeter(
+    lambda rows: write_usage_rows(rows),
+    shared_state,
+    flush_interval=USAGE_FLUSH_SECONDS,
+    reader=lambda user_id, day: stored_tokens_on(user_id, day),
+)
+
+# Replies that find no capacity on any model tier are queued and finished later (202 + job id).
+DEFERRED_REPLIES_ENABLED = os.getenv("DEFERRED_REPLIES_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+DEFERRED_MAX_JOBS = int(os.getenv("DEFERRED_MAX_JOBS", "200"))
+DEFERRED_MAX_AGE_SECONDS = float(os.getenv("DEFERRED_MAX_AGE_SECONDS", "900"))
+DEFERRED_WORKERS = int(os.getenv("DEFERRED_WORKERS", "4"))
+DEFERRED_HEARTBEAT_SECONDS = 15
+# Jobs live in the shared state, so any worker can answer a poll or run the job, and they survive restarts.
+deferred_replies = DeferredQueue(
+    lambda job: finish_deferred_reply(job),
+    max_jobs=DEFERRED_MAX_JOBS,
+    retry_delay=max(GEMINI_KEY_COOLDOWN_SECONDS, 1),
+    max_age=DEFERRED_MAX_AGE_SECONDS,
+    state=shared_state,
+    workers=DEFERRED_WORKERS,
+)
+
+# Opt-in profiling of chat requests: `X-Profile: <PROFILE_TOKEN>` or a sampled share of them
+# writes collapsed stacks into PROFILE_DIR, which keeps the newest PROFILE_MAX_FILES dumps.
+request_profiler = RequestProfiler(
+    os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, ".profiles")),
+    max_files=int(os.getenv("PROFILE_MAX_FILES", "50")),
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000,
+    token=os.getenv("PROFILE_TOKEN", ""),
+)
+
+# Optional write-behind for model replies: with MESSAGE_JOURNAL_DIR set, a reply is fsynced to a
+# local journal and returned at once, and the journal stores it in Supabase in the background.
+MESSAGE_JOURNAL_DIR = os.getenv("MESSAGE_JOURNAL_DIR", "").strip()
+MESSAGE_JOURNAL_FLUSH_SECONDS = float(os.getenv("MESSAGE_JOURNAL_FLUSH_SECONDS", "0.2"))
+message_journal = (
+    MessageJournal(
+        MESSAGE_JOURNAL_DIR,
+        lambda entries: write_journal_entries(entries),
+        flush_interval=MESSAGE_JOURNAL_FLUSH_SECONDS,
+        # Unflushed replies are visible to every worker's fetch_history and messages ETag.
+        state=shared_state,
+    )
+    if MESSAGE_JOURNAL_DIR
+    else None
+)
+
+# Chat WebSocket: concurrent turns and queued outgoing frames per connection; a client that
+# leaves the outbox full for WS_SEND_TIMEOUT_SECONDS is disconnected.
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "2"))
+WS_MAX_QUEUED_FRAMES = int(os.getenv("WS_MAX_QUEUED_FRAMES", "256"))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "30"))
+WS_AUTH_TIMEOUT_SECONDS = 10
+WS_MAX_MESSAGE_CHARS = 8000
+profile_events = Subscribers()
+_socket_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="ws-turn")
+
+SEARCH_INDEX_MAX_USERS = int(os.getenv("SEARCH_INDEX_MAX_USERS", "1000"))
+search_index = SearchIndex(max_users=SEARCH_INDEX_MAX_USERS)
+SEARCH_LOAD_PAGE_SIZE = 1000
+# Rows per storage read while streaming a data export.
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+
+# Gemini admission control: total in-flight calls scale with the key pool, each user is capped.
+GEMINI_CONCURRENCY_PER_KEY = int(os.getenv("GEMINI_CONCURRENCY_PER_KEY", "4"))
+GEMINI_PER_USER_INFLIGHT = int(os.getenv("GEMINI_PER_USER_INFLIGHT", "2"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "64"))
+GEMINI_MAX_QUEUE_PER_USER = int(os.getenv("GEMINI_MAX_QUEUE_PER_USER", "4"))
+GEMINI_QUEUE_TIMEOUT_SECONDS = float(os.getenv("GEMINI_QUEUE_TIMEOUT_SECONDS", "30"))
+
+gemini_scheduler = FairScheduler(
+    capacity=len(GEMINI_API_KEYS) * GEMINI_CONCURRENCY_PER_KEY,
+    per_user_limit=GEMINI_PER_USER_INFLIGHT,
+    max_queue=GEMINI_MAX_QUEUE,
+    max_queue_per_user=GEMINI_MAX_QUEUE_PER_USER,
+    queue_timeout=GEMINI_QUEUE_TIMEOUT_SECONDS,
+)
 
 
 class ChatIn(BaseModel):
@@ -90,25 +387,42 @@ class ChatOut(BaseModel):
 class ProfilePayload(BaseModel):
     fitness_goals: Optional[str] = None
     dietary_restrictions: Optional[str] = None
+    allergens: Optional[List[str]] = None
+    diets: Optional[List[str]] = None
+    calorie_target: Optional[int] = None
+    protein_target_g: Optional[int] = None
+    carbs_target_g: Optional[int] = None
+    fats_target_g: Optional[int] = None
 
 
 class ConversationCreate(BaseModel):
     title: Optional[str] = None
 
 
+class BootstrapOut(BaseModel):
+    profile: ProfilePayload
+    conversations: List[Dict[str, Any]]
+    active_conversation_id: Optional[str] = None
+    messages: List[Dict[str, Any]]
+
+
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def get_current_user(authorization: str = Header(...)) -> str:
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth header")
-    token = authorization.split(" ", 1)[1]
+def verify_token(token: str) -> Dict[str, Any]:
+    """Claims of a Supabase access token; 401 when it is invalid or expired."""
     try:
-        payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience="authenticated")
+        return jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience="authenticated")
     except jwt.PyJWTError as exc:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(exc)) from exc
-    return payload["sub"]
+
+
+def get_current_user(authorization: str = Header(...)) -> str:
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth header")
+    with request_profiler.follow():
+        return verify_token(authorization.split(" ", 1)[1])["sub"]
 
 
 def supabase_single(response) -> Optional[Dict[str, Any]]:
@@ -140,14 +454,24 @@ def update_profile(user_id: str, updates: Dict[str, str]) -> Dict[str, Any]:
     return updated or ensure_profile(user_id)
 
 
-def list_conversations(user_id: str) -> List[Dict[str, Any]]:
-    response = (
+def save_profile_updates(user_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+    """Store profile changes and push them to the user's open chat sockets."""
+    profile = update_profile(user_id, updates)
+    with suppress(Exception):
+        profile_events.publish(user_id, {"type": "profile", "changed": sorted(updates), "profile": profile})
+    return profile
+
+
+def list_conversations(user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    query = (
         supabase.table("conversations")
         .select("id,title,created_at,updated_at,last_message_preview")
         .eq("user_id", user_id)
         .order("updated_at", desc=True)
-        .execute()
     )
+    if limit:
+        query = query.limit(limit)
+    response = query.execute()
     if getattr(response, "error", None):
         raise HTTPException(status_code=500, detail=str(response.error))
     return response.data or []
@@ -183,31 +507,39 @@ def delete_conversation(user_id: str, conversation_id: str) -> None:
     response = supabase.table("messages").delete().eq("conversation_id", conversation_id).execute()
     if getattr(response, "error", None):
         raise HTTPException(status_code=500, detail=str(response.error))
+    supabase.table(ARCHIVE_TABLE).delete().eq("conversation_id", conversation_id).execute()
     supabase.table("conversations").delete().eq("id", conversation_id).execute()
+    search_index.remove_conversation(user_id, conversation_id)
+    publish_invalidation("search_remove", f"{user_id}:{conversation_id}")
+    if message_journal is not None:
+        message_journal.discard(conversation_id)
 
 
-def fetch_history(conversation_id: str) -> List[Dict[str, Any]]:
+def fetch_history_rows(conversation_id: str) -> List[Dict[str, Any]]:
+    """The newest MAX_TURNS * 2 message rows, newest first."""
     response = (
         supabase.table("messages")
-        .select("role,content")
+        .select("id,role,content,created_at")
         .eq("conversation_id", conversation_id)
         .order("created_at", desc=True)
+        .order("id", desc=True)
         .limit(MAX_TURNS * 2)
         .execute()
     )
     if getattr(response, "error", None):
         raise HTTPException(status_code=500, detail=str(response.error))
-    history = []
-    rows = list((response.data or []))[::-1]
-    for row in rows:
-        role = row.get("role")
-        if role not in ("user", "model"):
-            continue
-        history.append({"role": role, "parts": [row.get("content", "")]})
-    return history
+    rows = response.data or []
+    if message_journal is not None:
+        # Replies not flushed yet (by any worker) are part of the conversation already.
+        rows = merge_pending(rows, message_journal.pending(conversation_id), MAX_TURNS * 2)
+    return rows
 
 
-def insert_message(conversation_id: str, role: str, content: str, user_id: Optional[str]) -> None:
+def fetch_history(conversation_id: str) -> List[Dict[str, Any]]:
+    return rows_to_history(fetch_history_rows(conversation_id))
+
+
+def insert_message(conversation_id: str, role: str, content: str, user_id: Optional[str]) -> str:
     payload = {
         "id": str(uuid.uuid4()),
         "conversation_id": conversation_id,
@@ -220,6 +552,236 @@ def insert_message(conversation_id: str, role: str, content: str, user_id: Optio
     response = supabase.table("messages").insert(payload).execute()
     if getattr(response, "error", None):
         raise HTTPException(status_code=500, detail=str(response.error))
+    return payload["id"]
+
+
+def delete_message(message_id: str) -> None:
+    response = supabase.table("messages").delete().eq("id", message_id).execute()
+    if getattr(response, "error", None):
+        raise HTTPException(status_code=500, detail=str(response.error))
+
+
+def record_message(user_id: str, conversation_id: str, role: str, content: str) -> str:
+    """Store a chat message and add it to the owner's search partition; returns its id."""
+    message_id = insert_message(conversation_id, role, content, user_id if role == "user" else None)
+    search_index.add_message(user_id, conversation_id, message_id, role, content, now_iso())
+    # Other workers append it to their copy of the partition instead of dropping it.
+    publish_invalidation("search_append", f"{user_id}:{message_id}")
+    return message_id
+
+
+def unrecord_message(user_id: str, message_id: str) -> None:
+    """Undo `record_message`: delete the row, and have every worker rebuild the owner's search partition."""
+    delete_message(message_id)
+    search_index.drop_user(user_id)
+    publish_invalidation("search", user_id)
+
+
+def journal_reply(user_id: str, conversation_id: str, reply: str) -> None:
+    """`record_message` and `touch_conversation` for a model reply, through `message_journal`."""
+    created_at = now_iso()
+    message = {
+        "op": MESSAGE,
+        "id": str(uuid.uuid4()),
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "role": "model",
+        "content": reply,
+        "created_at": created_at,
+    }
+    touch = {"op": TOUCH, "id": str(uuid.uuid4()), "conversation_id": conversation_id, "preview": reply[:140], "updated_at": created_at}
+    message_journal.append(message, touch)
+    search_index.add_message(user_id, conversation_id, message["id"], "model", reply, created_at)
+
+
+def _upsert_messages(rows: List[Dict[str, Any]]) -> None:
+    # Upserted by id: a batch replayed after a crash is written once.
+    response = supabase.table("messages").upsert(rows, on_conflict="id").execute()
+    if getattr(response, "error", None):
+        raise RuntimeError(str(response.error))
+
+
+def _conversation_exists(conversation_id: str) -> bool:
+    response = supabase.table("conversations").select("id").eq("id", conversation_id).limit(1).execute()
+    return supabase_single(response) is not None
+
+
+def write_journal_entries(entries: List[Dict[str, Any]]) -> None:
+    """Writer of `message_journal`: store the messages, then apply the newest touch of each conversation."""
+    messages = [entry for entry in entries if entry["op"] == MESSAGE]
+    rows = {
+        entry["id"]: {
+            "id": entry["id"],
+            "conversation_id": entry["conversation_id"],
+            "role": entry["role"],
+            "content": entry["content"],
+            "created_at": entry["created_at"],
+            **({"user_id": entry["user_id"]} if entry["role"] == "user" else {}),
+        }
+        for entry in messages
+    }
+    if rows:
+        try:
+            _upsert_messages(list(rows.values()))
+        except Exception:
+            # A reply to a conversation deleted since fails its foreign key; drop only those.
+            for message_id, row in list(rows.items()):
+                try:
+                    _upsert_messages([row])
+                except Exception:
+                    if _conversation_exists(row["conversation_id"]):
+                        raise
+                    print("Dropping journaled reply to a deleted conversation:", row["conversation_id"])
+                    del rows[message_id]
+
+    touches: Dict[str, Dict[str, Any]] = {}
+    for entry in entries:
+        if entry["op"] == TOUCH and entry["updated_at"] >= touches.get(entry["conversation_id"], entry)["updated_at"]:
+            touches[entry["conversation_id"]] = entry
+    for conversation_id, entry in touches.items():
+        # A replayed or late touch never rolls back a newer one stored since.
+        response = (
+            supabase.table("conversations")
+            .update({"last_message_preview": entry["preview"], "updated_at": entry["updated_at"]})
+            .eq("id", conversation_id)
+            .lt("updated_at", entry["updated_at"])
+            .execute()
+        )
+        if getattr(response, "error", None):
+            raise RuntimeError(str(response.error))
+
+    for entry in messages:
+        if entry["id"] in rows:
+            publish_invalidation("search_append", f"{entry['user_id']}:{entry['id']}")
+
+
+def write_usage_rows(rows: List[Dict[str, Any]]) -> None:
+    response = supabase.table(USAGE_TABLE).insert(rows).execute()
+    if getattr(response, "error", None):
+        raise RuntimeError(str(response.error))
+
+
+def fetch_usage_rows(user_id: str, since_day: str) -> List[Dict[str, Any]]:
+    response = (
+        supabase.table(USAGE_TABLE)
+        .select("day,conversation_id,kind,prompt_tokens,output_tokens,calls")
+        .eq("user_id", user_id)
+        .gte("day", since_day)
+        .execute()
+    )
+    if getattr(response, "error", None):
+        raise HTTPException(status_code=500, detail=str(response.error))
+    return response.data or []
+
+
+def stored_tokens_on(user_id: str, day: str) -> int:
+    return sum(
+        (row.get("prompt_tokens") or 0) + (row.get("output_tokens") or 0)
+        for row in fetch_usage_rows(user_id, day)
+        if row.get("day") == day
+    )
+
+
+def check_token_budget(user_id: str) -> None:
+    """Refuse a generation once the user has spent today's token budget."""
+    if USER_DAILY_TOKEN_BUDGET <= 0:
+        return
+    try:
+        used = usage_meter.used_today(user_id)
+    except Exception as exc:
+        print("Token budget check skipped:", exc)
+        return
+    if used >= USER_DAILY_TOKEN_BUDGET:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Daily token budget reached. Please try again tomorrow.",
+            headers={"Retry-After": str(seconds_until_utc_midnight())},
+        )
+
+
+def publish_invalidation(topic: str, key: str) -> None:
+    """Tell other workers about a change to something they may have cached."""
+    try:
+        shared_state.publish(WORKER_ID, topic, key)
+    except Exception as exc:
+        print("Could not publish invalidation:", exc)
+
+
+def apply_invalidations() -> None:
+    """Apply changes other workers have published since the last check to the search partitions held here."""
+    try:
+        events = invalidations.poll()
+    except Exception as exc:
+        print("Could not read invalidations:", exc)
+        return
+    appended: Dict[str, List[str]] = {}
+    for event in events:
+        if event.topic == FLUSH_ALL:
+            search_index.clear()
+            appended.clear()
+        elif event.topic == "search":
+            search_index.drop_user(event.key)
+            appended.pop(event.key, None)
+        elif event.topic == "search_append":
+            user_id, _, message_id = event.key.partition(":")
+            # Partitions this worker doesn't hold read the message from storage when they are built.
+            if user_id in search_index:
+                appended.setdefault(user_id, []).append(message_id)
+        elif event.topic == "search_remove":
+            user_id, _, conversation_id = event.key.partition(":")
+            search_index.remove_conversation(user_id, conversation_id)
+    for user_id, message_ids in appended.items():
+        try:
+            for row in fetch_messages_by_id(message_ids):
+                search_index.add_message(
+                    user_id, row["conversation_id"], row["id"], row.get("role", ""), row.get("content") or "", row.get("created_at")
+                )
+        except Exception as exc:
+            print("Could not apply search appends:", exc)
+            search_index.drop_user(user_id)
+
+
+def fetch_messages_by_id(message_ids: List[str]) -> List[Dict[str, Any]]:
+    rows: List[Dict[str, Any]] = []
+    for start in range(0, len(message_ids), 50):
+        response = (
+            supabase.table("messages")
+            .select("id,conversation_id,role,content,created_at")
+            .in_("id", message_ids[start:start + 50])
+            .execute()
+        )
+        if getattr(response, "error", None):
+            raise RuntimeError(str(response.error))
+        rows.extend(response.data or [])
+    return rows
+
+
+def load_search_rows(user_id: str):
+    """Yield every stored message of a user (hot rows and archives) to build their search partition."""
+    conversation_ids = [conversation["id"] for conversation in list_conversations(user_id)]
+    for start in range(0, len(conversation_ids), 50):
+        chunk = conversation_ids[start:start + 50]
+        offset = 0
+        while True:
+            response = (
+                supabase.table("messages")
+                .select("id,conversation_id,role,content,created_at")
+                .in_("conversation_id", chunk)
+                .order("created_at")
+                .range(offset, offset + SEARCH_LOAD_PAGE_SIZE - 1)
+                .execute()
+            )
+            if getattr(response, "error", None):
+                raise HTTPException(status_code=500, detail=str(response.error))
+            rows = response.data or []
+            yield from rows
+            if len(rows) < SEARCH_LOAD_PAGE_SIZE:
+                break
+            offset += SEARCH_LOAD_PAGE_SIZE
+    for conversation_id in conversation_ids:
+        for archive in iter_archives(supabase, conversation_id):
+            for row in load_archive(supabase, archive["id"]):
+                yield {**row, "conversation_id": conversation_id}
 
 
 def touch_conversation(conversation_id: str, preview: str) -> None:
@@ -239,24 +801,39 @@ def generate_chat_with_rotation(
 ):
     """
     Generate a chat response, load-balancing across keys and failing
-    over to other keys on quota/auth errors.
+    over to other keys on quota/auth errors. Keys whose circuit breaker
+    is open are skipped.
     """
+    if GEMINI_HEDGE_ENABLED:
+        return generate_chat_hedged(profile, history)
+
     last_exc = None
     n_keys = len(GEMINI_API_KEYS)
     attempts = 0
 
     while attempts < n_keys:
         attempts += 1
-
-        # Configure client with the *current* key
-        _configure_genai()
+        key_index = _current_key_index
+        breaker = _key_breaker(key_index)
+        if not _key_usable(key_index):
+            _rotate_key()
+            continue
+        _record_key_use(key_index)
 
         try:
-            chat_model = conversation_model(profile)
+            # Configure client with the *current* key
+            with _genai_config_lock:
+                _configure_key(key_index)
+                chat_model = conversation_model(profile)
+                _pin_client(chat_model)
+            started = time.monotonic()
             response = chat_model.generate_content(
                 history,
                 generation_config=HTML_GENERATION_CONFIG,
             )
+            generation_latency.record(time.monotonic() - started)
+            breaker.record_success()
+            _record_usage(response, key_index, "chat")
             # On success, advance so the NEXT request uses the next key
             _rotate_key()
             return response
@@ -264,18 +841,250 @@ def generate_chat_with_rotation(
         except (gapi_exceptions.ResourceExhausted, gapi_exceptions.PermissionDenied) as exc:
             # quota/auth error → move to the next key and retry
             last_exc = exc
+            breaker.record_failure()
+            if isinstance(exc, gapi_exceptions.ResourceExhausted):
+                _cool_down_key(key_index)
             _rotate_key()
             continue
 
         except Exception as exc:
             # Non-retryable error: bail out
             last_exc = exc
+            if isinstance(exc, KEY_FAILURE_ERRORS):
+                breaker.record_failure()
             break
 
+        finally:
+            # Errors that say nothing about the key must not leave a half-open probe claimed.
+            breaker.release()
+
     # All keys failed
+    raise last_exc or NoHealthyKeys("Gemini generation failed: no healthy API keys")
+
+
+def stream_chat_with_rotation(profile: Dict[str, Any], history) -> Iterator[str]:
+    """
+    Stream a chat response as text chunks. Keys fail over as in
+    `generate_chat_with_rotation`, but only until the first chunk has been
+    yielded; an error after that is raised to the caller.
+    """
+    last_exc = None
+    n_keys = len(GEMINI_API_KEYS)
+    attempts = 0
+
+    while attempts < n_keys:
+        attempts += 1
+        key_index = _current_key_index
+        breaker = _key_breaker(key_index)
+        if not _key_usable(key_index):
+            _rotate_key()
+            continue
+        _record_key_use(key_index)
+
+        yielded = False
+        try:
+            with _genai_config_lock:
+                _configure_key(key_index)
+                chat_model = conversation_model(profile)
+                _pin_client(chat_model)
+            started = time.monotonic()
+            response = chat_model.generate_content(
+                history,
+                generation_config=HTML_GENERATION_CONFIG,
+                stream=True,
+            )
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without text parts (e.g. the final finish-reason chunk).
+                    continue
+                if text:
+                    yielded = True
+                    yield text
+            generation_latency.record(time.monotonic() - started)
+            breaker.record_success()
+            # usage_metadata is filled in once the whole stream has been read.
+            _record_usage(response, key_index, "chat")
+            _rotate_key()
+            return
+
+        except (gapi_exceptions.ResourceExhausted, gapi_exceptions.PermissionDenied) as exc:
+            last_exc = exc
+            breaker.record_failure()
+            if isinstance(exc, gapi_exceptions.ResourceExhausted):
+                _cool_down_key(key_index)
+            _rotate_key()
+            if yielded:
+                raise
+            continue
+
+        except Exception as exc:
+            last_exc = exc
+            if isinstance(exc, KEY_FAILURE_ERRORS):
+                breaker.record_failure()
+            break
+
+        finally:
+            # Also runs when the consumer closes the generator mid-stream (GeneratorExit).
+            breaker.release()
+
+    raise last_exc or NoHealthyKeys("Gemini generation failed: no healthy API keys")
+
+
+def _next_healthy_key(exclude) -> Optional[int]:
+    """Claim the next key (round-robin from the shared cursor) whose breaker allows a call."""
+    n_keys = len(GEMINI_API_KEYS)
+    start = _current_key_index
+    _rotate_key()
+    for offset in range(n_keys):
+        key_index = (start + offset) % n_keys
+        if key_index in exclude:
+            continue
+        if _key_usable(key_index):
+            _record_key_use(key_index)
+            return key_index
+    return None
+
+
+def _generate_on_key(key_index: int, profile: Dict[str, Any], history):
+    breaker = _key_breaker(key_index)
+    try:
+        with _genai_config_lock:
+            _configure_key(key_index)
+            chat_model = conversation_model(profile)
+            _pin_client(chat_model)
+        started = time.monotonic()
+        response = chat_model.generate_content(history, generation_config=HTML_GENERATION_CONFIG)
+    except KEY_FAILURE_ERRORS as exc:
+        breaker.record_failure()
+        if isinstance(exc, gapi_exceptions.ResourceExhausted):
+            _cool_down_key(key_index)
+        raise
+    finally:
+        breaker.release()
+    generation_latency.record(time.monotonic() - started)
+    breaker.record_success()
+    return response
+
+
+def _record_hedge_loser(future, key_index: int, context: contextvars.Context) -> None:
+    """A running attempt can't be cancelled; once it finishes, bill its tokens to the same user."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    context.run(_record_usage, future.result(), key_index, "chat")
+
+
+def hedge_delay() -> float:
+    observed = generation_latency.percentile(GEMINI_HEDGE_PERCENTILE)
+    delay = GEMINI_HEDGE_DEFAULT_DELAY if observed is None else observed
+    return max(delay, GEMINI_HEDGE_MIN_DELAY)
+
+
+def generate_chat_hedged(profile: Dict[str, Any], history):
+    """
+    Hedged generation: start on one healthy key; if it hasn't answered by the
+    hedge deadline (or fails with a key error), start another attempt on a
+    different healthy key and return whichever succeeds first. At most two
+    attempts run at once; the loser's reply is discarded, but its tokens are
+    still recorded once it finishes.
+    """
+    tried = set()
+    pending = {}
+    last_exc = None
+
+    def launch() -> bool:
+        key_index = _next_healthy_key(tried)
+        if key_index is None:
+            return False
+        tried.add(key_index)
+        # Copy the context so the attempt uses the caller's model tier and usage scope.
+        context = contextvars.copy_context()
+        future = _hedge_executor.submit(context.run, _generate_on_key, key_index, profile, history)
+        pending[future] = (key_index, context)
+        return True
+
+    if not launch():
+        raise NoHealthyKeys("Gemini generation failed: no healthy API keys")
+    deadline = time.monotonic() + hedge_delay()
+    hedged = False
+
+    while pending:
+        timeout = None if hedged else max(deadline - time.monotonic(), 0)
+        done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+        if not done:
+            # Primary is slower than the deadline: race a second key.
+            hedged = True
+            launch()
+            continue
+
+        for future in done:
+            key_index, _ = pending.pop(future)
+            try:
+                response = future.result()
+            except Exception as exc:
+                last_exc = exc
+                if not isinstance(exc, (gapi_exceptions.ResourceExhausted, gapi_exceptions.PermissionDenied)):
+                    continue
+                # Quota/auth error: keep the failover behaviour and try another key.
+                if len(pending) < 2:
+                    launch()
+                continue
+            for other, (other_key, other_context) in pending.items():
+                if other.cancel():
+                    continue
+                # Still running past the deadline and beaten by the hedge: count it as slow,
+                # and record the tokens it spends when it does finish.
+                _key_breaker(other_key).record_failure()
+                other.add_done_callback(
+                    lambda finished, key=other_key, ctx=other_context: _record_hedge_loser(finished, key, ctx)
+                )
+            _record_usage(response, key_index, "chat")
+            return response
+
     raise last_exc or RuntimeError("Gemini generation failed with unknown error")
 
 
+def generate_reply(
+    profile: Dict[str, Any],
+    history,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, str]:
+    """
+    Generate a reply on MODEL and, when it has no capacity left, on
+    FALLBACK_MODEL_NAME. Returns (reply, model name). A stream that has
+    already sent text is not restarted on another tier.
+    """
+    formats = detect_formats(history) if PROMPT_SECTIONS_MODE == "on" else None
+    if formats is not None:
+        prompt_stats.record(formats)
+    last_exc = None
+    for model_name in model_chain():
+        chunks: List[str] = []
+        with model_tier(model_name), prompt_formats(formats):
+            try:
+                if on_delta is None:
+                    response = generate_chat_with_rotation(profile, history)
+                    return response.text or "(no response)", model_name
+                for text in stream_chat_with_rotation(profile, history):
+                    chunks.append(text)
+                    on_delta(text)
+                return "".join(chunks) or "(no response)", model_name
+            except CAPACITY_ERRORS as exc:
+                if chunks:
+                    raise
+                last_exc = exc
+                print(f"No capacity on {model_name}:", exc)
+    raise last_exc
+
+
+def regenerate_section(profile: Dict[str, Any], prompt: str) -> str:
+    """Regenerate one malformed block of a reply (no conversation history needed)."""
+    response = generate_chat_with_rotation(profile, [{"role": "user", "parts": [prompt]}])
+    return response.text or ""
+
+
 def detect_profile_updates_with_rotation(message: str, profile: Dict[str, Any]) -> Dict[str, str]:
     """
     Detect profile updates using Gemini, load-balancing across keys and
@@ -288,11 +1097,18 @@ def detect_profile_updates_with_rotation(message: str, profile: Dict[str, Any])
 
     while attempts < n_keys:
         attempts += 1
-
-        _configure_genai()
+        key_index = _current_key_index
+        breaker = _key_breaker(key_index)
+        if not _key_usable(key_index):
+            _rotate_key()
+            continue
+        _record_key_use(key_index)
 
         try:
-            model = profile_model()
+            with _genai_config_lock:
+                _configure_key(key_index)
+                model = profile_model()
+                _pin_client(model)
             response = model.generate_content(
                 [{"role": "user", "parts": [prompt]}],
                 generation_config=genai_types.GenerationConfig(
@@ -304,29 +1120,41 @@ def detect_profile_updates_with_rotation(message: str, profile: Dict[str, Any])
             updates = diff_profile(profile, parsed)
 
             # success → advance pointer for next request
+            breaker.record_success()
+            _record_usage(response, key_index, "profile")
             _rotate_key()
             return updates
 
         except (gapi_exceptions.ResourceExhausted, gapi_exceptions.PermissionDenied) as exc:
             last_exc = exc
+            breaker.record_failure()
+            if isinstance(exc, gapi_exceptions.ResourceExhausted):
+                _cool_down_key(key_index)
             _rotate_key()
             continue
 
         except Exception as exc:
             last_exc = exc
+            if isinstance(exc, KEY_FAILURE_ERRORS):
+                breaker.record_failure()
             break
 
+        finally:
+            breaker.release()
+
     with suppress(Exception):
         print("Profile update detection failed for all keys:", last_exc)
     return {}
 
 
 def conversation_model(profile: Dict[str, Any]) -> genai.GenerativeModel:
-    system_instruction = f"{SYSTEM_PROMPT}\n\n{format_profile_context(profile)}"
-    return genai.GenerativeModel(MODEL, system_instruction=system_instruction)
+    formats = _prompt_formats.get()
+    system_prompt = SYSTEM_PROMPT if formats is None else build_system_prompt(formats)
+    system_instruction = f"{system_prompt}\n\n{format_profile_context(profile)}"
+    return genai.GenerativeModel(active_model(), system_instruction=system_instruction)
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"] if ALLOWED_ORIGINS == ["*"] else ALLOWED_ORIGINS,
@@ -334,29 +1162,144 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Wraps the whole request, so a profile covers body parsing and auth as well as the turn.
+app.add_middleware(
+    ProfilingMiddleware,
+    profiler=lambda: request_profiler,
+    labels={"/api/chat": "chat", "/api/chat/stream": "chat_stream"},
+)
+
+
+def _key_usage() -> Optional[Dict[str, Dict[int, int]]]:
+    try:
+        return {
+            "calls_this_minute": shared_state.key_usage(len(GEMINI_API_KEYS)),
+            "tokens_today": usage_meter.key_tokens_today(len(GEMINI_API_KEYS)),
+        }
+    except Exception:
+        return None
+
+
+@app.on_event("startup")
+def resume_deferred_replies():
+    if DEFERRED_REPLIES_ENABLED:
+        deferred_replies.start()
+
+
+@app.on_event("startup")
+def start_message_journal():
+    # Replies journaled before a restart are flushed without waiting for a new one.
+    if message_journal is not None:
+        message_journal.start()
+
+
+@app.on_event("shutdown")
+def flush_usage():
+    with suppress(Exception):
+        usage_meter.flush()
+
+
+@app.on_event("shutdown")
+def close_message_journal():
+    if message_journal is not None:
+        message_journal.close()
 
 
 @app.get("/api/health")
 def health():
-    return {"ok": True, "model": MODEL}
+    return {
+        "ok": True,
+        "model": MODEL,
+        "intent_router": {"mode": INTENT_ROUTER_MODE, **router_stats.snapshot()},
+        "fallback_model": FALLBACK_MODEL_NAME or None,
+        "deferred_replies": {"enabled": DEFERRED_REPLIES_ENABLED, **deferred_replies.snapshot()},
+        "format_check": {"mode": FORMAT_CHECK_MODE, **format_stats.snapshot()},
+        "allergen_screen": {"mode": ALLERGEN_SCREEN_MODE, **allergen_stats.snapshot()},
+        "prompt_sections": {"mode": PROMPT_SECTIONS_MODE, **prompt_stats.snapshot()},
+        "key_usage": _key_usage(),
+    }
 
 
 @app.get("/api/profile", response_model=ProfilePayload)
-def get_profile(user_id: str = Depends(get_current_user)):
-    return ensure_profile(user_id)
+def get_profile(request: Request, response: Response, user_id: str = Depends(get_current_user)):
+    profile = ensure_profile(user_id)
+    if profile.get("updated_at"):
+        etag = make_etag("profile", user_id, profile["updated_at"])
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+        set_cache_headers(response, etag)
+    return profile
 
 
 @app.put("/api/profile", response_model=ProfilePayload)
 def put_profile(payload: ProfilePayload, user_id: str = Depends(get_current_user)):
     updates = {k: v for k, v in payload.dict().items() if v is not None}
+    for field in STRUCTURED_FIELDS:
+        if field in updates:
+            updates[field] = normalize_field(field, updates[field])
     if not updates:
         return ensure_profile(user_id)
-    return update_profile(user_id, updates)
+    return save_profile_updates(user_id, updates)
 
 
 @app.get("/api/conversations")
-def get_conversations(user_id: str = Depends(get_current_user)):
-    return list_conversations(user_id)
+def get_conversations(request: Request, response: Response, user_id: str = Depends(get_current_user)):
+    conversations = list_conversations(user_id)
+    etag = make_etag("conversations", user_id, *(f"{c.get('id')}@{c.get('updated_at')}" for c in conversations))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag)
+    set_cache_headers(response, etag)
+    return conversations
+
+
+@app.get("/api/search")
+def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    user_id: str = Depends(get_current_user),
+):
+    apply_invalidations()
+    return search_index.search(user_id, q, load_search_rows, limit)
+
+
+@app.get("/api/usage")
+def get_usage(days: int = Query(7, ge=1, le=90), user_id: str = Depends(get_current_user)):
+    since = days_back(days)
+    # Rows not flushed yet are added on top of what's stored.
+    rows = fetch_usage_rows(user_id, since) + [row for row in usage_meter.pending_rows(user_id) if row["day"] >= since]
+    used_today = usage_meter.used_today(user_id)
+    budget = USER_DAILY_TOKEN_BUDGET or None
+    return {
+        "since": since,
+        "used_today": used_today,
+        "daily_budget": budget,
+        "remaining_today": max(budget - used_today, 0) if budget else None,
+        **summarize(rows),
+    }
+
+
+def _export_until_error(records):
+    """Headers are long gone when a later page fails, so the failure becomes the last line (and there's no `end` line)."""
+    try:
+        yield from records
+    except Exception as exc:
+        print("Export failed:", exc)
+        yield {"type": "error", "detail": str(exc)}
+
+
+@app.get("/api/export")
+def export_data(compressed: bool = Query(False, alias="gzip"), user_id: str = Depends(get_current_user)):
+    """Every conversation and message of the user as NDJSON, streamed while it is read."""
+    profile = ensure_profile(user_id)
+    # Replies still in the write-behind journal belong in the export too.
+    pending = message_journal.pending if message_journal is not None else None
+    chunks = encode_lines(_export_until_error(export_records(supabase, user_id, profile, EXPORT_PAGE_SIZE, pending)))
+    filename = f"easydiet-export-{datetime.now(timezone.utc):%Y%m%d}.ndjson"
+    media_type = "application/x-ndjson"
+    if compressed:
+        chunks, filename, media_type = gzip_chunks(chunks), filename + ".gz", "application/gzip"
+    headers = {"Cache-Control": "no-store", "Content-Disposition": f'attachment; filename="{filename}"'}
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
 
 
 @app.post("/api/conversations")
@@ -372,13 +1315,98 @@ def remove_conversation(conversation_id: str, user_id: str = Depends(get_current
 
 
 @app.get("/api/conversations/{conversation_id}/messages")
-def get_conversation_messages(conversation_id: str, user_id: str = Depends(get_current_user)):
-    ensure_conversation_owner(user_id, conversation_id)
-    return fetch_history(conversation_id)
+def get_conversation_messages(
+    conversation_id: str,
+    request: Request,
+    before: Optional[str] = None,
+    limit: int = Query(MAX_TURNS * 2, ge=1, le=500),
+    user_id: str = Depends(get_current_user),
+):
+    conversation = ensure_conversation_owner(user_id, conversation_id)
+    headers = {}
+    # touch_conversation bumps updated_at on every message, so it versions the history
+    # and lets us answer 304 before reading any message bodies.
+    if conversation.get("updated_at"):
+        # Unflushed journal entries haven't bumped updated_at yet, so they version the history too.
+        pending = [entry["id"] for entry in message_journal.pending(conversation_id)] if message_journal is not None else []
+        etag = make_etag("messages", conversation_id, conversation["updated_at"], before, limit, *pending)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+        headers = cache_headers(etag)
+
+    if before is None:
+        rows = fetch_history_rows(conversation_id)
+        # A full page may have older messages; its oldest row is where `?before=` paging starts.
+        if len(rows) >= MAX_TURNS * 2:
+            headers["X-Next-Before"] = make_cursor(rows[-1])
+        rows.reverse()
+    else:
+        # Paging back through history: hot rows first, then archived blobs on demand.
+        try:
+            rows, next_before = read_page(supabase, conversation_id, before, limit)
+        except RuntimeError as exc:
+            raise HTTPException(status_code=500, detail=str(exc)) from exc
+        if next_before:
+            headers["X-Next-Before"] = next_before
+    page = [
+        {"role": row["role"], "parts": [row.get("content", "")], "created_at": row["created_at"]}
+        for row in rows
+        if row.get("role") in ("user", "model")
+    ]
+    return json_response(request, page, headers=headers)
+
+
+@app.get("/api/bootstrap", response_model=BootstrapOut)
+async def bootstrap(
+    conversation_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    user_id: str = Depends(get_current_user),
+):
+    """
+    Everything the chat page needs on first paint: profile, the first page of
+    conversations and the active conversation's messages. Profile, list and
+    ownership check run concurrently; messages are read once ownership is known.
+    """
+    profile_task = asyncio.to_thread(ensure_profile, user_id)
+    conversations_task = asyncio.to_thread(list_conversations, user_id, limit)
+
+    if conversation_id:
+        owner_task = asyncio.to_thread(ensure_conversation_owner, user_id, conversation_id)
+        profile, conversations, owner = await asyncio.gather(
+            profile_task, conversations_task, owner_task, return_exceptions=True
+        )
+        for result in (profile, conversations):
+            if isinstance(result, BaseException):
+                raise result
+        if isinstance(owner, HTTPException) and owner.status_code == 404:
+            conversation_id = None
+        elif isinstance(owner, BaseException):
+            raise owner
+    else:
+        profile, conversations = await asyncio.gather(profile_task, conversations_task)
+        conversation_id = conversations[0]["id"] if conversations else None
 
+    # Only read the history once the conversation is known to be the user's.
+    history = await asyncio.to_thread(fetch_history, conversation_id) if conversation_id else []
 
-@app.post("/api/chat", response_model=ChatOut)
-def chat(body: ChatIn, user_id: str = Depends(get_current_user)):
+    return {
+        "profile": profile,
+        "conversations": conversations,
+        "active_conversation_id": conversation_id,
+        "messages": history,
+    }
+
+
+def run_chat_turn(
+    user_id: str,
+    body: ChatIn,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Run one chat turn and return the `ChatOut` payload. With `on_delta`, the
+    reply is generated as a stream and each text chunk is passed to it as it
+    arrives; the returned reply is the final (reconciled) text.
+    """
     if body.conversation_id:
         ensure_conversation_owner(user_id, body.conversation_id)
         conversation_id = body.conversation_id
@@ -386,23 +1414,469 @@ def chat(body: ChatIn, user_id: str = Depends(get_current_user)):
         conversation = create_conversation(user_id)
         conversation_id = conversation["id"]
 
-    insert_message(conversation_id, "user", body.message, user_id)
-    touch_conversation(conversation_id, body.message)
+    with usage_scope(user_id, conversation_id):
+        return _complete_chat_turn(user_id, conversation_id, body, on_delta)
+
+
+def _complete_chat_turn(
+    user_id: str,
+    conversation_id: str,
+    body: ChatIn,
+    on_delta: Optional[Callable[[str], None]],
+) -> Dict[str, Any]:
+    decision = classify_message(body.message) if INTENT_ROUTER_MODE in ("shadow", "on") else None
+    if (
+        INTENT_ROUTER_MODE == "on"
+        and decision.reply is not None
+        and decision.confidence >= INTENT_ROUTER_MIN_CONFIDENCE
+    ):
+        # Off-topic messages and thank-yous get their fixed reply without a generation.
+        record_message(user_id, conversation_id, "user", body.message)
+        record_message(user_id, conversation_id, "model", decision.reply)
+        touch_conversation(conversation_id, decision.reply)
+        if on_delta is not None:
+            on_delta(decision.reply)
+        return ChatOut(reply=decision.reply, conversation_id=conversation_id, model=LOCAL_ROUTER_MODEL).dict()
+
+    check_token_budget(user_id)
+
+    # Take the generation slot before writing anything, so a 429 leaves no orphan user message.
+    try:
+        ticket = gemini_scheduler.acquire(user_id, INTERACTIVE)
+    except SchedulerOverloaded as exc:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(exc),
+            headers={"Retry-After": str(exc.retry_after)},
+        ) from exc
 
-    history = fetch_history(conversation_id)
-    profile = ensure_profile(user_id)
+    try:
+        message_id = record_message(user_id, conversation_id, "user", body.message)
+        touch_conversation(conversation_id, body.message)
+
+        history = trim_history(fetch_history(conversation_id), HISTORY_MAX_TOKENS)
+        profile = ensure_profile(user_id)
+
+        streamed = False
+        # Raw chunks could name an allergen the screen would repair or flag, so with a
+        # restricted profile the client gets the screened reply as a single delta instead.
+        withhold = ALLERGEN_SCREEN_MODE != "off" and screener_for_profile(profile) is not None
+
+        def forward(text: str) -> None:
+            nonlocal streamed
+            streamed = True
+            on_delta(text)
+
+        try:
+            reply, model_name = generate_reply(
+                profile, history, forward if on_delta is not None and not withhold else None
+            )
+        except CAPACITY_ERRORS as exc:
+            if DEFERRED_REPLIES_ENABLED and not streamed:
+                return defer_reply(user_id, conversation_id, body.message, history, message_id)
+            raise HTTPException(status_code=500, detail=f"Gemini error: {exc}") from exc
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Gemini error: {exc}") from exc
+
+        reply = polish_reply(profile, reply, model_name)
+        if on_delta is not None and withhold:
+            on_delta(reply)
+    finally:
+        gemini_scheduler.release(ticket)
+
+    return store_reply(user_id, conversation_id, body.message, profile, reply, model_name, decision)
+
+
+def polish_reply(profile: Dict[str, Any], reply: str, model_name: str) -> str:
+    """Format repair and allergen screening; repairs are generated on the same model tier as the reply."""
+    with model_tier(model_name):
+        try:
+            reply = check_reply(
+                reply,
+                FORMAT_CHECK_MODE,
+                regenerate=lambda prompt: regenerate_section(profile, prompt),
+                stats=format_stats,
+                max_repairs=FORMAT_MAX_REPAIRS,
+            )
+        except Exception as exc:
+            print("Format check failed:", exc)
+
+        try:
+            reply = screen_reply(
+                reply,
+                profile,
+                ALLERGEN_SCREEN_MODE,
+                regenerate=lambda prompt: regenerate_section(profile, prompt),
+                stats=allergen_stats,
+            )
+        except Exception as exc:
+            print("Allergen screen failed:", exc)
+    return reply
+
+
+def store_reply(
+    user_id: str,
+    conversation_id: str,
+    message: str,
+    profile: Dict[str, Any],
+    reply: str,
+    model_name: str,
+    decision=None,
+) -> Dict[str, Any]:
+    if decision is not None and INTENT_ROUTER_MODE == "shadow":
+        router_stats.record_shadow(decision, reply, INTENT_ROUTER_MIN_CONFIDENCE)
 
     try:
-        response = generate_chat_with_rotation(profile, history)
-        reply = response.text or "(no response)"
+        reply = reconcile_reply(reply, NUTRITION_CHECK_MODE)
     except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Gemini error: {exc}") from exc
+        print("Nutrition reconciliation failed:", exc)
 
-    insert_message(conversation_id, "model", reply, user_id=None)
-    touch_conversation(conversation_id, reply)
+    if message_journal is not None:
+        journal_reply(user_id, conversation_id, reply)
+    else:
+        record_message(user_id, conversation_id, "model", reply)
+        touch_conversation(conversation_id, reply)
 
-    updates = detect_profile_updates_with_rotation(body.message, profile)
+    try:
+        with gemini_scheduler.slot(user_id, BACKGROUND):
+            updates = detect_profile_updates_with_rotation(message, profile)
+    except SchedulerOverloaded:
+        updates = {}
     if updates:
-        update_profile(user_id, updates)
+        save_profile_updates(user_id, updates)
+
+    return ChatOut(reply=reply, conversation_id=conversation_id, model=model_name).dict()
+
 
-    return ChatOut(reply=reply, conversation_id=conversation_id)
+def defer_reply(
+    user_id: str,
+    conversation_id: str,
+    message: str,
+    history: List[Dict[str, Any]],
+    message_id: str,
+) -> Dict[str, Any]:
+    """
+    Queue the reply to a message that is already stored (as `message_id`); the
+    payload is returned with a 202. When the queue is full the message is
+    deleted again, so the 503 leaves no user turn without a reply.
+    """
+    try:
+        job = deferred_replies.submit(user_id, conversation_id, message, history)
+    except DeferredQueueFull as exc:
+        try:
+            unrecord_message(user_id, message_id)
+        except Exception as cleanup_exc:
+            print("Could not delete the unanswered message:", cleanup_exc)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(exc),
+            headers={"Retry-After": str(DEFERRED_HEARTBEAT_SECONDS)},
+        ) from exc
+    return {**job.public(), "retry_after": deferred_replies.retry_after(job)}
+
+
+def finish_deferred_reply(job: DeferredJob) -> Dict[str, Any]:
+    """Work function of `deferred_replies`: generate and store the reply once capacity is back."""
+    with usage_scope(job.user_id, job.conversation_id):
+        try:
+            ticket = gemini_scheduler.acquire(job.user_id, BACKGROUND)
+        except SchedulerOverloaded as exc:
+            raise CapacityUnavailable(str(exc)) from exc
+        try:
+            profile = ensure_profile(job.user_id)
+            try:
+                # The history captured when the job was queued, so later messages don't leak into this reply.
+                reply, model_name = generate_reply(profile, job.history)
+            except CAPACITY_ERRORS as exc:
+                raise CapacityUnavailable(str(exc)) from exc
+            reply = polish_reply(profile, reply, model_name)
+        finally:
+            gemini_scheduler.release(ticket)
+        return store_reply(job.user_id, job.conversation_id, job.message, profile, reply, model_name)
+
+
+def chat_result_response(request: Request, result: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> Response:
+    if "job_id" not in result:
+        return json_response(request, result, headers=headers)
+    headers = {
+        **(headers or {}),
+        "Location": f"/api/chat/jobs/{result['job_id']}",
+        "Retry-After": str(result["retry_after"]),
+    }
+    return json_response(request, result, status_code=status.HTTP_202_ACCEPTED, headers=headers)
+
+
+def job_events(job: DeferredJob) -> Iterator[bytes]:
+    """NDJSON lines for a deferred reply: `deferred`, periodic `status`, then `done` or `error`."""
+    yield dumps({"type": "deferred", **job.public()}) + b"\n"
+    job = deferred_replies.wait(job, DEFERRED_HEARTBEAT_SECONDS)
+    while not job.finished:
+        yield dumps({"type": "status", **job.public()}) + b"\n"
+        job = deferred_replies.wait(job, DEFERRED_HEARTBEAT_SECONDS)
+    if job.status == DONE:
+        yield dumps({"type": "done", **job.result}) + b"\n"
+    else:
+        yield dumps({"type": "error", "detail": job.error}) + b"\n"
+
+
+@app.post("/api/chat", response_model=ChatOut)
+def chat(
+    body: ChatIn,
+    request: Request,
+    user_id: str = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    with request_profiler.follow():
+        if not idempotency_key:
+            return chat_result_response(request, run_chat_turn(user_id, body))
+
+        # Retries with the same key join the in-flight generation or replay its stored result.
+        try:
+            result, replayed = chat_idempotency.run(
+                (user_id, idempotency_key, body.conversation_id),
+                request_fingerprint(body.message),
+                lambda: run_chat_turn(user_id, body),
+                wait_timeout=IDEMPOTENCY_WAIT_SECONDS,
+            )
+        except IdempotencyConflict as exc:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(exc)) from exc
+        headers = {"Idempotent-Replayed": "true"} if replayed else None
+        return chat_result_response(request, result, headers=headers)
+
+
+@app.post("/api/chat/stream")
+def chat_stream(
+    body: ChatIn,
+    user_id: str = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """
+    Same turn as `/api/chat`, streamed as NDJSON: `{"type": "delta", "text"}`
+    lines while the model writes, then one `{"type": "done", ...ChatOut}` line.
+    Errors raised before the first line are returned as a normal HTTP error;
+    later ones arrive as a final `{"type": "error", "detail"}` line. A deferred
+    reply continues as the job's stream (see `/api/chat/jobs/{job_id}/stream`).
+    A retry with the same Idempotency-Key gets only the `done` line of the
+    original turn.
+    """
+    events: "queue.Queue" = queue.Queue()
+
+    def turn():
+        return run_chat_turn(user_id, body, on_delta=lambda text: events.put(("delta", text)))
+
+    def work():
+        with request_profiler.follow():
+            try:
+                if idempotency_key:
+                    try:
+                        result, _ = chat_idempotency.run(
+                            (user_id, idempotency_key, body.conversation_id),
+                            request_fingerprint(body.message),
+                            turn,
+                            wait_timeout=IDEMPOTENCY_WAIT_SECONDS,
+                        )
+                    except IdempotencyConflict as exc:
+                        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(exc)) from exc
+                else:
+                    result = turn()
+                events.put(("done", result))
+            except Exception as exc:
+                events.put(("error", exc))
+
+    # The turn runs to completion (and is stored) even if the client disconnects mid-stream.
+    # The copied context lets the turn's thread join a profile of this request.
+    threading.Thread(target=contextvars.copy_context().run, args=(work,), daemon=True).start()
+    kind, value = events.get()
+    if kind == "error":
+        if isinstance(value, HTTPException):
+            raise value
+        raise HTTPException(status_code=500, detail=str(value)) from value
+
+    def lines():
+        event_kind, event_value = kind, value
+        while True:
+            if event_kind == "delta":
+                yield dumps({"type": "delta", "text": event_value}) + b"\n"
+            elif event_kind == "done":
+                job = deferred_replies.get(event_value["job_id"], user_id) if "job_id" in event_value else None
+                if job is not None:
+                    yield from job_events(job)
+                else:
+                    yield dumps({"type": "done", **event_value}) + b"\n"
+                return
+            else:
+                detail = event_value.detail if isinstance(event_value, HTTPException) else str(event_value)
+                yield dumps({"type": "error", "detail": detail}) + b"\n"
+                return
+            event_kind, event_value = events.get()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
+
+
+@app.get("/api/chat/jobs/{job_id}")
+def get_chat_job(
+    job_id: str,
+    request: Request,
+    wait: float = Query(0, ge=0, le=30),
+    user_id: str = Depends(get_current_user),
+):
+    """Status of a deferred reply; `wait` holds the request up to that many seconds for it to finish."""
+    job = deferred_replies.get(job_id, user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if wait:
+        job = deferred_replies.wait(job, wait)
+    headers = None if job.finished else {"Retry-After": str(deferred_replies.retry_after(job))}
+    return json_response(request, job.public(), headers=headers)
+
+
+@app.get("/api/chat/jobs/{job_id}/stream")
+def stream_chat_job(job_id: str, user_id: str = Depends(get_current_user)):
+    job = deferred_replies.get(job_id, user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(job_events(job), media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
+
+
+def run_socket_turn(user_id: str, request_id: str, body: ChatIn, outbox: Outbox) -> None:
+    """One chat turn for the WebSocket, run on `_socket_executor`; every frame carries the client's `id`."""
+
+    def emit(frame: Dict[str, Any]) -> bool:
+        return outbox.put_threadsafe({**frame, "id": request_id})
+
+    try:
+        result = run_chat_turn(user_id, body, on_delta=lambda text: emit({"type": "delta", "text": text}))
+    except HTTPException as exc:
+        emit({"type": "error", "status": exc.status_code, "detail": exc.detail})
+        return
+    except Exception as exc:
+        emit({"type": "error", "status": 500, "detail": str(exc)})
+        return
+
+    job = deferred_replies.get(result["job_id"], user_id) if "job_id" in result else None
+    if job is None:
+        emit({"type": "done", **result})
+        return
+    emit({"type": "deferred", **job.public()})
+    job = deferred_replies.wait(job, DEFERRED_HEARTBEAT_SECONDS)
+    while not job.finished:
+        if outbox.closed:
+            return
+        job = deferred_replies.wait(job, DEFERRED_HEARTBEAT_SECONDS)
+    if job.status == DONE:
+        emit({"type": "done", **job.result})
+    else:
+        emit({"type": "error", "status": 503, "detail": job.error})
+
+
+async def authenticate_socket(websocket: WebSocket) -> Optional[Dict[str, Any]]:
+    """
+    Claims for the connection, from the handshake's Authorization header or,
+    since browsers can't set one, a first `{"type": "auth", "token"}` frame.
+    """
+    try:
+        authorization = websocket.headers.get("authorization")
+        if authorization and authorization.startswith("Bearer "):
+            return verify_token(authorization.split(" ", 1)[1])
+        frame = await asyncio.wait_for(websocket.receive_json(), WS_AUTH_TIMEOUT_SECONDS)
+        if not isinstance(frame, dict) or frame.get("type") != "auth" or not isinstance(frame.get("token"), str):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Expected an auth frame")
+        return verify_token(frame["token"])
+    except (HTTPException, asyncio.TimeoutError, ValueError, WebSocketDisconnect) as exc:
+        detail = exc.detail if isinstance(exc, HTTPException) else "Expected an auth frame"
+        with suppress(Exception):
+            await websocket.send_json({"type": "error", "status": 401, "detail": detail})
+            await websocket.close(code=CLOSE_UNAUTHORIZED)
+        return None
+
+
+@app.websocket("/api/ws")
+async def chat_socket(websocket: WebSocket):
+    """
+    Chat over one authenticated connection. Client frames:
+    `{"type": "chat", "id", "message", "conversation_id"?}`, `{"type": "auth", "token"}`
+    (to refresh an expiring token) and `{"type": "ping"}`. Server frames: `ready`,
+    then per chat `id`: `delta`*, `done` (ChatOut) or `error`, possibly `deferred`
+    first; plus `profile` whenever the user's profile changes. At most
+    WS_MAX_INFLIGHT chats run at once per connection.
+    """
+    await websocket.accept()
+    claims = await authenticate_socket(websocket)
+    if claims is None:
+        return
+    user_id = claims["sub"]
+    loop = asyncio.get_running_loop()
+    outbox = Outbox(loop, WS_MAX_QUEUED_FRAMES, WS_SEND_TIMEOUT_SECONDS)
+
+    async def send(frame: Dict[str, Any]) -> None:
+        await websocket.send_text(dumps(frame).decode("utf-8"))
+
+    async def abort() -> None:
+        with suppress(Exception):
+            await asyncio.wait_for(websocket.close(code=outbox.close_code), 5)
+
+    sender = outbox.start(send)
+    # A stuck client is disconnected, which also ends the receive loop below.
+    sender.add_done_callback(lambda _task: loop.create_task(abort()) if outbox.close_code is not None else None)
+    unsubscribe = profile_events.subscribe(user_id, outbox.offer_threadsafe)
+    inflight: set = set()
+
+    def reject(request_id: Any, status_code: int, detail: str) -> None:
+        outbox.offer({"type": "error", "id": request_id, "status": status_code, "detail": detail})
+
+    try:
+        await outbox.put({"type": "ready", "user_id": user_id, "max_inflight": WS_MAX_INFLIGHT})
+        while not outbox.closed:
+            try:
+                frame = await websocket.receive_json()
+            except ValueError:
+                reject(None, 400, "Frames must be JSON objects")
+                continue
+            if not isinstance(frame, dict):
+                reject(None, 400, "Frames must be JSON objects")
+                continue
+            kind = frame.get("type")
+            request_id = frame.get("id")
+
+            if kind == "ping":
+                outbox.offer({"type": "pong", "id": request_id})
+            elif kind == "auth":
+                try:
+                    refreshed = verify_token(str(frame.get("token")))
+                except HTTPException as exc:
+                    reject(request_id, 401, exc.detail)
+                    continue
+                if refreshed["sub"] != user_id:
+                    reject(request_id, 403, "Token belongs to another user")
+                    continue
+                claims = refreshed
+                outbox.offer({"type": "ready", "id": request_id, "user_id": user_id, "max_inflight": WS_MAX_INFLIGHT})
+            elif kind == "chat":
+                request_id = str(request_id) if request_id is not None else uuid.uuid4().hex
+                message = frame.get("message")
+                conversation_id = frame.get("conversation_id")
+                if claims.get("exp") is not None and claims["exp"] <= time.time():
+                    reject(request_id, 401, "Token expired; send a new auth frame")
+                elif len(inflight) >= WS_MAX_INFLIGHT:
+                    reject(request_id, 429, f"At most {WS_MAX_INFLIGHT} replies can be in progress per connection")
+                elif request_id in inflight:
+                    reject(request_id, 409, "A chat with this id is already in progress")
+                elif not isinstance(message, str) or not message.strip() or len(message) > WS_MAX_MESSAGE_CHARS:
+                    reject(request_id, 400, f"message must be a non-empty string of at most {WS_MAX_MESSAGE_CHARS} characters")
+                elif conversation_id is not None and not isinstance(conversation_id, str):
+                    reject(request_id, 400, "conversation_id must be a string")
+                else:
+                    inflight.add(request_id)
+                    body = ChatIn(message=message, conversation_id=conversation_id)
+                    future = loop.run_in_executor(_socket_executor, run_socket_turn, user_id, request_id, body, outbox)
+                    future.add_done_callback(lambda _future, rid=request_id: inflight.discard(rid))
+            else:
+                reject(request_id, 400, f"Unknown frame type: {kind!r}")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        unsubscribe()
+        # Turns still running finish and are stored; their frames are dropped.
+        outbox.close()
+        with suppress(Exception, asyncio.CancelledError):
+            await sender
@@ -0,0 +1,529 @@
+"""
+State shared by every worker process: the Gemini key cursor, per-key usage
+counters, key cooldowns, cache-invalidation events and small expiring
+values such as idempotency records.
+
+    SHARED_STATE_URL=memory://                      (default, this process only)
+    SHARED_STATE_URL=sqlite:////dev/shm/easydiet.db (all workers on one host)
+    SHARED_STATE_URL=redis://:password@host:6379/0  (any Redis-protocol server)
+
+Backends implement a few primitives (counters with expiry, cooldowns,
+expiring string values and an append-only event log); the key-rotation helpers are built on top of those.
+"""
+import abc
+import json
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+# Events older than this many entries are dropped; a worker that falls further behind flushes its caches.
+EVENT_LOG_SIZE = 1000
+FLUSH_ALL = "*"
+KEY_USAGE_WINDOW_SECONDS = 60
+
+
+@dataclass
+class InvalidationEvent:
+    id: int
+    origin: str
+    topic: str
+    key: str
+
+
+class SharedState(abc.ABC):
+    """Base class: backends implement the primitives, the helpers below are shared."""
+
+    @abc.abstractmethod
+    def incr(self, name: str, amount: int = 1, ttl_seconds: Optional[float] = None) -> int:
+        """Atomically add to a counter and return its new value; `ttl_seconds` applies when it is created."""
+
+    @abc.abstractmethod
+    def get(self, name: str) -> int:
+        ...
+
+    @abc.abstractmethod
+    def set_cooldown(self, name: str, seconds: float) -> None:
+        ...
+
+    @abc.abstractmethod
+    def cooldown_remaining(self, name: str) -> float:
+        ...
+
+    @abc.abstractmethod
+    def put_value(self, name: str, value: str, ttl_seconds: float, only_if_absent: bool = False) -> bool:
+        """Store `value` for `ttl_seconds`; with `only_if_absent` nothing is written over a live value. Returns whether it was written."""
+
+    @abc.abstractmethod
+    def get_value(self, name: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    def delete_value(self, name: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def publish(self, origin: str, topic: str, key: str) -> int:
+        """Append an event and return its id; ids increase by one per event."""
+
+    @abc.abstractmethod
+    def events_since(self, cursor: int) -> List[InvalidationEvent]:
+        ...
+
+    @abc.abstractmethod
+    def latest_event_id(self) -> int:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    # -- helpers --------------------------------------------------------------
+
+    def advance_key_cursor(self, n_keys: int) -> int:
+        """Next key index in a round-robin shared by all workers."""
+        return self.incr("key_cursor") % n_keys
+
+    def record_key_use(self, key_index: int, window_seconds: int = KEY_USAGE_WINDOW_SECONDS) -> int:
+        bucket = int(time.time() // window_seconds)
+        return self.incr(f"key_use:{key_index}:{bucket}", ttl_seconds=window_seconds * 2)
+
+    def key_usage(self, n_keys: int, window_seconds: int = KEY_USAGE_WINDOW_SECONDS) -> Dict[int, int]:
+        """Calls per key in the current window, across all workers."""
+        bucket = int(time.time() // window_seconds)
+        return {key_index: self.get(f"key_use:{key_index}:{bucket}") for key_index in range(n_keys)}
+
+
+class MemoryState(SharedState):
+    """Single-process backend; also the fallback when nothing else is configured."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Tuple[int, Optional[float]]] = {}
+        self._cooldowns: Dict[str, float] = {}
+        self._values: Dict[str, Tuple[str, float]] = {}
+        self._next_value_sweep = 0.0
+        self._events: deque = deque(maxlen=EVENT_LOG_SIZE)
+        self._last_event_id = 0
+
+    def incr(self, name: str, amount: int = 1, ttl_seconds: Optional[float] = None) -> int:
+        with self._lock:
+            now = self._clock()
+            value, expires_at = self._counters.get(name, (0, None))
+            if name not in self._counters or (expires_at is not None and expires_at <= now):
+                value, expires_at = 0, (now + ttl_seconds if ttl_seconds else None)
+            value += amount
+            self._counters[name] = (value, expires_at)
+            return value
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            value, expires_at = self._counters.get(name, (0, None))
+            if expires_at is not None and expires_at <= self._clock():
+                return 0
+            return value
+
+    def set_cooldown(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._cooldowns[name] = self._clock() + seconds
+
+    def cooldown_remaining(self, name: str) -> float:
+        with self._lock:
+            return max(self._cooldowns.get(name, 0.0) - self._clock(), 0.0)
+
+    def put_value(self, name: str, value: str, ttl_seconds: float, only_if_absent: bool = False) -> bool:
+        with self._lock:
+            now = self._clock()
+            if now >= self._next_value_sweep:
+                # Expired values are only dropped lazily; sweep them out about once a second.
+                for stale in [key for key, (_, expires_at) in self._values.items() if expires_at <= now]:
+                    del self._values[stale]
+                self._next_value_sweep = now + 1.0
+            current = self._values.get(name)
+            if only_if_absent and current is not None and current[1] > now:
+                return False
+            self._values[name] = (value, now + ttl_seconds)
+            return True
+
+    def get_value(self, name: str) -> Optional[str]:
+        with self._lock:
+            current = self._values.get(name)
+            if current is None or current[1] <= self._clock():
+                return None
+            return current[0]
+
+    def delete_value(self, name: str) -> None:
+        with self._lock:
+            self._values.pop(name, None)
+
+    def publish(self, origin: str, topic: str, key: str) -> int:
+        with self._lock:
+            self._last_event_id += 1
+            self._events.append(InvalidationEvent(self._last_event_id, origin, topic, key))
+            return self._last_event_id
+
+    def events_since(self, cursor: int) -> List[InvalidationEvent]:
+        with self._lock:
+            return [event for event in self._events if event.id > cursor]
+
+    def latest_event_id(self) -> int:
+        with self._lock:
+            return self._last_event_id
+
+
+class SQLiteState(SharedState):
+    """
+    Backend for several workers on one host. Each thread gets its own
+    connection; increments run in IMMEDIATE transactions so they are atomic
+    across processes. Put the file on tmpfs (/dev/shm) to keep it in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS cooldowns (name TEXT PRIMARY KEY, until REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (name TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires_at ON kv (expires_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, topic TEXT, key TEXT, created_at REAL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, work):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def incr(self, name: str, amount: int = 1, ttl_seconds: Optional[float] = None) -> int:
+        def work(conn):
+            now = time.time()
+            row = conn.execute("SELECT value, expires_at FROM counters WHERE name = ?", (name,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                value, expires_at = amount, now + ttl_seconds if ttl_seconds else None
+            else:
+                value, expires_at = row[0] + amount, row[1]
+            conn.execute(
+                "INSERT INTO counters (name, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (name, value, expires_at),
+            )
+            return value
+
+        return self._transaction(work)
+
+    def get(self, name: str) -> int:
+        row = self._connect().execute(
+            "SELECT value FROM counters WHERE name = ? AND (expires_at IS NULL OR expires_at > ?)", (name, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_cooldown(self, name: str, seconds: float) -> None:
+        self._connect().execute(
+            "INSERT INTO cooldowns (name, until) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET until = excluded.until",
+            (name, time.time() + seconds),
+        )
+
+    def cooldown_remaining(self, name: str) -> float:
+        row = self._connect().execute("SELECT until FROM cooldowns WHERE name = ?", (name,)).fetchone()
+        return max(row[0] - time.time(), 0.0) if row else 0.0
+
+    def put_value(self, name: str, value: str, ttl_seconds: float, only_if_absent: bool = False) -> bool:
+        def work(conn):
+            now = time.time()
+            conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+            if only_if_absent and conn.execute("SELECT 1 FROM kv WHERE name = ?", (name,)).fetchone():
+                return False
+            conn.execute(
+                "INSERT INTO kv (name, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (name, value, now + ttl_seconds),
+            )
+            return True
+
+        return self._transaction(work)
+
+    def get_value(self, name: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE name = ? AND expires_at > ?", (name, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete_value(self, name: str) -> None:
+        self._connect().execute("DELETE FROM kv WHERE name = ?", (name,))
+
+    def publish(self, origin: str, topic: str, key: str) -> int:
+        def work(conn):
+            cursor = conn.execute(
+                "INSERT INTO events (origin, topic, key, created_at) VALUES (?, ?, ?, ?)", (origin, topic, key, time.time())
+            )
+            event_id = cursor.lastrowid
+            conn.execute("DELETE FROM events WHERE id <= ?", (event_id - EVENT_LOG_SIZE,))
+            return event_id
+
+        return self._transaction(work)
+
+    def events_since(self, cursor: int) -> List[InvalidationEvent]:
+        rows = self._connect().execute(
+            "SELECT id, origin, topic, key FROM events WHERE id > ? ORDER BY id", (cursor,)
+        ).fetchall()
+        return [InvalidationEvent(*row) for row in rows]
+
+    def latest_event_id(self) -> int:
+        row = self._connect().execute("SELECT MAX(id) FROM events").fetchone()
+        return row[0] or 0
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server."""
+
+
+class RespClient:
+    """Minimal RESP2 client: one socket, pipelined commands, reconnect once on a broken connection."""
+
+    def __init__(self, host: str, port: int, password: Optional[str] = None, db: int = 0, timeout: float = 1.0):
+        self.host, self.port, self.password, self.db, self.timeout = host, port, password, db, timeout
+        self._sock: Optional[socket.socket] = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._roundtrip(setup)
+
+    def close(self) -> None:
+        resources, self._sock, self._reader = (self._reader, self._sock), None, None
+        for resource in resources:
+            if resource is not None:
+                try:
+                    resource.close()
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _encode(command) -> bytes:
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _read_reply(self) -> Any:
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            return RespError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise ConnectionError(f"unexpected reply type {kind!r}")
+
+    def _roundtrip(self, commands) -> List[Any]:
+        self._sock.sendall(b"".join(self._encode(command) for command in commands))
+        return [self._read_reply() for _ in commands]
+
+    def pipeline(self, *commands) -> List[Any]:
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._open()
+                    replies = self._roundtrip(commands)
+                    break
+                except (OSError, ConnectionError):
+                    self.close()
+                    if attempt:
+                        raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def command(self, *args) -> Any:
+        return self.pipeline(args)[0]
+
+
+class RedisState(SharedState):
+    """Backend for workers on several hosts, speaking RESP to Redis or a compatible server."""
+
+    def __init__(self, client: RespClient, namespace: str = "easydiet"):
+        self.client = client
+        self.namespace = namespace
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisState":
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip("/") or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return cls(RespClient(parsed.hostname or "localhost", parsed.port or 6379, password, db))
+
+    def _key(self, name: str) -> str:
+        return f"{self.namespace}:{name}"
+
+    def incr(self, name: str, amount: int = 1, ttl_seconds: Optional[float] = None) -> int:
+        key = self._key(name)
+        if not ttl_seconds:
+            return self.client.command("INCRBY", key, amount)
+        # SET NX creates the counter with its expiry first, so the TTL can't be lost between commands.
+        _, value = self.client.pipeline(
+            ("SET", key, 0, "PX", int(ttl_seconds * 1000), "NX"),
+            ("INCRBY", key, amount),
+        )
+        return value
+
+    def get(self, name: str) -> int:
+        value = self.client.command("GET", self._key(name))
+        return int(value) if value is not None else 0
+
+    def set_cooldown(self, name: str, seconds: float) -> None:
+        self.client.command("SET", self._key(f"cooldown:{name}"), 1, "PX", max(int(seconds * 1000), 1))
+
+    def cooldown_remaining(self, name: str) -> float:
+        remaining_ms = self.client.command("PTTL", self._key(f"cooldown:{name}"))
+        return remaining_ms / 1000.0 if remaining_ms and remaining_ms > 0 else 0.0
+
+    def put_value(self, name: str, value: str, ttl_seconds: float, only_if_absent: bool = False) -> bool:
+        command = ["SET", self._key(f"value:{name}"), value, "PX", max(int(ttl_seconds * 1000), 1)]
+        if only_if_absent:
+            command.append("NX")
+        return self.client.command(*command) is not None
+
+    def get_value(self, name: str) -> Optional[str]:
+        return self.client.command("GET", self._key(f"value:{name}"))
+
+    def delete_value(self, name: str) -> None:
+        self.client.command("DEL", self._key(f"value:{name}"))
+
+    def publish(self, origin: str, topic: str, key: str) -> int:
+        # One MULTI/EXEC transaction: the counter and the log can't drift apart, so an
+        # entry's id follows from its position (the last entry's id is events:seq).
+        entry = json.dumps({"origin": origin, "topic": topic, "key": key})
+        replies = self.client.pipeline(
+            ("MULTI",),
+            ("INCR", self._key("events:seq")),
+            ("RPUSH", self._key("events:log"), entry),
+            ("LTRIM", self._key("events:log"), -EVENT_LOG_SIZE, -1),
+            ("EXEC",),
+        )
+        return replies[-1][0]
+
+    def events_since(self, cursor: int) -> List[InvalidationEvent]:
+        latest = self.latest_event_id()
+        # Read only the tail past the cursor; retry if more events landed between the two reads.
+        for _ in range(3):
+            if latest <= cursor:
+                return []
+            wanted = min(latest - cursor, EVENT_LOG_SIZE)
+            _, _, _, (latest, entries) = self.client.pipeline(
+                ("MULTI",),
+                ("GET", self._key("events:seq")),
+                ("LRANGE", self._key("events:log"), -wanted, -1),
+                ("EXEC",),
+            )
+            latest = int(latest or 0)
+            entries = entries or []
+            if len(entries) >= min(latest - cursor, EVENT_LOG_SIZE):
+                break
+        first_id = latest - len(entries) + 1
+        events = []
+        for offset, entry in enumerate(entries):
+            event_id = first_id + offset
+            if event_id > cursor:
+                data = json.loads(entry)
+                events.append(InvalidationEvent(event_id, data["origin"], data["topic"], data["key"]))
+        return events
+
+    def latest_event_id(self) -> int:
+        return self.get("events:seq")
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def create_shared_state(url: Optional[str]) -> SharedState:
+    if not url or url.startswith("memory:"):
+        return MemoryState()
+    if url.startswith("sqlite:///"):
+        return SQLiteState(url[len("sqlite:///"):])
+    if url.startswith("redis://"):
+        return RedisState.from_url(url)
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+
+
+class InvalidationFeed:
+    """Tracks this worker's position in the shared event log and yields events from other workers."""
+
+    def __init__(self, state: SharedState, origin: str):
+        self.state = state
+        self.origin = origin
+        self._lock = threading.Lock()
+        self._cursor: Optional[int] = None
+
+    def poll(self) -> List[InvalidationEvent]:
+        """
+        Events published by other workers since the last poll. If the log was
+        trimmed past this worker's cursor, a single `FLUSH_ALL` event is returned.
+        """
+        with self._lock:
+            if self._cursor is None:
+                # Start at the head: anything older predates this worker's caches.
+                self._cursor = self.state.latest_event_id()
+                return []
+            cursor = self._cursor
+            events = self.state.events_since(cursor)
+            if not events:
+                return []
+            self._cursor = events[-1].id
+        if events[0].id > cursor + 1:
+            return [InvalidationEvent(events[-1].id, "", FLUSH_ALL, FLUSH_ALL)]
+        return [event for event in events if event.origin != self.origin]
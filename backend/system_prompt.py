@@ -0,0 +1,116 @@
+"""
+The chat system prompt, assembled from the sections in `backend/prompts/`.
+
+`core.txt` (persona, conversation flow, off-topic rule) goes into every
+call. The strict output formats are only added when the turn may need them:
+`detect_formats()` looks for a meal plan, recipe or grocery list request in
+the latest user message, or for a change request to a reply that used one of
+those formats. A meal plan always brings the recipe format with it, since
+every meal is a full recipe.
+"""
+import os
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+from backend.usage import estimate_tokens
+
+PROMPT_DIR = os.path.join(os.path.dirname(__file__), "prompts")
+
+MEAL_PLAN = "meal_plan"
+RECIPE = "recipe"
+GROCERY_LIST = "grocery_list"
+# Order the sections appear in the prompt.
+FORMATS = (MEAL_PLAN, RECIPE, GROCERY_LIST)
+_REQUIRES = {MEAL_PLAN: (RECIPE,)}
+
+_FORMAT_PATTERNS = {
+    MEAL_PLAN: re.compile(
+        r"\b(?:meal[\s-]?plans?|meal[\s-]?prep|menu|plan (?:my|me|out|for)"
+        r"|what (?:should|can|do) i eat"
+        r"|(?:day|week|days|weeks)(?:'s)? (?:of|worth of) (?:eating|meals|food))\b"
+    ),
+    RECIPE: re.compile(
+        r"\b(?:recipes?|cook|cooking|bake|baking|make|prepare|dish|dishes"
+        r"|breakfast|brunch|lunch|dinner|supper|ingredients?)\b"
+    ),
+    GROCERY_LIST: re.compile(r"\b(?:grocery|groceries|shopping|shop|buy|supermarket|store)\b"),
+}
+# Markers of a format in a model reply; the reply is HTML, so these match the raw text.
+_REPLY_MARKERS = {MEAL_PLAN: "Meal Plan:", RECIPE: "Recipe:", GROCERY_LIST: "Grocery List"}
+# A message like "swap the salmon" or "make it vegan" edits the previous reply in its own format.
+_FOLLOW_UP_RE = re.compile(
+    r"\b(?:change|swap|replace|adjust|update|redo|tweak|modify|substitute|instead|another|different"
+    r"|again|more|less|fewer|without|remove|add|cheaper|shorter|longer|bigger|smaller|same|version"
+    r"|vegan|vegetarian|halal|kosher|keto|gluten|dairy|allergic|allergy)\b"
+)
+
+
+@lru_cache(maxsize=None)
+def _section(name: str) -> str:
+    with open(os.path.join(PROMPT_DIR, f"{name}.txt"), "r", encoding="utf-8") as handle:
+        return handle.read().strip()
+
+
+def _latest_text(history, role: str) -> Optional[str]:
+    for turn in reversed(history or []):
+        if turn.get("role") == role:
+            return " ".join(str(part) for part in turn.get("parts", []))
+    return None
+
+
+def detect_formats(history: List[Dict[str, Any]]) -> FrozenSet[str]:
+    """Output formats the next reply may use, judged from the end of `history`."""
+    message = _latest_text(history, "user")
+    if message is None:
+        return frozenset()
+    message = " ".join(message.lower().split())
+    formats = {name for name, pattern in _FORMAT_PATTERNS.items() if pattern.search(message)}
+    previous = _latest_text(history, "model")
+    if previous and _FOLLOW_UP_RE.search(message):
+        formats.update(name for name, marker in _REPLY_MARKERS.items() if marker in previous)
+    return frozenset(formats)
+
+
+@lru_cache(maxsize=None)
+def build_system_prompt(formats: FrozenSet[str]) -> str:
+    """Core section plus the format sections in `formats` (and the ones they require)."""
+    chosen = set(formats)
+    for name in formats:
+        chosen.update(_REQUIRES.get(name, ()))
+    parts = [_section("core")]
+    if chosen:
+        parts.append("Strict Formatting Rules:")
+        parts.extend(_section(name) for name in FORMATS if name in chosen)
+        parts.append(_section("formatting"))
+    return "\n\n".join(parts)
+
+
+def full_system_prompt() -> str:
+    return build_system_prompt(frozenset(FORMATS))
+
+
+class PromptStats:
+    """How often each format section was sent, and the prompt tokens left out by sending only some."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record(self, formats: Iterable[str]) -> None:
+        formats = frozenset(formats)
+        saved = estimate_tokens(full_system_prompt()) - estimate_tokens(build_system_prompt(formats))
+        with self._lock:
+            self._counts["prompts"] += 1
+            self._counts["tokens_saved"] += saved
+            for name in formats:
+                self._counts[name] += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            counts = dict(self._counts)
+        prompts = counts.get("prompts", 0)
+        counts["avg_tokens_saved"] = counts.get("tokens_saved", 0) / prompts if prompts else None
+        return counts
@@ -0,0 +1,142 @@
+import copy
+
+import pytest
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+        self.error = None
+
+
+class FakeQuery:
+    """Just enough of the supabase-py/postgrest query builder for the storage helpers."""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.action = "select"
+        self.columns = "*"
+        self.payload = None
+        self.filters = []
+        self.orders = []
+        self.start = None
+        self.end = None
+        self.count = None
+
+    def select(self, columns="*", count=None):
+        self.action, self.columns, self.count = "select", columns, count
+        return self
+
+    def insert(self, payload):
+        self.action, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict=None):
+        self.action, self.payload = "upsert", payload
+        self.on_conflict = on_conflict
+        return self
+
+    def update(self, payload):
+        self.action, self.payload = "update", payload
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def _filter(self, column, predicate):
+        self.filters.append((column, predicate))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, lambda v: v == value)
+
+    def neq(self, column, value):
+        return self._filter(column, lambda v: v != value)
+
+    def lt(self, column, value):
+        return self._filter(column, lambda v: v is not None and v < value)
+
+    def lte(self, column, value):
+        return self._filter(column, lambda v: v is not None and v <= value)
+
+    def gt(self, column, value):
+        return self._filter(column, lambda v: v is not None and v > value)
+
+    def gte(self, column, value):
+        return self._filter(column, lambda v: v is not None and v >= value)
+
+    def in_(self, column, values):
+        values = set(values)
+        return self._filter(column, lambda v: v in values)
+
+    def is_(self, column, value):
+        expected = None if value in (None, "null") else value
+        return self._filter(column, lambda v: v is expected)
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, n):
+        self.start, self.end = 0, n - 1
+        return self
+
+    def range(self, start, end):
+        self.start, self.end = start, end
+        return self
+
+    def _matches(self, row):
+        return all(predicate(row.get(column)) for column, predicate in self.filters)
+
+    def _project(self, row):
+        if self.columns.strip() == "*":
+            return copy.deepcopy(row)
+        return {column.strip(): copy.deepcopy(row.get(column.strip())) for column in self.columns.split(",")}
+
+    def execute(self):
+        rows = self.db.tables.setdefault(self.table, [])
+        if self.action in ("insert", "upsert"):
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            inserted = []
+            for item in payload:
+                item = copy.deepcopy(item)
+                if self.action == "upsert" and self.on_conflict:
+                    keys = [k.strip() for k in self.on_conflict.split(",")]
+                    existing = next((r for r in rows if all(r.get(k) == item.get(k) for k in keys)), None)
+                    if existing is not None:
+                        existing.update(item)
+                        inserted.append(copy.deepcopy(existing))
+                        continue
+                rows.append(item)
+                inserted.append(copy.deepcopy(item))
+            return FakeResponse(inserted)
+        matched = [row for row in rows if self._matches(row)]
+        if self.action == "update":
+            for row in matched:
+                row.update(copy.deepcopy(self.payload))
+            return FakeResponse([copy.deepcopy(row) for row in matched])
+        if self.action == "delete":
+            self.db.tables[self.table] = [row for row in rows if not self._matches(row)]
+            return FakeResponse([copy.deepcopy(row) for row in matched])
+        for column, desc in reversed(self.orders):
+            matched.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        total = len(matched)
+        if self.start is not None:
+            matched = matched[self.start:self.end + 1]
+        return FakeResponse([self._project(row) for row in matched], count=total if self.count else None)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {}
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+@pytest.fixture
+def fake_supabase():
+    return FakeSupabase()
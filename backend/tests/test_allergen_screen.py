@@ -0,0 +1,104 @@
+from backend.allergen_screen import (
+    AhoCorasick,
+    ScreenStats,
+    compile_screener,
+    restrictions_from_text,
+    screen_reply,
+    screener_for_profile,
+)
+
+
+def recipe_html(name, ingredient):
+    return (
+        f"<section><h3>Recipe: {name}</h3>"
+        f"<p><strong>Ingredients:</strong></p><ul><li>{ingredient}</li><li>1 cup rice</li></ul>"
+        "<p><strong>Instructions:</strong></p><ol><li>Cook everything.</li></ol>"
+        "<p>Time: 20 minutes</p><p>Servings: 2</p><p>Estimated Calories Per Serving: 450</p>"
+        "<p>Macros (per serving):</p><ul><li>Protein: 30 g</li><li>Carbs: 45 g</li><li>Fats: 12 g</li></ul></section>"
+    )
+
+
+def terms(screener, text):
+    return [violation.term for violation in screener.scan(text)]
+
+
+def test_automaton_finds_overlapping_patterns():
+    matches = sorted(AhoCorasick(["he", "she", "his", "hers"]).iter_matches("ushers"))
+    assert matches == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
+
+
+def test_longest_phrase_wins_and_exclusions_are_ignored():
+    screener = compile_screener(frozenset({"dairy", "peanuts"}), frozenset())
+    assert terms(screener, "Blend peanut butter with almond milk") == ["peanut butter"]
+    assert terms(screener, "Use coconut milk and a pinch of cream of tartar") == []
+    assert terms(screener, "Keep it dairy-free: no cheese, buttery squash") == []
+    assert terms(screener, "Top with Greek\nyogurt") == ["greek yogurt"]
+
+
+def test_mentions_of_the_allergy_itself_are_not_violations():
+    screener = compile_screener(frozenset({"peanuts"}), frozenset())
+    assert terms(screener, "Since you have a peanut allergy, I used sunflower seeds") == []
+    assert terms(screener, "Because you are allergic to peanuts, I left them out") == []
+    assert terms(screener, "A peanut-free granola") == []
+    assert terms(screener, "Sprinkle with crushed peanuts") == ["peanuts"]
+
+
+def test_replaced_ingredients_are_not_violations_in_any_verb_form():
+    screener = compile_screener(frozenset(), frozenset({"vegetarian"}))
+    assert terms(screener, "I replaced the chicken with tofu") == []
+    assert terms(screener, "Swapped out the beef for lentils, and I'm replacing the bacon with mushrooms") == []
+    assert terms(screener, "Tempeh instead of pork, and skipped the anchovies") == []
+    assert terms(screener, "Grill the chicken") == ["chicken"]
+
+
+def test_non_dairy_phrases_are_allowed_for_vegans():
+    screener = compile_screener(frozenset(), frozenset({"vegan"}))
+    assert terms(screener, "Butter beans in cream of mushroom sauce, with peanut butter toast") == []
+    assert terms(screener, "Finish with coconut cream and a knob of butter") == ["butter"]
+
+
+def test_diets_expand_to_groups_and_extra_terms():
+    screener = compile_screener(frozenset(), frozenset({"vegan"}))
+    found = screener.scan("Drizzle fish sauce over tofu, add eggs and vegan mayo")
+    assert [(violation.term, violation.reasons) for violation in found] == [("fish", ("vegan",)), ("eggs", ("vegan",))]
+    assert compile_screener(frozenset(), frozenset()) is None
+
+
+def test_free_text_restrictions_are_recognised():
+    allergens, diets = restrictions_from_text("Love fish, allergic to peanuts; gluten-free")
+    assert allergens == {"peanuts"} and diets == {"gluten free"}
+    screener = screener_for_profile({"dietary_restrictions": "Love fish, allergic to peanuts"})
+    assert screener is screener_for_profile({"allergens": ["peanuts"]})
+
+
+def test_flag_appends_warning():
+    stats = ScreenStats()
+    reply = "<p>Try this</p>" + recipe_html("Satay Bowl", "2 tbsp peanut butter")
+    screened = screen_reply(reply, {"allergens": ["peanut"]}, "flag", stats=stats)
+    assert screened.startswith(reply)
+    assert "<p><strong>Note: this reply mentions peanut butter" in screened
+    assert stats.snapshot()["replies_flagged"] == 1
+    assert screen_reply("Have a rice bowl.", {"allergens": ["peanut"]}, "flag") == "Have a rice bowl."
+
+
+def test_repair_regenerates_only_the_offending_recipe():
+    prompts = []
+
+    def regenerate(prompt):
+        prompts.append(prompt)
+        return recipe_html("Chicken Bowl", "200 g chicken breast")
+
+    safe = recipe_html("Rice Bowl", "100 g tofu")
+    reply = safe + recipe_html("Shrimp Bowl", "200 g shrimp") + "<p>Enjoy!</p>"
+    stats = ScreenStats()
+    screened = screen_reply(reply, {"allergens": ["shellfish"]}, "repair", regenerate, stats)
+
+    assert len(prompts) == 1 and "shrimp" in prompts[0] and "Rice Bowl" not in prompts[0]
+    assert screened == safe + recipe_html("Chicken Bowl", "200 g chicken breast") + "<p>Enjoy!</p>"
+    assert stats.snapshot()["sections_repaired"] == 1
+
+
+def test_failed_repair_falls_back_to_flag():
+    reply = recipe_html("Shrimp Bowl", "200 g shrimp")
+    screened = screen_reply(reply, {"allergens": ["shellfish"]}, "repair", lambda prompt: reply)
+    assert screened.startswith(reply) and "Note: this reply mentions shrimp" in screened
@@ -0,0 +1,89 @@
+from backend.archive import (
+    ARCHIVE_TABLE,
+    compact_conversation,
+    make_cursor,
+    pack_messages,
+    read_page,
+    unpack_messages,
+)
+
+
+def _seed(fake_supabase, count, conversation_id="conv-1"):
+    fake_supabase.tables["messages"] = [
+        {
+            "id": f"m{i:03d}",
+            "conversation_id": conversation_id,
+            "role": "user" if i % 2 == 0 else "model",
+            "content": f"message {i}",
+            "created_at": f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}+00:00",
+            "user_id": None,
+        }
+        for i in range(count)
+    ]
+
+
+def test_pack_round_trip():
+    rows = [{"id": "1", "role": "model", "content": "<p>Recipe: Oats</p>" * 50, "created_at": "t"}]
+    blob = pack_messages(rows)
+    assert unpack_messages(blob) == rows
+    assert len(blob) < len(rows[0]["content"])
+
+
+def test_compaction_keeps_live_window_hot(fake_supabase):
+    _seed(fake_supabase, 130)
+
+    archived = compact_conversation(fake_supabase, "conv-1", live_window=60, chunk_size=50, min_batch=10)
+
+    assert archived == 70
+    hot = fake_supabase.tables["messages"]
+    assert len(hot) == 60
+    assert min(row["id"] for row in hot) == "m070"
+    archives = fake_supabase.tables[ARCHIVE_TABLE]
+    assert [a["message_count"] for a in archives] == [50, 20]
+    assert archives[0]["first_created_at"] == "2024-01-01T00:00:20+00:00"
+
+
+def test_compaction_skips_small_tails(fake_supabase):
+    _seed(fake_supabase, 65)
+    assert compact_conversation(fake_supabase, "conv-1", live_window=60, min_batch=10) == 0
+    assert len(fake_supabase.tables["messages"]) == 65
+
+
+def test_read_page_spans_hot_rows_and_archives(fake_supabase):
+    _seed(fake_supabase, 130)
+    compact_conversation(fake_supabase, "conv-1", live_window=60, chunk_size=50, min_batch=10)
+
+    newest_hot = fake_supabase.tables["messages"][-1]["created_at"]
+    rows, cursor = read_page(fake_supabase, "conv-1", before=newest_hot, limit=100)
+    assert [row["id"] for row in rows] == [f"m{i:03d}" for i in range(29, 129)]
+    assert cursor == make_cursor(rows[0])
+
+    rows, cursor = read_page(fake_supabase, "conv-1", before=cursor, limit=100)
+    assert [row["id"] for row in rows] == [f"m{i:03d}" for i in range(29)]
+    assert cursor is None
+
+
+def test_read_page_drops_duplicates_left_by_interrupted_compaction(fake_supabase):
+    _seed(fake_supabase, 130)
+    compact_conversation(fake_supabase, "conv-1", live_window=60, chunk_size=50, min_batch=10)
+    # Simulate a crash after the archive insert but before the hot delete.
+    _seed(fake_supabase, 130)
+
+    rows, _ = read_page(fake_supabase, "conv-1", before="2024-01-01T00:02:00+00:00", limit=200)
+    ids = [row["id"] for row in rows]
+    assert len(ids) == len(set(ids)) == 120
+
+
+def test_read_page_cursor_keeps_rows_sharing_a_timestamp(fake_supabase):
+    _seed(fake_supabase, 12)
+    for row in fake_supabase.tables["messages"][2:10]:
+        row["created_at"] = "2024-01-01T00:00:05+00:00"
+    compact_conversation(fake_supabase, "conv-1", live_window=4, chunk_size=3, min_batch=1)
+
+    pages, cursor = [], None
+    while True:
+        rows, cursor = read_page(fake_supabase, "conv-1", before=cursor, limit=3)
+        pages.insert(0, [row["id"] for row in rows])
+        if cursor is None:
+            break
+    assert sum(pages, []) == [f"m{i:03d}" for i in range(12)]
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+import backend.batch_meal_plans as batch
+import backend.server as server
+from backend.search_index import SearchIndex
+
+
+class DummyResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    state = {"generations": [], "conversations": [], "messages": []}
+
+    def fake_generate(profile, history):
+        state["generations"].append(profile["user_id"])
+        return DummyResponse(f"plan for {profile.get('fitness_goals')}")
+
+    def fake_create_conversation(user_id, title=None):
+        conversation = {"id": f"conv-{len(state['conversations']) + 1}", "user_id": user_id, "title": title}
+        state["conversations"].append(conversation)
+        return conversation
+
+    def fake_insert_message(conversation_id, role, content, user_id):
+        state["messages"].append((conversation_id, role, content))
+        return f"msg-{len(state['messages'])}"
+
+    monkeypatch.setattr(server, "generate_chat_with_rotation", fake_generate, raising=False)
+    monkeypatch.setattr(server, "create_conversation", fake_create_conversation, raising=False)
+    monkeypatch.setattr(server, "insert_message", fake_insert_message, raising=False)
+    monkeypatch.setattr(server, "touch_conversation", lambda cid, preview: None, raising=False)
+    monkeypatch.setattr(server, "search_index", SearchIndex())
+    return state
+
+
+PROFILES = [
+    {"user_id": "u1", "fitness_goals": "Lose weight", "dietary_restrictions": "vegan"},
+    {"user_id": "u2", "fitness_goals": " lose  WEIGHT ", "dietary_restrictions": "Vegan"},
+    {"user_id": "u3", "fitness_goals": "Gain muscle", "dietary_restrictions": None},
+]
+
+
+def test_profile_group_key_normalizes():
+    assert batch.profile_group_key(PROFILES[0]) == batch.profile_group_key(PROFILES[1])
+    assert batch.profile_group_key(PROFILES[0]) != batch.profile_group_key(PROFILES[2])
+
+
+def test_group_key_includes_structured_fields():
+    base = {"user_id": "u4", "fitness_goals": "Lose weight", "dietary_restrictions": "vegan"}
+    assert batch.profile_group_key(base) == batch.profile_group_key({**base, "allergens": []})
+    assert batch.profile_group_key({**base, "allergens": ["Peanut"]}) == batch.profile_group_key({**base, "allergens": "peanut"})
+    assert batch.profile_group_key({**base, "allergens": ["peanut"]}) != batch.profile_group_key(base)
+    assert batch.profile_group_key({**base, "calorie_target": 1800}) != batch.profile_group_key(base)
+
+
+def test_batch_plans_are_screened_for_allergens(fake_backend, monkeypatch):
+    monkeypatch.setattr(server, "ALLERGEN_SCREEN_MODE", "flag", raising=False)
+    monkeypatch.setattr(server, "generate_chat_with_rotation", lambda profile, history: DummyResponse("Snack on peanuts."), raising=False)
+    profiles = [{"user_id": "u5", "fitness_goals": "Gain muscle", "dietary_restrictions": None, "allergens": ["peanut"]}]
+    asyncio.run(batch.run_batch(profiles, batch.BatchProgress(path=None), concurrency=1))
+
+    [plan] = [content for _, role, content in fake_backend["messages"] if role == "model"]
+    assert plan.startswith("Snack on peanuts.") and "Note: this reply mentions peanuts" in plan
+
+
+def test_run_batch_generates_once_per_group(fake_backend, tmp_path):
+    progress = batch.BatchProgress.load(str(tmp_path / "progress.jsonl"))
+    server.search_index.search("u3", "plan", lambda user_id: [])
+    report = asyncio.run(batch.run_batch(PROFILES, progress, concurrency=2, title="Plan"))
+
+    assert report.groups == 2
+    assert report.generations == 2
+    assert report.users_written == 3
+    assert len(fake_backend["generations"]) == 2
+    assert {c["user_id"] for c in fake_backend["conversations"]} == {"u1", "u2", "u3"}
+    model_messages = [m for m in fake_backend["messages"] if m[1] == "model"]
+    assert len(model_messages) == 3
+    # Plans go through record_message, so already-loaded search partitions see them.
+    u3_conversation = next(c["id"] for c in fake_backend["conversations"] if c["user_id"] == "u3")
+    hits = server.search_index.search("u3", "muscle", lambda user_id: [])
+    assert [hit["conversation_id"] for hit in hits] == [u3_conversation]
+
+
+def test_run_batch_resumes_from_progress(fake_backend, tmp_path):
+    path = str(tmp_path / "progress.jsonl")
+    first = batch.BatchProgress.load(path)
+    asyncio.run(batch.run_batch(PROFILES[:1], first, concurrency=1))
+
+    resumed = batch.BatchProgress.load(path)
+    report = asyncio.run(batch.run_batch(PROFILES, resumed, concurrency=1))
+
+    # u1's group plan is reused for u2; only the u3 group needs a new generation.
+    assert report.generations == 1
+    assert report.reused_plans == 1
+    assert report.users_skipped == 1
+    assert report.users_written == 2
+    assert len(fake_backend["generations"]) == 2
+
+
+def test_progress_log_appends_and_skips_torn_lines(tmp_path):
+    path = tmp_path / "progress.jsonl"
+    progress = batch.BatchProgress.load(str(path))
+    progress.record_plan("g1", "plan one")
+    progress.record_user("u1", "conv-1")
+    assert len(path.read_text().splitlines()) == 2
+
+    with open(path, "a", encoding="utf-8") as handle:
+        handle.write('{"user": "u2", "conv')
+    loaded = batch.BatchProgress.load(str(path))
+    assert loaded.plans == {"g1": "plan one"}
+    assert loaded.users_done == {"u1": "conv-1"}
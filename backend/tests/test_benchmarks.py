@@ -0,0 +1,21 @@
+from backend.benchmarks import bench_hot_paths, bench_prompt_sections
+
+
+def test_every_case_runs_and_has_a_baseline():
+    baseline = bench_hot_paths.load_baseline()
+    for name, (fn, args) in bench_hot_paths.cases().items():
+        fn(*args)
+        assert baseline.get(name, 0) > 0, name
+
+
+def test_regressions_only_reports_cases_past_the_threshold():
+    baseline = {"fast": 1.0, "slow": 1.0, "retired": 1.0}
+    results = {"fast": 1.2, "slow": 1.5, "new": 9.0}
+    assert bench_hot_paths.regressions(results, baseline, 0.25) == ["slow: +50% (limit +25%)"]
+
+
+def test_sectioned_prompts_send_fewer_tokens_on_every_turn():
+    full_tokens, _ = bench_prompt_sections.run(False, 0, 0, 24000)
+    tokens, _ = bench_prompt_sections.run(True, 0, 0, 24000)
+    assert all(after <= before for before, after in zip(full_tokens, tokens))
+    assert sum(tokens) < sum(full_tokens)
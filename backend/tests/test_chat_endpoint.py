@@ -1,7 +1,17 @@
+import json
+import time
+
 import pytest
 from fastapi.testclient import TestClient
 
 import backend.server as server
+from backend.archive import compact_conversation
+from backend.profile_utils import ALL_PROFILE_FIELDS
+from backend.shared_state import InvalidationFeed, MemoryState
+from backend.usage import UsageMeter
+
+# The client fixture fakes history reads; paging tests run the real query against fake_supabase.
+REAL_FETCH_HISTORY_ROWS = server.fetch_history_rows
 
 
 class DummyResponse:
@@ -31,8 +41,13 @@ def client(monkeypatch):
         "conversations": {},
         "messages": [],
         "profiles": {},
+        "clock": 0,
     }
 
+    def tick():
+        state["clock"] += 1
+        return f"2024-01-01T00:00:{state['clock']:02d}+00:00"
+
     def fake_ensure_profile(user_id: str):
         profile = state["profiles"].get(user_id)
         if profile is None:
@@ -43,6 +58,7 @@ def client(monkeypatch):
     def fake_update_profile(user_id: str, updates):
         profile = fake_ensure_profile(user_id)
         profile.update(updates)
+        profile["updated_at"] = tick()
         return profile
 
     def fake_create_conversation(user_id: str, title=None):
@@ -52,10 +68,16 @@ def client(monkeypatch):
             "user_id": user_id,
             "title": title or "New conversation",
             "last_message_preview": None,
+            "updated_at": tick(),
         }
         state["conversations"][conv_id] = conversation
         return conversation
 
+    def fake_list_conversations(user_id: str, limit=None):
+        conversations = [c for c in state["conversations"].values() if c["user_id"] == user_id]
+        conversations.reverse()
+        return conversations[:limit] if limit else conversations
+
     def fake_ensure_conversation_owner(user_id: str, conversation_id: str):
         conv = state["conversations"].get(conversation_id)
         if not conv or conv["user_id"] != user_id:
@@ -65,38 +87,51 @@ def client(monkeypatch):
         return conv
 
     def fake_insert_message(conversation_id: str, role: str, content: str, user_id: str | None):
+        message_id = f"msg-{len(state['messages']) + 1}"
         state["messages"].append(
             {
+                "id": message_id,
+                "created_at": tick(),
                 "conversation_id": conversation_id,
                 "role": role,
                 "content": content,
                 "user_id": user_id,
             }
         )
+        return message_id
+
+    def fake_delete_message(message_id: str):
+        state["messages"] = [msg for msg in state["messages"] if msg["id"] != message_id]
 
     def fake_touch_conversation(conversation_id: str, preview: str):
         conv = state["conversations"].get(conversation_id)
         if conv:
             conv["last_message_preview"] = preview[:140]
+            conv["updated_at"] = tick()
 
-    def fake_fetch_history(conversation_id: str):
-        # Build minimal gemini-style history from stored messages
-        history = []
-        for msg in state["messages"]:
-            if msg["conversation_id"] != conversation_id:
-                continue
-            if msg["role"] not in ("user", "model"):
-                continue
-            history.append({"role": msg["role"], "parts": [msg["content"]]})
-        return history
+    def fake_fetch_history_rows(conversation_id: str):
+        # Newest first, like the real query
+        rows = [msg for msg in state["messages"] if msg["conversation_id"] == conversation_id]
+        return list(reversed(rows))[: server.MAX_TURNS * 2]
 
     monkeypatch.setattr(server, "ensure_profile", fake_ensure_profile, raising=False)
     monkeypatch.setattr(server, "update_profile", fake_update_profile, raising=False)
     monkeypatch.setattr(server, "create_conversation", fake_create_conversation, raising=False)
+    monkeypatch.setattr(server, "list_conversations", fake_list_conversations, raising=False)
     monkeypatch.setattr(server, "ensure_conversation_owner", fake_ensure_conversation_owner, raising=False)
     monkeypatch.setattr(server, "insert_message", fake_insert_message, raising=False)
+    monkeypatch.setattr(server, "delete_message", fake_delete_message, raising=False)
     monkeypatch.setattr(server, "touch_conversation", fake_touch_conversation, raising=False)
-    monkeypatch.setattr(server, "fetch_history", fake_fetch_history, raising=False)
+    monkeypatch.setattr(server, "fetch_history_rows", fake_fetch_history_rows, raising=False)
+    monkeypatch.setattr(server, "search_index", server.SearchIndex(), raising=False)
+    monkeypatch.setattr(server, "shared_state", MemoryState(), raising=False)
+    monkeypatch.setattr(server, "usage_meter", UsageMeter(lambda rows: None, server.shared_state), raising=False)
+    monkeypatch.setattr(
+        server,
+        "deferred_replies",
+        server.DeferredQueue(server.finish_deferred_reply, retry_delay=0, autostart=False, state=server.shared_state),
+        raising=False,
+    )
 
     # ---- 3) Stub Gemini helpers (no actual network) ----
     def fake_generate_chat_with_rotation(profile, history):
@@ -148,7 +183,7 @@ def test_chat_creates_conversation_and_returns_reply(client):
     res_msgs = client.get(f"/api/conversations/{conv_id}/messages", headers=headers)
     assert res_msgs.status_code == 200
     messages = res_msgs.json()
-    # Messages history is coming from our fake_fetch_history
+    # Messages history is coming from our fake_fetch_history_rows
     # For this run, we expect at least one user message and one model message
     roles = [m["role"] for m in messages]
     assert "user" in roles
@@ -185,3 +220,548 @@ def test_chat_uses_existing_conversation_and_updates_profile(client):
     assert res_profile.status_code == 200
     profile = res_profile.json()
     assert profile["fitness_goals"] == "gain muscle"
+
+
+def test_bootstrap_returns_profile_conversations_and_messages(client):
+    headers = {"Authorization": "Bearer dummy-token"}
+    first = client.post("/api/chat", json={"message": "Hello first"}, headers=headers).json()
+    second = client.post("/api/chat", json={"message": "Hello second"}, headers=headers).json()
+
+    # Without a conversation_id the most recent conversation becomes active.
+    res = client.get("/api/bootstrap", headers=headers)
+    assert res.status_code == 200
+    data = res.json()
+    assert set(data["profile"]) == set(ALL_PROFILE_FIELDS)
+    assert [c["id"] for c in data["conversations"]] == [second["conversation_id"], first["conversation_id"]]
+    assert data["active_conversation_id"] == second["conversation_id"]
+    assert [m["parts"][0] for m in data["messages"]] == ["Hello second", "stubbed model reply"]
+
+    res = client.get(
+        "/api/bootstrap",
+        params={"conversation_id": first["conversation_id"], "limit": 1},
+        headers=headers,
+    )
+    data = res.json()
+    assert len(data["conversations"]) == 1
+    assert data["active_conversation_id"] == first["conversation_id"]
+    assert data["messages"][0]["parts"][0] == "Hello first"
+
+
+def test_bootstrap_ignores_unknown_conversation(client, monkeypatch):
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    def fail_fetch_history(conversation_id):
+        raise AssertionError("history of a conversation the user doesn't own must not be read")
+
+    monkeypatch.setattr(server, "fetch_history", fail_fetch_history, raising=False)
+    res = client.get("/api/bootstrap", params={"conversation_id": "missing"}, headers=headers)
+    assert res.status_code == 200
+    data = res.json()
+    assert data["active_conversation_id"] is None
+    assert data["messages"] == []
+
+
+def test_bootstrap_rejects_out_of_range_limit(client):
+    headers = {"Authorization": "Bearer dummy-token"}
+    assert client.get("/api/bootstrap", params={"limit": 0}, headers=headers).status_code == 422
+    assert client.get("/api/bootstrap", params={"limit": 201}, headers=headers).status_code == 422
+
+
+def test_messages_etag_returns_304_until_conversation_changes(client):
+    headers = {"Authorization": "Bearer dummy-token"}
+    conv_id = client.post("/api/chat", json={"message": "Hello"}, headers=headers).json()["conversation_id"]
+
+    first = client.get(f"/api/conversations/{conv_id}/messages", headers=headers)
+    etag = first.headers["etag"]
+    assert etag.startswith('W/"')
+    assert first.headers["cache-control"] == "private, no-cache"
+
+    cached = client.get(
+        f"/api/conversations/{conv_id}/messages",
+        headers={**headers, "If-None-Match": etag},
+    )
+    assert cached.status_code == 304
+    assert cached.content == b""
+
+    client.post("/api/chat", json={"message": "Again", "conversation_id": conv_id}, headers=headers)
+    changed = client.get(
+        f"/api/conversations/{conv_id}/messages",
+        headers={**headers, "If-None-Match": etag},
+    )
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+
+
+def test_conversations_and_profile_etags(client):
+    headers = {"Authorization": "Bearer dummy-token"}
+    client.post("/api/chat", json={"message": "I want to bulk"}, headers=headers)
+
+    for path in ("/api/conversations", "/api/profile"):
+        first = client.get(path, headers=headers)
+        assert first.status_code == 200
+        cached = client.get(path, headers={**headers, "If-None-Match": first.headers["etag"]})
+        assert cached.status_code == 304
+
+
+def test_large_replies_are_compressed(client, monkeypatch):
+    long_reply = "<section><h2>Meal Plan: Monday</h2>" + "<p>Oats with berries</p>" * 200 + "</section>"
+    monkeypatch.setattr(
+        server, "generate_chat_with_rotation", lambda profile, history: DummyResponse(long_reply), raising=False
+    )
+    headers = {"Authorization": "Bearer dummy-token", "Accept-Encoding": "gzip"}
+
+    res = client.post("/api/chat", json={"message": "Plan my Monday"}, headers=headers)
+    assert res.status_code == 200
+    assert res.headers["content-encoding"] == "gzip"
+    assert res.json()["reply"] == long_reply
+
+    conv_id = res.json()["conversation_id"]
+    res_msgs = client.get(f"/api/conversations/{conv_id}/messages", headers=headers)
+    assert res_msgs.headers["content-encoding"] == "gzip"
+    assert res_msgs.json()[-1]["parts"][0] == long_reply
+
+
+def test_chat_idempotency_key_replays_without_duplicate_messages(client, monkeypatch):
+    monkeypatch.setattr(server, "chat_idempotency", server.IdempotencyStore(ttl_seconds=60), raising=False)
+    headers = {"Authorization": "Bearer dummy-token", "Idempotency-Key": "retry-1"}
+    calls = []
+
+    def counting_generate(profile, history):
+        calls.append(1)
+        return DummyResponse("stubbed model reply")
+
+    monkeypatch.setattr(server, "generate_chat_with_rotation", counting_generate, raising=False)
+
+    first = client.post("/api/chat", json={"message": "Hello"}, headers=headers)
+    retry = client.post("/api/chat", json={"message": "Hello"}, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert len(calls) == 1
+
+    conv_id = first.json()["conversation_id"]
+    messages = client.get(f"/api/conversations/{conv_id}/messages", headers=headers).json()
+    assert [m["role"] for m in messages] == ["user", "model"]
+
+    conflict = client.post("/api/chat", json={"message": "Something else"}, headers=headers)
+    assert conflict.status_code == 409
+
+
+def test_stream_retry_on_another_worker_replays_the_stored_turn(client, monkeypatch):
+    shared = MemoryState()
+    monkeypatch.setattr(server, "chat_idempotency", server.IdempotencyStore(ttl_seconds=60, state=shared), raising=False)
+    headers = {"Authorization": "Bearer dummy-token", "Idempotency-Key": "msg-1"}
+    calls = []
+
+    def counting_generate(profile, history):
+        calls.append(1)
+        return DummyResponse("stubbed model reply")
+
+    monkeypatch.setattr(server, "generate_chat_with_rotation", counting_generate, raising=False)
+    first = client.post("/api/chat", json={"message": "Hello"}, headers=headers).json()
+
+    # The retry reaches a different worker: its own store, same shared state.
+    monkeypatch.setattr(server, "chat_idempotency", server.IdempotencyStore(ttl_seconds=60, state=shared), raising=False)
+    res = client.post("/api/chat/stream", json={"message": "Hello"}, headers=headers)
+    events = [json.loads(line) for line in res.text.splitlines() if line]
+    assert [e["type"] for e in events] == ["done"]
+    assert events[0]["reply"] == first["reply"]
+    assert len(calls) == 1
+
+    conflict = client.post("/api/chat/stream", json={"message": "Other"}, headers=headers)
+    assert conflict.status_code == 409
+
+
+def test_admin_profile_header_dumps_the_chat_request(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "request_profiler", server.RequestProfiler(str(tmp_path), token="profile-secret"), raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    assert client.post("/api/chat", json={"message": "Hi"}, headers=headers).status_code == 200
+    assert server.request_profiler.dumps() == ()
+
+    # Authentication runs before the handler, and is part of the profile.
+    def slow_verify(token):
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return {"sub": "test-user-id"}
+
+    monkeypatch.delitem(server.app.dependency_overrides, server.get_current_user)
+    monkeypatch.setattr(server, "verify_token", slow_verify, raising=False)
+    res = client.post("/api/chat", json={"message": "Hi"}, headers={**headers, "X-Profile": "profile-secret"})
+    assert res.status_code == 200
+    [dump] = server.request_profiler.dumps()
+    assert "-chat-" in dump
+    assert "slow_verify" in (tmp_path / dump).read_text()
+
+
+def test_journaled_reply_returns_before_it_is_stored(client, monkeypatch, tmp_path):
+    batches = []
+    journal = server.MessageJournal(str(tmp_path), batches.append, autostart=False)
+    monkeypatch.setattr(server, "message_journal", journal, raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    res = client.post("/api/chat", json={"message": "Quick lunch?"}, headers=headers)
+    assert res.status_code == 200
+    conversation_id = res.json()["conversation_id"]
+    # Only the user message went to storage; the reply waits in the journal.
+    messages = client.get(f"/api/conversations/{conversation_id}/messages", headers=headers).json()
+    assert [m["role"] for m in messages] == ["user"]
+    [pending] = journal.pending(conversation_id)
+    assert pending["content"] == res.json()["reply"]
+
+    journal.flush()
+    [batch] = batches
+    assert [entry["op"] for entry in batch] == ["message", "touch"]
+    assert batch[0]["id"] == pending["id"]
+
+
+def test_late_journal_touch_does_not_roll_back_a_newer_one(monkeypatch, fake_supabase):
+    fake_supabase.tables["conversations"] = [
+        {"id": "c1", "user_id": "u1", "last_message_preview": "newer", "updated_at": "2024-01-01T00:00:05+00:00"}
+    ]
+    monkeypatch.setattr(server, "supabase", fake_supabase, raising=False)
+    touch = {"op": "touch", "conversation_id": "c1", "preview": "stale", "updated_at": "2024-01-01T00:00:03+00:00"}
+
+    server.write_journal_entries([{**touch, "id": "t1"}])
+    assert fake_supabase.tables["conversations"][0]["last_message_preview"] == "newer"
+
+    server.write_journal_entries([{**touch, "id": "t2", "preview": "newest", "updated_at": "2024-01-01T00:00:07+00:00"}, {**touch, "id": "t1"}])
+    assert fake_supabase.tables["conversations"][0]["last_message_preview"] == "newest"
+
+
+def test_export_streams_stored_and_journaled_messages(client, monkeypatch, fake_supabase, tmp_path):
+    import gzip
+
+    fake_supabase.tables["conversations"] = [{"id": "c1", "user_id": "test-user-id", "title": "Plans"}]
+    fake_supabase.tables["messages"] = [
+        {"id": f"m{i}", "conversation_id": "c1", "role": "user", "content": f"hi {i}", "created_at": f"2024-01-01T00:00:0{i}+00:00"}
+        for i in range(3)
+    ]
+    journal = server.MessageJournal(str(tmp_path), lambda entries: None, autostart=False)
+    journal.append({"op": "message", "id": "m9", "conversation_id": "c1", "role": "model", "content": "reply", "created_at": "2024-01-01T00:00:09+00:00"})
+    monkeypatch.setattr(server, "supabase", fake_supabase, raising=False)
+    monkeypatch.setattr(server, "message_journal", journal, raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    res = client.get("/api/export", headers=headers)
+    assert res.headers["content-type"] == "application/x-ndjson"
+    assert "attachment" in res.headers["content-disposition"]
+    records = [json.loads(line) for line in res.text.splitlines()]
+    assert [r["id"] for r in records if r["type"] == "message"] == ["m0", "m1", "m2", "m9"]
+    assert records[-1] == {"type": "end", "conversations": 1, "messages": 4}
+
+    res = client.get("/api/export?gzip=true", headers=headers)
+    assert res.headers["content-type"] == "application/gzip"
+    assert [json.loads(line) for line in gzip.decompress(res.content).splitlines()][1:] == records[1:]
+
+    # A storage failure after the stream has started ends it with an error line instead of `end`.
+    table = fake_supabase.table
+
+    def failing_table(name):
+        if name == "messages":
+            raise RuntimeError("storage unavailable")
+        return table(name)
+
+    monkeypatch.setattr(fake_supabase, "table", failing_table)
+    records = [json.loads(line) for line in client.get("/api/export", headers=headers).text.splitlines()]
+    assert records[-1] == {"type": "error", "detail": "storage unavailable"}
+
+
+def test_messages_pages_hand_off_from_the_first_page_to_archives(client, monkeypatch, fake_supabase):
+    # Pairs of messages share a timestamp, so page boundaries fall inside a tie.
+    fake_supabase.tables["messages"] = [
+        {"id": f"m{i:02d}", "conversation_id": "c1", "role": "user" if i % 2 == 0 else "model",
+         "content": f"message {i}", "created_at": f"2024-01-01T00:00:{i // 2:02d}+00:00"}
+        for i in range(30)
+    ]
+    compact_conversation(fake_supabase, "c1", live_window=7, chunk_size=5, min_batch=1)
+    monkeypatch.setattr(server, "supabase", fake_supabase, raising=False)
+    monkeypatch.setattr(server, "fetch_history_rows", REAL_FETCH_HISTORY_ROWS, raising=False)
+    monkeypatch.setattr(server, "message_journal", None, raising=False)
+    monkeypatch.setattr(server, "ensure_conversation_owner", lambda user_id, conversation_id: {"id": conversation_id})
+    monkeypatch.setattr(server, "MAX_TURNS", 2)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    res = client.get("/api/conversations/c1/messages", headers=headers)
+    pages = [res.json()]
+    while "x-next-before" in res.headers:
+        res = client.get("/api/conversations/c1/messages", params={"before": res.headers["x-next-before"], "limit": 3}, headers=headers)
+        pages.append(res.json())
+
+    assert len(pages[0]) == 4
+    contents = [message["parts"][0] for page in reversed(pages) for message in page]
+    assert contents == [f"message {i}" for i in range(30)]
+
+
+def test_chat_returns_429_when_scheduler_is_full(client, monkeypatch):
+    scheduler = server.FairScheduler(capacity=1, per_user_limit=1, max_queue=0)
+    monkeypatch.setattr(server, "gemini_scheduler", scheduler, raising=False)
+    busy = scheduler.acquire("someone-else")
+
+    headers = {"Authorization": "Bearer dummy-token"}
+    res = client.post("/api/chat", json={"message": "Hello"}, headers=headers)
+    assert res.status_code == 429
+    assert res.headers["retry-after"] == "1"
+
+    scheduler.release(busy)
+    res = client.post("/api/chat", json={"message": "Hello"}, headers=headers)
+    assert res.status_code == 200
+
+
+def test_router_answers_off_topic_locally(client, monkeypatch):
+    monkeypatch.setattr(server, "INTENT_ROUTER_MODE", "on", raising=False)
+
+    def fail_generate(profile, history):
+        raise AssertionError("off-topic message should not reach the model")
+
+    monkeypatch.setattr(server, "generate_chat_with_rotation", fail_generate, raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    res = client.post("/api/chat", json={"message": "Who won the football game last night?"}, headers=headers)
+    assert res.status_code == 200
+    data = res.json()
+    assert data["reply"] == "I'm here to help with nutrition-related questions."
+    assert data["model"] == server.LOCAL_ROUTER_MODEL
+
+    messages = client.get(f"/api/conversations/{data['conversation_id']}/messages", headers=headers).json()
+    assert [m["role"] for m in messages] == ["user", "model"]
+
+
+def test_search_indexes_new_messages_and_drops_deleted_conversations(client, monkeypatch):
+    loads = []
+
+    def fake_load_search_rows(user_id):
+        loads.append(user_id)
+        return [
+            {"id": "old-1", "conversation_id": "conv-old", "role": "model", "content": "<p>Lentil soup with cumin</p>", "created_at": "2023-12-01T00:00:00+00:00"},
+        ]
+
+    monkeypatch.setattr(server, "load_search_rows", fake_load_search_rows, raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    res = client.get("/api/search", params={"q": "lentil"}, headers=headers)
+    assert res.status_code == 200
+    assert [hit["message_id"] for hit in res.json()] == ["old-1"]
+
+    chat = client.post("/api/chat", json={"message": "Any ideas for a chickpea curry?"}, headers=headers).json()
+    hits = client.get("/api/search", params={"q": "chickpeas"}, headers=headers).json()
+    assert [hit["conversation_id"] for hit in hits] == [chat["conversation_id"]]
+    assert hits[0]["role"] == "user"
+    assert loads == ["test-user-id"]
+
+    monkeypatch.setattr(server, "delete_conversation", lambda user_id, cid: server.search_index.remove_conversation(user_id, cid))
+    client.delete(f"/api/conversations/{chat['conversation_id']}", headers=headers)
+    assert client.get("/api/search", params={"q": "chickpea"}, headers=headers).json() == []
+
+
+def test_search_applies_other_workers_appends_and_removals(client, monkeypatch):
+    monkeypatch.setattr(server, "invalidations", InvalidationFeed(server.shared_state, "this-worker"), raising=False)
+    server.invalidations.poll()
+    monkeypatch.setattr(server, "load_search_rows", lambda user_id: [], raising=False)
+    fetched = []
+
+    def fake_fetch_messages_by_id(message_ids):
+        fetched.extend(message_ids)
+        return [{"id": "remote-1", "conversation_id": "conv-remote", "role": "user", "content": "Tofu scramble?", "created_at": None}]
+
+    monkeypatch.setattr(server, "fetch_messages_by_id", fake_fetch_messages_by_id, raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+    assert client.get("/api/search", params={"q": "tofu"}, headers=headers).json() == []
+
+    server.shared_state.publish("other-worker", "search_append", "test-user-id:remote-1")
+    server.shared_state.publish("other-worker", "search_append", "someone-else:remote-2")
+    hits = client.get("/api/search", params={"q": "tofu"}, headers=headers).json()
+    assert [hit["message_id"] for hit in hits] == ["remote-1"]
+    # Only partitions held by this worker are patched; the partition was kept, not rebuilt.
+    assert fetched == ["remote-1"]
+
+    server.shared_state.publish("other-worker", "search_remove", "test-user-id:conv-remote")
+    assert client.get("/api/search", params={"q": "tofu"}, headers=headers).json() == []
+
+
+def test_chat_stream_emits_deltas_then_done(client, monkeypatch):
+    def fake_stream(profile, history):
+        yield "<p>Try "
+        yield "overnight oats.</p>"
+
+    monkeypatch.setattr(server, "stream_chat_with_rotation", fake_stream, raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    res = client.post("/api/chat/stream", json={"message": "Quick breakfast?"}, headers=headers)
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in res.text.splitlines() if line]
+    assert [e["type"] for e in events] == ["delta", "delta", "done"]
+    assert events[-1]["reply"] == "<p>Try overnight oats.</p>"
+
+    messages = client.get(f"/api/conversations/{events[-1]['conversation_id']}/messages", headers=headers).json()
+    assert messages[-1]["parts"] == ["<p>Try overnight oats.</p>"]
+
+
+def test_chat_stream_screens_the_reply_before_sending_it_to_allergic_users(client, monkeypatch):
+    monkeypatch.setattr(server, "ALLERGEN_SCREEN_MODE", "flag", raising=False)
+    monkeypatch.setattr(server, "stream_chat_with_rotation", lambda profile, history: iter(["<p>Add peanuts.</p>"]), raising=False)
+    monkeypatch.setattr(server, "generate_chat_with_rotation", lambda profile, history: DummyResponse("<p>Add peanuts.</p>"), raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+    server.ensure_profile("test-user-id")["allergens"] = ["peanut"]
+
+    res = client.post("/api/chat/stream", json={"message": "Snack?"}, headers=headers)
+    events = [json.loads(line) for line in res.text.splitlines() if line]
+    assert [e["type"] for e in events] == ["delta", "done"]
+    assert "Note: this reply mentions peanuts" in events[0]["text"]
+    assert events[0]["text"] == events[-1]["reply"]
+
+
+def test_chat_stream_reports_errors_before_first_chunk_as_http_errors(client, monkeypatch):
+    def failing_stream(profile, history):
+        raise RuntimeError("all keys exhausted")
+        yield
+
+    monkeypatch.setattr(server, "stream_chat_with_rotation", failing_stream, raising=False)
+    res = client.post("/api/chat/stream", json={"message": "Hi"}, headers={"Authorization": "Bearer dummy-token"})
+    assert res.status_code == 500
+    assert "all keys exhausted" in res.json()["detail"]
+
+
+def test_daily_token_budget_blocks_generation(client, monkeypatch):
+    monkeypatch.setattr(server, "USER_DAILY_TOKEN_BUDGET", 100, raising=False)
+    monkeypatch.setattr(server, "fetch_usage_rows", lambda user_id, since: [], raising=False)
+    headers = {"Authorization": "Bearer dummy-token"}
+
+    assert client.post("/api/chat", json={"message": "Hello"}, headers=headers).status_code == 200
+    with server.usage_scope("test-user-id", "conv-1"):
+        server.usage_meter.record(0, "chat", 90, 20)
+
+    res = client.post("/api/chat", json={"message": "Another plan please"}, headers=headers)
+    assert res.status_code == 429
+    assert int(res.headers["retry-after"]) > 0
+
+    usage = client.get("/api/usage", headers=headers).json()
+    assert usage["used_today"] == 110
+    assert usage["remaining_today"] == 0
+    assert usage["by_conversation"]["conv-1"]["output_tokens"] == 20
+
+
+def test_full_deferred_queue_leaves_no_unanswered_message(client, monkeypatch):
+    headers = {"Authorization": "Bearer dummy-token"}
+    first = client.post("/api/chat", json={"message": "Hello"}, headers=headers).json()
+
+    def generate(profile, history):
+        raise server.gapi_exceptions.ResourceExhausted("quota exceeded")
+
+    monkeypatch.setattr(server, "generate_chat_with_rotation", generate, raising=False)
+    monkeypatch.setattr(server, "FALLBACK_MODEL_NAME", "", raising=False)
+    monkeypatch.setattr(server.deferred_replies, "max_jobs", 0)
+
+    res = client.post("/api/chat", json={"message": "Plan my dinner", "conversation_id": first["conversation_id"]}, headers=headers)
+    assert res.status_code == 503
+    assert res.headers["retry-after"]
+
+    messages = client.get(f"/api/conversations/{first['conversation_id']}/messages", headers=headers).json()
+    assert [m["parts"][0] for m in messages] == ["Hello", "stubbed model reply"]
+
+
+def test_reply_is_deferred_when_no_tier_has_capacity(client, monkeypatch):
+    headers = {"Authorization": "Bearer dummy-token"}
+    capacity = {"available": False}
+
+    def generate(profile, history):
+        if not capacity["available"]:
+            raise server.gapi_exceptions.ResourceExhausted("quota exceeded")
+        return DummyResponse("reply after the rush")
+
+    monkeypatch.setattr(server, "generate_chat_with_rotation", generate, raising=False)
+    monkeypatch.setattr(server, "FALLBACK_MODEL_NAME", "", raising=False)
+
+    res = client.post("/api/chat", json={"message": "Plan my dinner"}, headers=headers)
+    assert res.status_code == 202
+    job = res.json()
+    assert job["status"] == "queued"
+    assert res.headers["location"] == f"/api/chat/jobs/{job['job_id']}"
+
+    server.deferred_replies.run_due()
+    assert client.get(f"/api/chat/jobs/{job['job_id']}", headers=headers).json()["status"] == "queued"
+
+    capacity["available"] = True
+    server.record_message("test-user-id", job["conversation_id"], "user", "Written after the job was queued")
+    seen = []
+    monkeypatch.setattr(server, "generate_chat_with_rotation", lambda profile, history: seen.append(history) or generate(profile, history), raising=False)
+    server.deferred_replies.run_due()
+    done = client.get(f"/api/chat/jobs/{job['job_id']}", headers=headers).json()
+    assert done["status"] == "done"
+    assert done["result"]["reply"] == "reply after the rush"
+
+    lines = [json.loads(line) for line in client.get(f"/api/chat/jobs/{job['job_id']}/stream", headers=headers).text.splitlines()]
+    assert [line["type"] for line in lines] == ["deferred", "done"]
+    messages = client.get(f"/api/conversations/{job['conversation_id']}/messages", headers=headers).json()
+    assert [m["role"] for m in messages] == ["user", "user", "model"]
+    # The job answers the conversation as it was when it was queued.
+    assert [turn["parts"][0] for turn in seen[0]] == ["Plan my dinner"]
+
+
+def _receive_until_done(ws, count):
+    frames, done = [], 0
+    while done < count:
+        frame = ws.receive_json()
+        frames.append(frame)
+        done += frame["type"] in ("done", "error")
+    return frames
+
+
+def test_websocket_multiplexes_conversations_and_pushes_profile_updates(client, monkeypatch):
+    monkeypatch.setattr(server, "verify_token", lambda token: {"sub": "test-user-id"}, raising=False)
+
+    def fake_stream(profile, history):
+        yield "<p>Reply to "
+        yield history[-1]["parts"][0] + "</p>"
+
+    monkeypatch.setattr(server, "stream_chat_with_rotation", fake_stream, raising=False)
+
+    with client.websocket_connect("/api/ws") as ws:
+        ws.send_json({"type": "auth", "token": "dummy-token"})
+        assert ws.receive_json()["type"] == "ready"
+
+        ws.send_json({"type": "chat", "id": "a", "message": "I want to bulk"})
+        ws.send_json({"type": "chat", "id": "b", "message": "Snack ideas"})
+        # The profile event is pushed while turn "a" stores its reply, so it arrives before both `done` frames.
+        frames = _receive_until_done(ws, 2)
+
+    done = {frame["id"]: frame for frame in frames if frame["type"] == "done"}
+    assert done["a"]["reply"] == "<p>Reply to I want to bulk</p>"
+    assert done["b"]["reply"] == "<p>Reply to Snack ideas</p>"
+    assert done["a"]["conversation_id"] != done["b"]["conversation_id"]
+    assert {frame["id"] for frame in frames if frame["type"] == "delta"} == {"a", "b"}
+    [profile_event] = [frame for frame in frames if frame["type"] == "profile"]
+    assert profile_event["changed"] == ["fitness_goals"]
+    assert profile_event["profile"]["fitness_goals"] == "gain muscle"
+
+
+def test_websocket_rejects_bad_auth_and_limits_inflight_chats(client, monkeypatch):
+    def verify(token):
+        if token != "good":
+            raise server.HTTPException(status_code=401, detail="bad token")
+        return {"sub": "test-user-id"}
+
+    monkeypatch.setattr(server, "verify_token", verify, raising=False)
+    monkeypatch.setattr(server, "WS_MAX_INFLIGHT", 1, raising=False)
+    release = server.threading.Event()
+
+    def slow_stream(profile, history):
+        release.wait(5)
+        yield "<p>ok</p>"
+
+    monkeypatch.setattr(server, "stream_chat_with_rotation", slow_stream, raising=False)
+
+    with client.websocket_connect("/api/ws", headers={"Authorization": "Bearer nope"}) as ws:
+        assert ws.receive_json() == {"type": "error", "status": 401, "detail": "bad token"}
+
+    with client.websocket_connect("/api/ws", headers={"Authorization": "Bearer good"}) as ws:
+        assert ws.receive_json()["max_inflight"] == 1
+        ws.send_json({"type": "chat", "id": "first", "message": "Plan lunch"})
+        ws.send_json({"type": "chat", "id": "second", "message": "Plan dinner"})
+        rejected = ws.receive_json()
+        assert (rejected["id"], rejected["type"], rejected["status"]) == ("second", "error", 429)
+        release.set()
+        frames = _receive_until_done(ws, 1)
+        assert frames[-1]["id"] == "first" and frames[-1]["type"] == "done"
@@ -0,0 +1,98 @@
+from backend.deferred import DONE, FAILED, QUEUED, CapacityUnavailable, DeferredQueue
+from backend.shared_state import MemoryState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_job_retries_with_backoff_until_capacity_returns():
+    clock = FakeClock()
+    outcomes = [CapacityUnavailable("busy"), CapacityUnavailable("busy"), {"reply": "ok"}]
+
+    def work(job):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    deferred = DeferredQueue(work, retry_delay=5, max_retry_delay=8, clock=clock, autostart=False)
+    job = deferred.submit("u1", "c1", "hello")
+    assert deferred.run_due() == 0
+
+    clock.now = 5
+    assert deferred.run_due() == 1
+    job = deferred.get(job.id, "u1")
+    assert job.status == QUEUED and job.next_attempt_at == 5 + 8
+
+    clock.now = 13
+    deferred.run_due()
+    assert deferred.get(job.id, "u1").status == QUEUED
+    clock.now = 21
+    deferred.run_due()
+
+    job = deferred.get(job.id, "u1")
+    assert job.status == DONE and job.finished
+    assert job.public() == {"job_id": job.id, "status": DONE, "conversation_id": "c1", "attempts": 3, "result": {"reply": "ok"}}
+    assert deferred.snapshot() == {"submitted": 1, "retries": 2, "completed": 1, "waiting": 0}
+
+
+def test_jobs_expire_fail_and_are_private():
+    clock = FakeClock()
+
+    def work(job):
+        if job.message == "boom":
+            raise ValueError("bad request")
+        raise CapacityUnavailable("busy")
+
+    deferred = DeferredQueue(work, max_jobs=2, retry_delay=1, max_age=3, ttl_seconds=10, clock=clock, autostart=False)
+    waiting = deferred.submit("u1", "c1", "hello")
+    failing = deferred.submit("u1", "c2", "boom")
+    assert deferred.get(waiting.id, "u2") is None
+
+    for clock.now in (1, 3, 7):
+        deferred.run_due()
+    failing = deferred.get(failing.id, "u1")
+    waiting = deferred.get(waiting.id, "u1")
+    assert failing.status == FAILED and failing.error == "bad request"
+    assert waiting.status == FAILED and waiting.error.startswith("Gave up waiting for capacity")
+
+
+def test_jobs_are_shared_between_workers_and_survive_a_restart():
+    clock = FakeClock()
+    state = MemoryState()
+    ran = []
+
+    def work(job):
+        ran.append(job.history)
+        return {"reply": "ok"}
+
+    accepting = DeferredQueue(work, retry_delay=1, clock=clock, autostart=False, state=state)
+    job = accepting.submit("u1", "c1", "hello", history=[{"role": "user", "parts": ["hello"]}])
+
+    # Another process (or this one after a restart) sees the job, runs it, and answers polls for it.
+    other = DeferredQueue(work, retry_delay=1, clock=clock, autostart=False, state=state)
+    assert other.get(job.id, "u1").status == QUEUED
+    clock.now = 1
+    assert other.run_due() == 1
+    assert accepting.run_due() == 0
+    assert ran == [[{"role": "user", "parts": ["hello"]}]]
+    assert accepting.wait(job, 0).result == {"reply": "ok"}
+
+
+def test_claim_of_a_worker_that_died_lapses():
+    clock = FakeClock()
+    state = MemoryState(clock=clock)
+    deferred = DeferredQueue(lambda job: {"reply": "ok"}, retry_delay=0, clock=clock, autostart=False, state=state, lease_seconds=30)
+    job = deferred.submit("u1", "c1", "hello")
+    # Claimed by a worker that never finished it.
+    assert deferred._claim(clock(), set()).id == job.id
+    assert deferred.run_due() == 0
+
+    clock.now = 31
+    assert deferred.run_due() == 1
+    assert deferred.get(job.id, "u1").status == DONE
@@ -0,0 +1,85 @@
+import gzip
+import json
+
+from backend.archive import compact_conversation
+from backend.export import encode_lines, export_records, gzip_chunks, iter_messages
+
+
+def _message(i, conversation_id="conv-1", created_at=None):
+    return {
+        "id": f"m{i:03d}",
+        "conversation_id": conversation_id,
+        "role": "user" if i % 2 == 0 else "model",
+        "content": f"message {i}",
+        "created_at": created_at or f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}+00:00",
+        "user_id": None,
+    }
+
+
+def _seed(fake_supabase, conversations, messages):
+    fake_supabase.tables["conversations"] = [
+        {"id": cid, "user_id": "u1", "title": cid, "created_at": "t", "updated_at": "t", "last_message_preview": None}
+        for cid in conversations
+    ] + [{"id": "other", "user_id": "u2", "title": "not mine", "created_at": "t", "updated_at": "t"}]
+    fake_supabase.tables["messages"] = messages
+
+
+class CountingSupabase:
+    """Records the largest number of rows any single read returned."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.largest_read = 0
+
+    def table(self, name):
+        query = self.inner.table(name)
+        execute = query.execute
+
+        def counted():
+            response = execute()
+            self.largest_read = max(self.largest_read, len(response.data))
+            return response
+
+        query.execute = counted
+        return query
+
+
+def test_export_streams_every_conversation_and_message_in_pages(fake_supabase):
+    _seed(fake_supabase, [f"conv-{n}" for n in range(1, 8)], [_message(i) for i in range(130)])
+    compact_conversation(fake_supabase, "conv-1", live_window=60, chunk_size=50, min_batch=10)
+    client = CountingSupabase(fake_supabase)
+
+    records = list(export_records(client, "u1", {"user_id": "u1", "fitness_goals": "cut"}, page_size=3))
+
+    assert [r["type"] for r in records[:3]] == ["export", "profile", "conversation"]
+    assert [r["id"] for r in records if r["type"] == "conversation"] == [f"conv-{n}" for n in range(1, 8)]
+    messages = [r for r in records if r["type"] == "message"]
+    assert [m["id"] for m in messages] == [f"m{i:03d}" for i in range(130)]
+    assert records[-1] == {"type": "end", "conversations": 7, "messages": 130}
+    # No read returns more than a page (an archive blob is a single row).
+    assert client.largest_read == 3
+
+
+def test_messages_are_exported_once_across_archives_ties_and_pending(fake_supabase):
+    rows = [_message(i) for i in range(10)]
+    # Several messages sharing one timestamp, more than a page of them.
+    rows += [_message(i, created_at="2024-01-01T00:01:00+00:00") for i in range(10, 15)]
+    fake_supabase.tables["messages"] = rows
+    compact_conversation(fake_supabase, "conv-1", live_window=5, chunk_size=4, min_batch=1)
+    # An interrupted compaction leaves archived rows in the hot table as well.
+    fake_supabase.tables["messages"].append(_message(0))
+    pending = [_message(20, created_at="2024-01-01T00:02:00+00:00"), _message(14, created_at="2024-01-01T00:01:00+00:00")]
+
+    exported = [row["id"] for row in iter_messages(fake_supabase, "conv-1", page_size=2, pending=pending)]
+
+    assert exported == [f"m{i:03d}" for i in range(15)] + ["m020"]
+
+
+def test_gzip_stream_round_trips(fake_supabase):
+    _seed(fake_supabase, ["conv-1"], [_message(i) for i in range(40)])
+    plain = b"".join(encode_lines(export_records(fake_supabase, "u1"), chunk_bytes=256))
+    compressed = b"".join(gzip_chunks(encode_lines(export_records(fake_supabase, "u1"), chunk_bytes=256)))
+
+    assert gzip.decompress(compressed).split(b"\n")[1:] == plain.split(b"\n")[1:]
+    lines = [json.loads(line) for line in plain.splitlines()]
+    assert lines[-1]["messages"] == 40
@@ -0,0 +1,114 @@
+from backend.format_validator import (
+    GROCERY_LIST,
+    RECIPE,
+    FormatStats,
+    check_reply,
+    validate_recipe_text,
+    validate_reply,
+)
+
+
+def recipe_html(name="Chicken Rice Bowl", servings="2", fats="<li>Fats: 12 g</li>"):
+    return (
+        f"<section><h3>Recipe: {name}</h3>"
+        "<p><strong>Ingredients:</strong></p><ul><li>200 g chicken breast</li><li>1 cup rice</li></ul>"
+        "<p><strong>Instructions:</strong></p><ol><li>Cook the rice.</li><li>Grill the chicken.</li></ol>"
+        f"<p>Time: 25 minutes</p><p>Servings: {servings}</p><p>Estimated Calories Per Serving: 450</p>"
+        f"<p>Macros (per serving):</p><ul><li>Protein: 35 g</li><li>Carbs: 45 g</li>{fats}</ul></section>"
+    )
+
+
+GROCERY_HTML = (
+    "<h2>Grocery List</h2>"
+    "<h3>Proteins:</h3><ul><li>chicken breast (400 g)</li></ul>"
+    "<h3>Carbohydrates:</h3><ul><li>rice (2 cups)</li></ul>"
+    "<h3>Vegetables:</h3><ul><li>broccoli (1 head)</li></ul>"
+    "<h3>Fruits:</h3><ul><li>banana (3)</li></ul>"
+    "<h3>Pantry:</h3><ul><li>olive oil (1 bottle)</li></ul>"
+    "<h3>Other:</h3><ul><li>foil (1 roll)</li></ul>"
+)
+
+
+def test_valid_recipe_and_grocery_list_pass():
+    report = validate_reply("<p>Here you go!</p>" + recipe_html() + GROCERY_HTML)
+    assert [section.kind for section in report.sections] == [RECIPE, GROCERY_LIST]
+    assert report.ok
+
+
+def test_recipe_problems_are_named():
+    text = "Recipe: Oats\nIngredients:\n1 cup oats\nInstructions:\nSimmer.\nTime: 10 minutes\nServings: 1\nProtein: 10 g\n"
+    problems = validate_recipe_text(text)
+    assert "missing Estimated Calories Per Serving" in problems
+    assert "missing Fats" in problems
+    assert "no ingredients listed" not in problems
+
+
+def test_time_accepts_common_units():
+    base = "Recipe: Oats\nIngredients:\n1 cup oats\nInstructions:\nSimmer.\nTime: {}\n"
+    for value in ("10 mins", "10 min", "25 minutes", "1 hour", "1.5 hours", "2 hrs", "1 hr 15 mins"):
+        assert "missing Time" not in validate_recipe_text(base.format(value)), value
+    assert "missing Time" in validate_recipe_text(base.format("a while"))
+
+
+def test_meal_plan_checks_meals_and_snacks():
+    reply = (
+        "<h2>Meal Plan: Monday</h2><h3>Breakfast:</h3>" + recipe_html("Oats")
+        + "<h3>Lunch:</h3>" + recipe_html("Bowl") + "<h3>Snack:</h3><p>Apple</p>"
+    )
+    report = validate_reply(reply)
+    assert "missing Dinner" in report.meal_plan_problems
+    assert "includes snacks" in report.meal_plan_problems
+    assert "missing Estimated Daily Calories" in report.meal_plan_problems
+
+
+def test_repair_regenerates_only_the_broken_recipe():
+    good = recipe_html("Oats")
+    broken = recipe_html("Bowl", fats="")
+    reply = f"<div><p>Two ideas:</p>{good}{broken}</div><p>Enjoy!</p>"
+    prompts = []
+
+    def regenerate(prompt):
+        prompts.append(prompt)
+        return recipe_html("Bowl")
+
+    stats = FormatStats()
+    repaired = check_reply(reply, "repair", regenerate, stats)
+
+    assert len(prompts) == 1
+    assert "missing Fats" in prompts[0] and "Recipe: Bowl" in prompts[0] and "Recipe: Oats" not in prompts[0]
+    assert repaired.startswith(f"<div><p>Two ideas:</p>{good}")
+    assert validate_reply(repaired).ok
+    assert repaired.endswith("</div><p>Enjoy!</p>")
+    assert repaired.count("</div>") == 1
+    snapshot = stats.snapshot()
+    assert snapshot["sections_repaired"] == 1
+    assert snapshot["tokens_saved"] > 0
+
+
+def test_failed_repair_keeps_original_and_check_mode_never_regenerates():
+    reply = recipe_html(fats="")
+    stats = FormatStats()
+    assert check_reply(reply, "repair", lambda prompt: "Sorry, I can't.", stats) == reply
+    assert stats.snapshot()["repair_failures"] == 1
+
+    def fail(prompt):
+        raise AssertionError("check mode must not regenerate")
+
+    assert check_reply(reply, "check", fail, stats) == reply
+    assert stats.snapshot()["replies_invalid"] == 2
+
+
+def test_labels_mentioned_in_prose_are_not_sections():
+    reply = (
+        "<p>Aim for 30 g of protein at breakfast. Let me know if you'd like a Grocery List for the week,"
+        " or a <strong>Recipe:</strong> for overnight oats.</p>"
+        "Or just reply with Grocery List and I'll make one."
+    )
+    assert validate_reply(reply).sections == []
+
+    def fail(prompt):
+        raise AssertionError("nothing to repair")
+
+    stats = FormatStats()
+    assert check_reply(reply, "repair", fail, stats) == reply
+    assert stats.snapshot().get("replies_invalid", 0) == 0
@@ -1,6 +1,8 @@
 import pytest
 
 import backend.server as server
+from backend.shared_state import MemoryState
+from backend.usage import UsageMeter
 from google.api_core import exceptions as gapi_exceptions
 
 
@@ -21,6 +23,15 @@ def reset_keys(monkeypatch):
 
     # Don't actually configure the real client during tests.
     monkeypatch.setattr(server, "_configure_genai", lambda: None, raising=False)
+    monkeypatch.setattr(server, "_configure_key", lambda key_index: None, raising=False)
+
+    # Fresh circuit breakers and hedging off unless a test opts in.
+    monkeypatch.setattr(server, "key_breakers", server.BreakerRegistry(3, 30), raising=False)
+    monkeypatch.setattr(server, "GEMINI_HEDGE_ENABLED", False, raising=False)
+    # Fresh shared cursor; no cross-request key cooldown unless a test opts in.
+    monkeypatch.setattr(server, "shared_state", MemoryState(), raising=False)
+    monkeypatch.setattr(server, "GEMINI_KEY_COOLDOWN_SECONDS", 0, raising=False)
+    monkeypatch.setattr(server, "usage_meter", UsageMeter(lambda rows: None, server.shared_state), raising=False)
 
     yield
 
@@ -219,3 +230,309 @@ def test_profile_updates_all_fail_returns_empty(monkeypatch):
     assert updates == {}
     assert call_counter["n"] == len(server.GEMINI_API_KEYS)
     assert len(rotate_calls) == len(server.GEMINI_API_KEYS)
+
+
+def test_open_breaker_skips_key(monkeypatch):
+    """
+    A key whose breaker is open is skipped without a call; the request goes
+    to the next key instead.
+    """
+    monkeypatch.setattr(server, "key_breakers", server.BreakerRegistry(1, 60), raising=False)
+    server.key_breakers.get(0).record_failure()
+
+    used_keys = []
+
+    def fake_conversation_model(profile):
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                used_keys.append(server._current_key_index)
+                return DummyResponse("ok")
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+
+    response = server.generate_chat_with_rotation({}, [])
+
+    assert response.text == "ok"
+    assert used_keys == [1]
+    assert server.key_breakers.get(0).state == "open"
+
+
+def test_hedged_request_takes_faster_key(monkeypatch):
+    """
+    With hedging on, a primary attempt slower than the deadline is raced by a
+    second key; the faster answer wins and the slow key is marked as failing.
+    """
+    import threading
+    import time
+
+    monkeypatch.setattr(server, "GEMINI_HEDGE_ENABLED", True, raising=False)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 0.05, raising=False)
+    monkeypatch.setattr(server, "key_breakers", server.BreakerRegistry(1, 60), raising=False)
+
+    release_slow = threading.Event()
+    configured = threading.local()
+
+    def fake_configure_key(key_index):
+        configured.key = key_index
+
+    def fake_conversation_model(profile):
+        key_index = configured.key
+
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                if key_index == 0:
+                    release_slow.wait(5)
+                    return DummyResponse("slow")
+                return DummyResponse("fast")
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "_configure_key", fake_configure_key, raising=False)
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+
+    started = time.monotonic()
+    response = server.generate_chat_with_rotation({}, [])
+    release_slow.set()
+
+    assert response.text == "fast"
+    assert time.monotonic() - started < 2
+    assert server.key_breakers.get(0).state == "open"
+    assert server.key_breakers.get(1).state == "closed"
+
+
+def test_hedge_loser_tokens_are_recorded_when_it_finishes(monkeypatch):
+    import threading
+
+    monkeypatch.setattr(server, "GEMINI_HEDGE_ENABLED", True, raising=False)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 0.05, raising=False)
+    release_slow = threading.Event()
+    slow_done = threading.Event()
+    configured = threading.local()
+
+    class Usage:
+        prompt_token_count = 100
+        candidates_token_count = 10
+
+    def fake_configure_key(key_index):
+        configured.key = key_index
+
+    def fake_conversation_model(profile):
+        key_index = configured.key
+
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                if key_index == 0:
+                    release_slow.wait(5)
+                response = DummyResponse("slow" if key_index == 0 else "fast")
+                response.usage_metadata = Usage()
+                return response
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "_configure_key", fake_configure_key, raising=False)
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+
+    with server.usage_scope("user-1", "conv-1"):
+        response = server.generate_chat_with_rotation({}, [])
+    assert response.text == "fast"
+    assert server.usage_meter.used_today("user-1") == 110
+
+    original = server._record_hedge_loser
+
+    def tracking(future, key_index, context):
+        original(future, key_index, context)
+        slow_done.set()
+
+    monkeypatch.setattr(server, "_record_hedge_loser", tracking, raising=False)
+    release_slow.set()
+    assert slow_done.wait(5)
+    assert server.usage_meter.used_today("user-1") == 220
+    assert server.usage_meter.key_tokens_today(2) == {0: 110, 1: 110}
+
+
+def test_hedged_key_claims_advance_the_shared_cursor(monkeypatch):
+    monkeypatch.setattr(server, "GEMINI_HEDGE_ENABLED", True, raising=False)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 5.0, raising=False)
+
+    def fake_conversation_model(profile):
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                return DummyResponse("ok")
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+    server.generate_chat_with_rotation({}, [])
+    server.generate_chat_with_rotation({}, [])
+
+    assert server.shared_state.get("key_cursor") == 2
+    assert server.shared_state.key_usage(2) == {0: 1, 1: 1}
+
+
+def test_non_key_error_releases_the_half_open_probe(monkeypatch):
+    monkeypatch.setattr(server, "key_breakers", server.BreakerRegistry(1, 0), raising=False)
+    server.key_breakers.get(0).record_failure()
+
+    def behavior_bad_request(call_index):
+        raise ValueError("invalid argument")
+
+    _setup_fake_conversation_model(monkeypatch, [behavior_bad_request])
+    with pytest.raises(ValueError):
+        server.generate_chat_with_rotation({}, [])
+    assert server.key_breakers.get(0).allow()
+
+
+def test_abandoned_stream_releases_the_half_open_probe(monkeypatch):
+    monkeypatch.setattr(server, "key_breakers", server.BreakerRegistry(1, 0), raising=False)
+    server.key_breakers.get(0).record_failure()
+
+    class Chunk:
+        def __init__(self, text):
+            self.text = text
+
+    def fake_conversation_model(profile):
+        class FakeModel:
+            def generate_content(self, history, generation_config=None, stream=False):
+                return iter([Chunk("a"), Chunk("b")])
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+    stream = server.stream_chat_with_rotation({}, [])
+    assert next(stream) == "a"
+    stream.close()
+    assert server.key_breakers.get(0).allow()
+
+
+def test_hedged_request_fails_over_on_quota(monkeypatch):
+    monkeypatch.setattr(server, "GEMINI_HEDGE_ENABLED", True, raising=False)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 5.0, raising=False)
+
+    def behavior_fail_first(call_index):
+        if call_index == 1:
+            raise gapi_exceptions.ResourceExhausted("quota exceeded")
+        return DummyResponse("ok after failover")
+
+    call_counter, _ = _setup_fake_conversation_model(monkeypatch, [behavior_fail_first])
+
+    response = server.generate_chat_with_rotation({}, [])
+
+    assert response.text == "ok after failover"
+    assert call_counter["n"] == 2
+
+
+def test_quota_error_cools_key_down_for_other_requests(monkeypatch):
+    """
+    A quota error puts the key into a shared cooldown, so the next request
+    (from any worker) goes straight to another key.
+    """
+    monkeypatch.setattr(server, "GEMINI_KEY_COOLDOWN_SECONDS", 60, raising=False)
+    used_keys = []
+
+    def fake_conversation_model(profile):
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                used_keys.append(server._current_key_index)
+                if server._current_key_index == 0:
+                    raise gapi_exceptions.ResourceExhausted("quota exceeded")
+                return DummyResponse("ok")
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+
+    assert server.generate_chat_with_rotation({}, []).text == "ok"
+    monkeypatch.setattr(server, "_current_key_index", 0, raising=False)
+    assert server.generate_chat_with_rotation({}, []).text == "ok"
+
+    assert used_keys == [0, 1, 1]
+    assert server.shared_state.cooldown_remaining("key:0") > 0
+    assert server.shared_state.key_usage(2) == {0: 1, 1: 2}
+
+
+def test_usage_metadata_is_recorded_per_key(monkeypatch):
+    class Usage:
+        prompt_token_count = 120
+        candidates_token_count = 30
+
+    def fake_conversation_model(profile):
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                response = DummyResponse("ok")
+                response.usage_metadata = Usage()
+                return response
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+    with server.usage_scope("user-1", "conv-1"):
+        server.generate_chat_with_rotation({}, [])
+
+    assert server.usage_meter.used_today("user-1") == 150
+    assert server.usage_meter.key_tokens_today(2) == {0: 150, 1: 0}
+    [row] = server.usage_meter.pending_rows("user-1")
+    assert (row["conversation_id"], row["key_index"], row["kind"]) == ("conv-1", 0, "chat")
+
+
+def test_fallback_tier_runs_when_every_key_is_out_of_quota(monkeypatch):
+    monkeypatch.setattr(server, "FALLBACK_MODEL_NAME", "gemini-lite", raising=False)
+    monkeypatch.setattr(server, "GEMINI_KEY_COOLDOWN_SECONDS", 30, raising=False)
+    models = []
+
+    def fake_conversation_model(profile):
+        class FakeModel:
+            def generate_content(self, history, generation_config=None):
+                models.append(server.active_model())
+                if server.active_model() == server.MODEL:
+                    raise gapi_exceptions.ResourceExhausted("quota exceeded")
+                return DummyResponse("lite reply")
+
+        return FakeModel()
+
+    monkeypatch.setattr(server, "conversation_model", fake_conversation_model, raising=False)
+
+    assert server.generate_reply({}, []) == ("lite reply", "gemini-lite")
+    assert models == [server.MODEL, server.MODEL, "gemini-lite"]
+    # Cooldowns are per model: the primary tier is cooling down, the fallback tier is not.
+    assert server.shared_state.cooldown_remaining("key:0") > 0
+    assert server.shared_state.cooldown_remaining("key:0:gemini-lite") == 0
+
+    # With the primary keys cooling down, the next reply goes straight to the fallback tier.
+    assert server.generate_reply({}, []) == ("lite reply", "gemini-lite")
+    assert models[3:] == ["gemini-lite"]
+
+
+def test_generate_reply_raises_when_no_tier_has_capacity(monkeypatch):
+    monkeypatch.setattr(server, "FALLBACK_MODEL_NAME", "", raising=False)
+
+    def fail(_i):
+        raise gapi_exceptions.ResourceExhausted("quota exceeded")
+
+    _setup_fake_conversation_model(monkeypatch, [fail])
+    with pytest.raises(gapi_exceptions.ResourceExhausted):
+        server.generate_reply({}, [])
+
+
+def test_reply_prompt_carries_only_the_formats_the_turn_needs(monkeypatch):
+    instructions = []
+
+    class FakeGenerativeModel:
+        def __init__(self, model_name, system_instruction=None):
+            instructions.append(system_instruction)
+
+        def generate_content(self, history, generation_config=None):
+            return DummyResponse("ok")
+
+    monkeypatch.setattr(server.genai, "GenerativeModel", FakeGenerativeModel)
+    monkeypatch.setattr(server, "PROMPT_SECTIONS_MODE", "on", raising=False)
+
+    server.generate_reply({}, [{"role": "user", "parts": ["How much water should I drink?"]}])
+    server.generate_reply({}, [{"role": "user", "parts": ["Give me a recipe for lentil soup"]}])
+    # Section repairs outside a reply get the full prompt.
+    server.regenerate_section({}, "Rewrite this grocery list")
+
+    assert "Recipe Format" not in instructions[0]
+    assert "Recipe Format" in instructions[1] and "Grocery List Format" not in instructions[1]
+    assert instructions[2].startswith(server.SYSTEM_PROMPT)
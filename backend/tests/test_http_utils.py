@@ -0,0 +1,46 @@
+import gzip
+import json
+
+from starlette.requests import Request
+
+from backend.http_utils import brotli, choose_encoding, etag_matches, json_response, make_etag
+
+
+def test_make_etag_is_weak_and_stable():
+    etag = make_etag("messages", "conv-1", "2024-01-01T00:00:00+00:00")
+    assert etag.startswith('W/"')
+    assert etag == make_etag("messages", "conv-1", "2024-01-01T00:00:00+00:00")
+    assert etag != make_etag("messages", "conv-1", "2024-01-01T00:00:01+00:00")
+
+
+def test_etag_matches_lists_and_weak_forms():
+    etag = make_etag("x")
+    strong = etag[2:]
+    assert etag_matches(etag, etag)
+    assert etag_matches(strong, etag)
+    assert etag_matches(f'"other", {etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches(None, etag)
+    assert not etag_matches('"other"', etag)
+
+
+def test_choose_encoding_prefers_brotli_and_honours_q0():
+    assert choose_encoding("gzip, deflate, br") == ("br" if brotli is not None else "gzip")
+    assert choose_encoding("br;q=0, gzip") == "gzip"
+    assert choose_encoding("identity") is None
+    assert choose_encoding(None) is None
+
+
+def test_json_response_compresses_above_threshold():
+    scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+    request = Request(scope)
+    payload = [{"role": "model", "parts": ["<p>meal plan</p>" * 200]}]
+
+    response = json_response(request, payload, min_size=1024)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(response.body)) == payload
+
+    small = json_response(request, {"ok": True}, min_size=1024)
+    assert "content-encoding" not in small.headers
+    assert json.loads(small.body) == {"ok": True}
@@ -0,0 +1,153 @@
+import threading
+
+import pytest
+
+from backend.idempotency import IdempotencyConflict, IdempotencyStore
+from backend.shared_state import MemoryState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_duplicate_after_completion_replays_result():
+    store = IdempotencyStore(ttl_seconds=60)
+    calls = []
+
+    def work():
+        calls.append(1)
+        return {"reply": "ok"}
+
+    assert store.run("k", "fp", work) == ({"reply": "ok"}, False)
+    assert store.run("k", "fp", work) == ({"reply": "ok"}, True)
+    assert len(calls) == 1
+
+
+def test_concurrent_duplicates_share_one_execution():
+    store = IdempotencyStore(ttl_seconds=60)
+    release = threading.Event()
+    started = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "reply"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(store.run("k", "fp", work)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(store.run("k", "fp", work, wait_timeout=5)))
+    follower.start()
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results, key=lambda r: r[1]) == [("reply", False), ("reply", True)]
+
+
+def test_different_fingerprint_conflicts():
+    store = IdempotencyStore(ttl_seconds=60)
+    store.run("k", "fp-1", lambda: "first")
+    with pytest.raises(IdempotencyConflict):
+        store.run("k", "fp-2", lambda: "second")
+
+
+def test_failures_are_not_stored():
+    store = IdempotencyStore(ttl_seconds=60)
+
+    def boom():
+        raise RuntimeError("quota")
+
+    with pytest.raises(RuntimeError):
+        store.run("k", "fp", boom)
+    assert store.run("k", "fp", lambda: "retried") == ("retried", False)
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    store = IdempotencyStore(ttl_seconds=10, clock=clock)
+    store.run("k", "fp", lambda: "first")
+    clock.now = 11
+    assert store.run("k", "fp", lambda: "second") == ("second", False)
+    store.run("other", "fp", lambda: "x")
+    clock.now = 30
+    store.run("third", "fp", lambda: "y")
+    assert len(store) == 1
+
+
+def test_in_flight_entry_does_not_block_the_size_bound():
+    store = IdempotencyStore(ttl_seconds=60, max_entries=2)
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    leader = threading.Thread(target=lambda: store.run("head", "fp", slow))
+    leader.start()
+    started.wait(5)
+    for n in range(5):
+        store.run(f"k{n}", "fp", lambda: n)
+    assert len(store) <= 3
+    release.set()
+    leader.join(5)
+
+
+def test_shared_state_replays_across_workers():
+    shared = MemoryState()
+    first, second = IdempotencyStore(ttl_seconds=60, state=shared), IdempotencyStore(ttl_seconds=60, state=shared)
+    calls = []
+
+    def work():
+        calls.append(1)
+        return {"reply": "ok"}
+
+    assert first.run(("u", "k", None), "fp", work) == ({"reply": "ok"}, False)
+    assert second.run(("u", "k", None), "fp", work) == ({"reply": "ok"}, True)
+    with pytest.raises(IdempotencyConflict):
+        second.run(("u", "k", None), "other", work)
+    assert len(calls) == 1
+
+
+def test_shared_state_waits_for_another_workers_run():
+    shared = MemoryState()
+    first = IdempotencyStore(ttl_seconds=60, state=shared)
+    second = IdempotencyStore(ttl_seconds=60, state=shared, poll_interval=0.01)
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "reply"
+
+    leader = threading.Thread(target=lambda: first.run("k", "fp", slow))
+    leader.start()
+    started.wait(5)
+    with pytest.raises(IdempotencyConflict):
+        second.run("k", "fp", slow, wait_timeout=0.05)
+    threading.Timer(0.05, release.set).start()
+    assert second.run("k", "fp", slow, wait_timeout=5) == ("reply", True)
+    leader.join(5)
+
+
+def test_shared_claim_is_released_when_the_run_fails():
+    shared = MemoryState()
+    first, second = IdempotencyStore(ttl_seconds=60, state=shared), IdempotencyStore(ttl_seconds=60, state=shared)
+
+    def boom():
+        raise RuntimeError("quota")
+
+    with pytest.raises(RuntimeError):
+        first.run("k", "fp", boom)
+    assert second.run("k", "fp", lambda: "retried") == ("retried", False)
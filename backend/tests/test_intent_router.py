@@ -0,0 +1,65 @@
+from backend.intent_router import (
+    ACKNOWLEDGEMENT,
+    MODEL,
+    OFF_TOPIC,
+    OFF_TOPIC_REPLY,
+    RouteDecision,
+    RouterStats,
+    classify_message,
+)
+
+
+def test_acknowledgements_are_answered_locally():
+    for message in ("Thanks!", "thank you so much", "Great, thanks :)", "ok thanks", "bye"):
+        decision = classify_message(message)
+        assert decision.intent == ACKNOWLEDGEMENT, message
+        assert decision.confidence >= 0.9
+
+
+def test_bare_ok_goes_to_model():
+    # "ok"/"yes" may be answering the model's question, so they are never routed.
+    assert classify_message("ok").intent == MODEL
+    assert classify_message("yes please").intent == MODEL
+
+
+def test_clear_off_topic_is_confident():
+    decision = classify_message("Can you write a python function to sort a list?")
+    assert decision.intent == OFF_TOPIC
+    assert decision.reply == OFF_TOPIC_REPLY
+    assert decision.confidence >= 0.9
+
+    assert classify_message("What is the capital of France?").confidence >= 0.9
+
+
+def test_food_words_always_go_to_model():
+    assert classify_message("What should I eat before football practice?").intent == MODEL
+    assert classify_message("Is salmon good for my weight goals?").intent == MODEL
+    assert classify_message("How do I make a chickpea curry?").intent == MODEL
+
+
+def test_weak_off_topic_signal_stays_below_threshold():
+    decision = classify_message("I watched a movie last night")
+    assert decision.intent == OFF_TOPIC
+    assert decision.confidence < 0.9
+
+
+def test_off_topic_words_alone_never_reach_the_threshold():
+    # Hobbies mentioned in passing are context for the model, not a request to refuse.
+    assert classify_message("I play football and basketball, help me plan meals").intent == MODEL
+    decision = classify_message("I play football, basketball and soccer on weekends, any tips for game day?")
+    assert decision.intent == OFF_TOPIC
+    assert decision.confidence < 0.9
+
+
+def test_router_stats_precision_and_recall():
+    stats = RouterStats()
+    routed = RouteDecision(OFF_TOPIC, 0.95, OFF_TOPIC_REPLY)
+    stats.record_shadow(routed, OFF_TOPIC_REPLY, 0.9)
+    stats.record_shadow(routed, "<p>Here is a recipe</p>", 0.9)
+    stats.record_shadow(RouteDecision(MODEL, 0.0), OFF_TOPIC_REPLY, 0.9)
+
+    snapshot = stats.snapshot()
+    assert snapshot["messages"] == 3
+    assert snapshot["off_topic_precision"] == 0.5
+    assert snapshot["off_topic_recall"] == 0.5
+    assert snapshot["off_topic_missed"] == 1
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+
+import pytest
+
+from backend import journal as journal_module
+from backend.journal import MESSAGE, TOUCH, MessageJournal, merge_pending, read_entries
+from backend.shared_state import MemoryState
+
+
+def message(entry_id, conversation_id="c1", created_at="2024-01-01T00:00:01+00:00"):
+    return {"op": MESSAGE, "id": entry_id, "conversation_id": conversation_id, "role": "model", "content": entry_id, "created_at": created_at}
+
+
+def test_flush_hands_batches_to_the_writer_and_empties_the_file(tmp_path):
+    batches = []
+    journal = MessageJournal(str(tmp_path), batches.append, batch_size=2, autostart=False)
+    journal.append(message("m1"), {"op": TOUCH, "id": "t1", "conversation_id": "c1"})
+    journal.append(message("m2", conversation_id="c2"))
+    assert [entry["id"] for entry in journal.pending("c1")] == ["m1"]
+
+    assert journal.flush() == 3
+    assert [[entry["id"] for entry in batch] for batch in batches] == [["m1", "t1"], ["m2"]]
+    assert len(journal) == 0 and os.path.getsize(journal.path) == 0
+
+
+def test_entries_of_a_process_that_died_are_replayed(tmp_path):
+    def failing(entries):
+        raise RuntimeError("supabase down")
+
+    crashed = MessageJournal(str(tmp_path), failing, batch_size=1, autostart=False)
+    crashed.append(message("m1"), message("m2"))
+    with pytest.raises(RuntimeError):
+        crashed.flush()
+    # Dies without flushing; its file lock goes with it.
+    crashed._file.close()
+
+    stored = []
+    restarted = MessageJournal(str(tmp_path), stored.extend, autostart=False)
+    assert [entry["id"] for entry in restarted.pending("c1")] == ["m1", "m2"]
+    restarted.flush()
+    assert [entry["id"] for entry in stored] == ["m1", "m2"]
+    assert os.listdir(tmp_path) == [os.path.basename(restarted.path)]
+
+
+def test_pending_entries_are_visible_to_other_workers_until_stored(tmp_path):
+    state = MemoryState()
+    writing = MessageJournal(str(tmp_path / "a"), lambda entries: None, autostart=False, state=state)
+    other = MessageJournal(str(tmp_path / "b"), lambda entries: None, autostart=False, state=state)
+    writing.append(message("m1"), {"op": TOUCH, "id": "t1", "conversation_id": "c1"})
+
+    assert [entry["id"] for entry in other.pending("c1")] == ["m1"]
+    assert [entry["id"] for entry in other.pending("c1", TOUCH)] == ["t1"]
+    writing.flush()
+    assert other.pending("c1") == [] and state.get_value("journal:pending:c1") is None
+
+
+def test_stored_batches_are_not_replayed(tmp_path):
+    calls = []
+
+    def writer(entries):
+        calls.append(entries)
+        if len(calls) > 1:
+            raise RuntimeError("supabase down")
+
+    journal = MessageJournal(str(tmp_path), writer, batch_size=1, autostart=False)
+    journal.append(message("m1"), message("m2"))
+    with pytest.raises(RuntimeError):
+        journal.flush()
+    assert [entry["id"] for entry in read_entries(journal.path)] == ["m2"]
+
+
+def test_concurrent_appends_share_fsyncs(tmp_path, monkeypatch):
+    fsyncs = []
+
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        time.sleep(0.01)
+
+    monkeypatch.setattr(journal_module.os, "fsync", slow_fsync)
+    journal = MessageJournal(str(tmp_path), lambda entries: None, autostart=False)
+    threads = [threading.Thread(target=journal.append, args=(message(f"m{n}"),)) for n in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(journal) == 20
+    assert len(fsyncs) < 20
+    assert len(read_entries(journal.path)) == 20
+
+
+def test_merge_pending_orders_by_time_and_skips_stored_entries():
+    rows = [
+        {"id": "u2", "role": "user", "content": "second question", "created_at": "2024-01-01T00:00:03+00:00"},
+        {"id": "u1", "role": "user", "content": "first question", "created_at": "2024-01-01T00:00:01+00:00"},
+    ]
+    pending = [message("m1", created_at="2024-01-01T00:00:02+00:00"), {**message("u2"), "created_at": "2024-01-01T00:00:03+00:00"}]
+    merged = merge_pending(rows, pending, limit=3)
+    assert [row["id"] for row in merged] == ["u2", "m1", "u1"]
+    assert [row["id"] for row in merge_pending(rows, pending, limit=2)] == ["u2", "m1"]
@@ -0,0 +1,93 @@
+import pytest
+
+from backend.nutrition import (
+    NutritionTable,
+    compute_recipe_nutrition,
+    parse_ingredient,
+    parse_recipes,
+    reconcile_reply,
+)
+import backend.nutrition as nutrition
+
+
+RECIPE_HTML = """
+<section>
+<h3>Recipe: Chicken Rice Bowl</h3>
+<p><strong>Ingredients:</strong></p>
+<ul>
+<li>200 g chicken breast, diced</li>
+<li>1 cup cooked rice</li>
+<li>1 tbsp olive oil</li>
+</ul>
+<p><strong>Instructions:</strong></p>
+<ol><li>Cook the chicken.</li><li>Serve over rice.</li></ol>
+<p>Time: 20 minutes</p>
+<p>Servings: 2</p>
+<p><strong>Estimated Calories Per Serving:</strong> 900</p>
+<ul>
+<li>Protein: 10 g</li>
+<li>Carbs: 10 g</li>
+<li>Fats: 10 g</li>
+</ul>
+</section>
+"""
+
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    table = NutritionTable(cache_dir=str(tmp_path))
+    monkeypatch.setattr(nutrition, "_table", table, raising=False)
+    return table
+
+
+def test_table_is_memory_mapped_from_cache(tmp_path):
+    NutritionTable(cache_dir=str(tmp_path))
+    reloaded = NutritionTable(cache_dir=str(tmp_path))
+    assert list(tmp_path.glob("nutrients-*.npy"))
+    assert reloaded.values.base is not None
+    assert reloaded.values.shape[1] == 4
+
+
+def test_lookup_prefers_longest_phrase(table):
+    assert table.names[table.lookup("red bell pepper, sliced")] == "bell pepper"
+    assert table.names[table.lookup("freshly ground black pepper")] == "black pepper"
+    assert table.lookup("unobtainium") is None
+
+
+def test_parse_ingredient_units(table):
+    grams, row = parse_ingredient("2 large eggs", table)
+    assert table.names[row] == "egg"
+    assert grams == pytest.approx(100)
+
+    grams, row = parse_ingredient("1 1/2 cups rolled oats", table)
+    assert table.names[row] == "oats"
+    assert grams == pytest.approx(121.5)
+
+    grams, _ = parse_ingredient("8 oz salmon fillet", table)
+    assert grams == pytest.approx(226.8)
+
+
+def test_compute_recipe_nutrition_batch(table):
+    recipes = parse_recipes(RECIPE_HTML, table)
+    assert len(recipes) == 1
+    assert recipes[0].servings == 2
+
+    [result] = compute_recipe_nutrition(recipes + recipes, table)[:1]
+    # 200 g chicken (330 kcal) + 158 g rice (205 kcal) + 13.5 g oil (119 kcal), halved
+    assert result["calories"] == pytest.approx(327, abs=2)
+    assert result["protein"] == pytest.approx(33.1, abs=0.1)
+    assert result["coverage"] == 1.0
+
+
+def test_reconcile_reply_overwrites_estimates(table):
+    updated = reconcile_reply(RECIPE_HTML, "overwrite")
+    assert "<strong>Estimated Calories Per Serving:</strong> 327" in updated
+    assert "Protein: 33.1 g" in updated
+    assert "Fats: 10 g" not in updated
+
+
+def test_reconcile_reply_leaves_partial_matches(table):
+    partial = RECIPE_HTML.replace("1 tbsp olive oil", "1 pinch unobtainium")
+    assert reconcile_reply(partial, "overwrite") == partial
+    assert reconcile_reply(RECIPE_HTML, "check") == RECIPE_HTML
+    assert reconcile_reply("Just drink water.", "overwrite") == "Just drink water."
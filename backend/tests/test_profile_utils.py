@@ -27,3 +27,19 @@ def test_diff_profile_ignores_same_values():
     current = {"fitness_goals": "Maintain", "dietary_restrictions": "vegan"}
     updates = {"fitness_goals": "Maintain", "dietary_restrictions": "vegan"}
     assert diff_profile(current, updates) == {}
+
+
+def test_parse_profile_update_structured_fields():
+    updates = parse_profile_update(
+        '{"fitness_goals": null, "allergens": ["Peanut", "shellfish", "peanut"], "diets": null, "calorie_target": "2100.4"}'
+    )
+    assert updates == {"allergens": ["peanut", "shellfish"], "calorie_target": 2100}
+    assert parse_profile_update('{"allergens": []}') == {"allergens": []}
+
+
+def test_structured_fields_in_context_and_diff():
+    profile = {"allergens": ["sesame"], "diets": ["vegan"], "protein_target_g": 140}
+    context = format_profile_context(profile)
+    assert "- Allergens (never include): sesame" in context
+    assert "- Daily Protein Target: 140 g" in context
+    assert diff_profile(profile, {"allergens": ["Sesame"], "diets": ["vegan", "halal"]}) == {"diets": ["vegan", "halal"]}
@@ -0,0 +1,70 @@
+import contextvars
+import threading
+import time
+
+from backend.profiling import RequestProfiler
+
+
+def spin(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_profile_writes_collapsed_stacks_of_the_calling_thread(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), interval=0.001, token="secret")
+    with profiler.profile("chat", True):
+        spin(0.05)
+
+    [name] = profiler.dumps()
+    assert "-chat-" in name and name.endswith("ms.folded")
+    stack, count = (tmp_path / name).read_text().splitlines()[0].rsplit(" ", 1)
+    # The busiest stack comes first and ends in the spinning function.
+    assert stack.split(";")[-1] == f"{spin.__module__}.spin"
+    assert int(count) > 0
+
+
+def test_dumps_are_kept_in_a_bounded_ring(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), max_files=2, interval=0.001, token="secret")
+    for _ in range(3):
+        with profiler.profile("chat", True):
+            spin(0.005)
+    assert len(profiler.dumps()) == 2
+
+    with profiler.profile("chat", False):
+        spin(0.005)
+    assert len(profiler.dumps()) == 2
+
+
+def test_only_the_admin_token_or_the_sample_rate_picks_a_request(tmp_path):
+    off = RequestProfiler(str(tmp_path))
+    assert not off.enabled and not off.wanted("anything")
+
+    admin = RequestProfiler(str(tmp_path), token="secret")
+    assert admin.wanted("secret")
+    assert not admin.wanted("guess") and not admin.wanted(None)
+
+    assert RequestProfiler(str(tmp_path), sample_rate=1.0).wanted(None)
+
+
+def test_threads_that_follow_the_request_are_sampled_too(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), interval=0.001, token="secret")
+
+    def worker():
+        with profiler.follow():
+            spin(0.05)
+
+    with profiler.profile("chat", True):
+        # Like the threads auth and the handler run on, the worker inherits the request's context.
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(worker,))
+        thread.start()
+        thread.join()
+
+    [name] = profiler.dumps()
+    leaves = [line.rsplit(" ", 1)[0].split(";")[-1] for line in (tmp_path / name).read_text().splitlines()]
+    assert f"{spin.__module__}.spin" in leaves
+
+    # Outside a profiled request, following costs nothing and records nothing.
+    with profiler.follow():
+        spin(0.001)
+    assert len(profiler.dumps()) == 1
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+from backend.realtime import CLOSE_TOO_SLOW, Outbox, Subscribers
+
+
+def test_outbox_delivers_in_order_and_drops_offers_when_full():
+    async def scenario():
+        outbox = Outbox(asyncio.get_running_loop(), limit=2)
+        assert outbox.offer({"n": 1}) and outbox.offer({"n": 2})
+        assert not outbox.offer({"n": 3})
+        sent = []
+
+        async def send(frame):
+            sent.append(frame["n"])
+
+        sender = outbox.start(send)
+        await outbox.put({"n": 4})
+        outbox.close()
+        await sender
+        return sent, outbox.dropped
+
+    assert asyncio.run(scenario()) == ([1, 2, 4], 1)
+
+
+def test_blocked_producer_closes_a_stuck_outbox():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        outbox = Outbox(loop, limit=1, send_timeout=0.05)
+        stuck = asyncio.Event()
+
+        async def send(frame):
+            await stuck.wait()
+
+        outbox.start(send)
+        results = []
+        worker = threading.Thread(target=lambda: results.extend(outbox.put_threadsafe({"n": n}) for n in range(3)))
+        worker.start()
+        while worker.is_alive():
+            await asyncio.sleep(0.01)
+        return results, outbox.closed, outbox.close_code
+
+    results, closed, code = asyncio.run(scenario())
+    # The first frame is being sent, the second fills the outbox, the third can't get in.
+    assert results == [True, True, False]
+    assert closed and code == CLOSE_TOO_SLOW
+
+
+def test_subscribers_fan_out_per_user():
+    subscribers = Subscribers()
+    received = []
+    unsubscribe = subscribers.subscribe("u1", received.append)
+    subscribers.subscribe("u2", lambda event: received.append(("u2", event)))
+
+    assert subscribers.publish("u1", {"type": "profile"}) == 1
+    unsubscribe()
+    assert subscribers.publish("u1", {"type": "profile"}) == 0
+    assert received == [{"type": "profile"}]
+    assert subscribers.connections() == 1
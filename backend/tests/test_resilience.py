@@ -0,0 +1,71 @@
+from backend.resilience import CircuitBreaker, LatencyTracker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_after_consecutive_failures_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, recovery_seconds=10, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    clock.now = 10
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    # Only one probe at a time while half-open.
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_half_open_probe_failure_reopens():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, recovery_seconds=5, clock=clock)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now = 6
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_latency_percentile_needs_min_samples():
+    tracker = LatencyTracker(window=100, min_samples=10)
+    for value in range(9):
+        tracker.record(float(value))
+    assert tracker.percentile(0.95) is None
+    tracker.record(9.0)
+    assert tracker.percentile(0.5) in (4.0, 5.0)
+    assert tracker.percentile(0.95) == 9.0
+
+
+def test_release_frees_the_half_open_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, recovery_seconds=5, clock=clock)
+    breaker.record_failure()
+    clock.now = 6
+    assert breaker.allow()
+    assert not breaker.allow()
+    # The probe ended with an error that says nothing about the key.
+    breaker.release()
+    assert breaker.allow()
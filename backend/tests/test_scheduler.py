@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from backend.scheduler import BACKGROUND, INTERACTIVE, FairScheduler, SchedulerOverloaded
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+def _queue_waiters(scheduler, requests):
+    """Start one thread per (user, priority), each recording the order it was admitted in."""
+    order = []
+    threads = []
+    for user_id, priority in requests:
+        def run(user_id=user_id, priority=priority):
+            ticket = scheduler.acquire(user_id, priority)
+            order.append(user_id)
+            scheduler.release(ticket)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        _wait_for(lambda n=len(threads): scheduler.stats()["queued"] == n)
+    return order, threads
+
+
+def test_per_user_inflight_cap():
+    scheduler = FairScheduler(capacity=4, per_user_limit=1, queue_timeout=0.05)
+    ticket = scheduler.acquire("alice")
+    with pytest.raises(SchedulerOverloaded):
+        scheduler.acquire("alice")
+    # Other users still get through.
+    other = scheduler.acquire("bob")
+    scheduler.release(other)
+    scheduler.release(ticket)
+
+
+def test_fair_queueing_interleaves_users():
+    scheduler = FairScheduler(capacity=1, per_user_limit=1, max_queue_per_user=4)
+    blocker = scheduler.acquire("warmup")
+    order, threads = _queue_waiters(
+        scheduler, [("heavy", INTERACTIVE), ("heavy", INTERACTIVE), ("heavy", INTERACTIVE), ("light", INTERACTIVE)]
+    )
+    scheduler.release(blocker)
+    for thread in threads:
+        thread.join(5)
+    # The light user's single request is not stuck behind the heavy user's whole backlog.
+    assert order.index("light") <= 1
+
+
+def test_interactive_before_background():
+    scheduler = FairScheduler(capacity=1, per_user_limit=2)
+    blocker = scheduler.acquire("warmup")
+    order, threads = _queue_waiters(scheduler, [("extract", BACKGROUND), ("chat", INTERACTIVE)])
+    scheduler.release(blocker)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["chat", "extract"]
+
+
+def test_queue_overflow_raises():
+    scheduler = FairScheduler(capacity=1, per_user_limit=1, max_queue=1, queue_timeout=5)
+    blocker = scheduler.acquire("warmup")
+    _, threads = _queue_waiters(scheduler, [("a", INTERACTIVE)])
+    with pytest.raises(SchedulerOverloaded):
+        scheduler.acquire("b")
+    scheduler.release(blocker)
+    for thread in threads:
+        thread.join(5)
+    assert scheduler.stats() == {"inflight": 0, "queued": 0, "capacity": 1}
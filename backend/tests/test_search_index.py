@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+from backend.search_index import SearchIndex, UserIndex, normalize_text, tokenize
+
+
+def test_tokenize_folds_accents_and_plurals():
+    assert tokenize(normalize_text("Jalapeños and <b>Berries</b>")) == ["jalapeno", "berry"]
+
+
+def test_bm25_prefers_denser_matches_and_strips_html():
+    index = UserIndex()
+    index.add("m1", "c1", "model", "<h3>Salmon bowl</h3><p>Salmon, rice and salmon roe.</p>", "t1")
+    index.add("m2", "c1", "model", "Chicken salad with a little salmon dressing and lots of greens", "t2")
+    index.add("m3", "c2", "user", "What should I eat before a run?", "t3")
+
+    results = index.search("salmon")
+    assert [hit["message_id"] for hit in results] == ["m1", "m2"]
+    assert "<" not in results[0]["snippet"]
+    assert results[0]["snippet"].startswith("Salmon bowl")
+
+
+def test_remove_conversation_clears_postings():
+    index = UserIndex()
+    index.add("m1", "c1", "user", "oat pancakes", None)
+    index.add("m2", "c2", "user", "oat porridge", None)
+    index.remove_conversation("c1")
+    assert [hit["message_id"] for hit in index.search("oats")] == ["m2"]
+    assert "pancake" not in index.postings
+    assert index.total_length == 2
+
+
+def test_search_loads_partition_once_then_updates_incrementally():
+    index = SearchIndex()
+    calls = []
+
+    def loader(user_id):
+        calls.append(user_id)
+        if user_id != "u1":
+            return []
+        return [{"id": "m1", "conversation_id": "c1", "role": "model", "content": "tofu scramble", "created_at": "t1"}]
+
+    index.add_message("u1", "c1", "ignored", "user", "tofu before load")
+    assert [hit["message_id"] for hit in index.search("u1", "tofu", loader)] == ["m1"]
+
+    index.add_message("u1", "c2", "m2", "user", "crispy tofu")
+    assert {hit["message_id"] for hit in index.search("u1", "tofu", loader)} == {"m1", "m2"}
+    assert index.search("u2", "tofu", loader) == []
+    assert calls == ["u1", "u2"]
+
+
+def test_writes_during_load_are_applied_after_it():
+    index = SearchIndex()
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader(user_id):
+        started.set()
+        release.wait(5)
+        yield {"id": "m1", "conversation_id": "c1", "role": "user", "content": "quinoa salad"}
+        yield {"id": "m2", "conversation_id": "c2", "role": "user", "content": "quinoa porridge"}
+
+    results = {}
+    worker = threading.Thread(target=lambda: results.setdefault("hits", index.search("u1", "quinoa", slow_loader)))
+    worker.start()
+    assert started.wait(5)
+    index.add_message("u1", "c3", "m3", "user", "quinoa bowl")
+    index.remove_conversation("u1", "c2")
+    release.set()
+    worker.join(5)
+
+    assert {hit["message_id"] for hit in results["hits"]} == {"m1", "m3"}
+
+
+def test_failed_load_is_retried_on_next_search():
+    index = SearchIndex()
+
+    def broken(user_id):
+        raise RuntimeError("db down")
+        yield
+
+    with pytest.raises(RuntimeError):
+        index.search("u1", "kale", broken)
+    rows = [{"id": "m1", "conversation_id": "c1", "role": "user", "content": "kale chips"}]
+    assert [hit["message_id"] for hit in index.search("u1", "kale", lambda user_id: rows)] == ["m1"]
+
+
+def test_least_recently_searched_partition_is_evicted():
+    index = SearchIndex(max_users=1)
+    calls = []
+
+    def loader(user_id):
+        calls.append(user_id)
+        return []
+
+    index.search("u1", "egg", loader)
+    index.search("u2", "egg", loader)
+    index.search("u1", "egg", loader)
+    assert calls == ["u1", "u2", "u1"]
@@ -0,0 +1,289 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from backend.shared_state import (
+    FLUSH_ALL,
+    InvalidationFeed,
+    MemoryState,
+    RedisState,
+    RespClient,
+    RespError,
+    SQLiteState,
+    create_shared_state,
+)
+
+
+class FakeRedis:
+    """In-process stand-in for the handful of Redis commands RedisState uses."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.expiry = {}
+        self.lists = {}
+        self.ranges = []
+        # Each connection is served by its own thread, so MULTI state is per thread.
+        self.transaction = threading.local()
+
+    def _alive(self, key):
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.values.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.values
+
+    def execute(self, name, *args):
+        queued = getattr(self.transaction, "queued", None)
+        if name.upper() == "MULTI":
+            self.transaction.queued = []
+            return "OK"
+        if name.upper() == "EXEC":
+            self.transaction.queued = None
+            with self.lock:
+                return [self._run(*command) for command in queued]
+        if queued is not None:
+            queued.append((name, *args))
+            return "QUEUED"
+        with self.lock:
+            return self._run(name, *args)
+
+    def _run(self, name, *args):
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name}'")
+        return handler(*args)
+
+    def cmd_ping(self):
+        return "PONG"
+
+    def cmd_get(self, key):
+        return self.values[key] if self._alive(key) else None
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if "NX" in options and self._alive(key):
+            return None
+        self.values[key] = value
+        self.expiry.pop(key, None)
+        if "PX" in options:
+            self.expiry[key] = time.monotonic() + int(options[options.index("PX") + 1]) / 1000
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = sum(1 for key in keys if self._alive(key))
+        for key in keys:
+            self.values.pop(key, None)
+            self.expiry.pop(key, None)
+        return removed
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.values[key]) if self._alive(key) else 0
+        self.values[key] = str(value + int(amount))
+        return value + int(amount)
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, "1")
+
+    def cmd_pttl(self, key):
+        if not self._alive(key):
+            return -2
+        deadline = self.expiry.get(key)
+        return -1 if deadline is None else int((deadline - time.monotonic()) * 1000)
+
+    def cmd_rpush(self, key, *items):
+        self.lists.setdefault(key, []).extend(items)
+        return len(self.lists[key])
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self.lists.get(key, [])
+        start, stop = int(start), int(stop)
+        stop = len(items) + stop if stop < 0 else stop
+        start = max(len(items) + start, 0) if start < 0 else start
+        self.lists[key] = items[start:stop + 1]
+        return "OK"
+
+    def cmd_lrange(self, key, start, stop):
+        self.ranges.append((int(start), int(stop)))
+        items = self.lists.get(key, [])
+        start, stop = int(start), int(stop)
+        start = max(len(items) + start, 0) if start < 0 else start
+        return items[start:None if stop == -1 else stop + 1]
+
+
+def _encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, RespError):
+        return f"-{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, list):
+        return f"*{len(reply)}\r\n".encode() + b"".join(_encode(item) for item in reply)
+    if reply in ("OK", "PONG", "QUEUED"):
+        return f"+{reply}\r\n".encode()
+    data = reply.encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+@pytest.fixture
+def resp_server():
+    store = FakeRedis()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                header = self.rfile.readline()
+                if not header:
+                    return
+                args = []
+                for _ in range(int(header[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(length + 2)[:-2].decode())
+                self.wfile.write(_encode(store.execute(*args)))
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.store = store
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def state(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryState()
+    elif request.param == "sqlite":
+        backend = SQLiteState(str(tmp_path / "shared.db"))
+        yield backend
+        backend.close()
+    else:
+        host, port = request.getfixturevalue("resp_server").server_address
+        backend = create_shared_state(f"redis://{host}:{port}/0")
+        yield backend
+        backend.close()
+
+
+def test_key_cursor_round_robins(state):
+    assert [state.advance_key_cursor(3) for _ in range(4)] == [1, 2, 0, 1]
+
+
+def test_counters_expire(state):
+    assert state.incr("quota", ttl_seconds=0.05) == 1
+    assert state.incr("quota", 2, ttl_seconds=0.05) == 3
+    assert state.get("quota") == 3
+    time.sleep(0.08)
+    assert state.get("quota") == 0
+    assert state.incr("quota", ttl_seconds=0.05) == 1
+
+
+def test_cooldowns(state):
+    assert state.cooldown_remaining("key:0") == 0
+    state.set_cooldown("key:0", 5)
+    assert 4 < state.cooldown_remaining("key:0") <= 5
+    assert state.cooldown_remaining("key:1") == 0
+
+
+def test_values_expire_and_only_if_absent_respects_live_values(state):
+    assert state.get_value("idem:a") is None
+    assert state.put_value("idem:a", "first", 0.05, only_if_absent=True)
+    assert not state.put_value("idem:a", "second", 5, only_if_absent=True)
+    assert state.get_value("idem:a") == "first"
+    time.sleep(0.08)
+    assert state.put_value("idem:a", "third", 5, only_if_absent=True)
+    assert state.put_value("idem:a", "fourth", 5)
+    assert state.get_value("idem:a") == "fourth"
+    state.delete_value("idem:a")
+    assert state.get_value("idem:a") is None
+
+
+def test_key_usage_counts_current_window(state):
+    state.record_key_use(1)
+    state.record_key_use(1)
+    assert state.key_usage(2) == {0: 0, 1: 2}
+
+
+def test_invalidation_feed_skips_own_events(state):
+    mine, theirs = InvalidationFeed(state, "worker-a"), InvalidationFeed(state, "worker-b")
+    assert mine.poll() == [] and theirs.poll() == []
+
+    state.publish("worker-a", "search", "user-1")
+    state.publish("worker-b", "search", "user-2")
+
+    assert [event.key for event in mine.poll()] == ["user-2"]
+    assert [event.key for event in theirs.poll()] == ["user-1"]
+    assert mine.poll() == []
+
+
+def test_feed_flushes_when_it_falls_behind_the_log(monkeypatch):
+    import backend.shared_state as shared_state
+
+    monkeypatch.setattr(shared_state, "EVENT_LOG_SIZE", 2)
+    state = SQLiteState(":memory:")
+    feed = InvalidationFeed(state, "worker-a")
+    feed.poll()
+    for n in range(4):
+        state.publish("worker-b", "search", f"user-{n}")
+    assert [event.topic for event in feed.poll()] == [FLUSH_ALL]
+
+
+def test_redis_feed_reads_only_new_events(resp_server):
+    host, port = resp_server.server_address
+    state = create_shared_state(f"redis://{host}:{port}/0")
+    publisher = create_shared_state(f"redis://{host}:{port}/0")
+    feed = InvalidationFeed(state, "worker-a")
+    feed.poll()
+    threads = [
+        threading.Thread(target=lambda n=n: publisher.publish("worker-b", "search", f"user-{n}")) for n in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    events = feed.poll()
+    assert [event.id for event in events] == list(range(1, 21))
+    assert sorted(event.key for event in events) == sorted(f"user-{n}" for n in range(20))
+    assert resp_server.store.ranges[-1] == (-20, -1)
+
+    publisher.publish("worker-b", "search", "user-late")
+    assert [event.key for event in feed.poll()] == ["user-late"]
+    assert resp_server.store.ranges[-1] == (-1, -1)
+    assert feed.poll() == []
+    state.close()
+    publisher.close()
+
+
+def test_backends_must_implement_every_primitive():
+    from backend.shared_state import SharedState
+
+    class Partial(SharedState):
+        def incr(self, name, amount=1, ttl_seconds=None):
+            return 0
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_sqlite_state_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "shared.db")
+    first, second = SQLiteState(path), SQLiteState(path)
+    assert first.advance_key_cursor(4) == 1
+    assert second.advance_key_cursor(4) == 2
+    second.set_cooldown("key:1", 5)
+    assert first.cooldown_remaining("key:1") > 0
+
+
+def test_resp_client_reconnects_and_surfaces_errors(resp_server):
+    host, port = resp_server.server_address
+    client = RespClient(host, port)
+    assert client.command("PING") == "PONG"
+    client._sock.close()
+    assert client.command("INCR", "n") == 1
+    with pytest.raises(RespError):
+        client.command("FLUSHALL")
+    assert RedisState(client).incr("n") == 1
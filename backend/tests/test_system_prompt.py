@@ -0,0 +1,53 @@
+from backend.system_prompt import (
+    GROCERY_LIST,
+    MEAL_PLAN,
+    RECIPE,
+    PromptStats,
+    build_system_prompt,
+    detect_formats,
+    full_system_prompt,
+)
+
+
+def _turns(*texts):
+    return [{"role": "user" if n % 2 == 0 else "model", "parts": [text]} for n, text in enumerate(texts)]
+
+
+def test_detects_the_formats_a_message_asks_for():
+    assert detect_formats(_turns("How much protein do I need to build muscle?")) == frozenset()
+    assert detect_formats(_turns("Can you make me a high protein meal plan for tomorrow?")) >= {MEAL_PLAN}
+    assert detect_formats(_turns("Give me a quick recipe with salmon.")) == {RECIPE}
+    assert detect_formats(_turns("What should I buy for this week?")) == {GROCERY_LIST}
+    assert detect_formats([]) == frozenset()
+
+
+def test_change_requests_keep_the_previous_replys_formats():
+    plan = "<section><h2>Meal Plan: Monday</h2><h3>Recipe: Oats</h3></section>"
+    assert detect_formats(_turns("Plan my week", plan, "I'm vegetarian now, please adjust.")) == {MEAL_PLAN, RECIPE}
+    # Small talk after a plan doesn't need the formats again.
+    assert detect_formats(_turns("Plan my week", plan, "Is it okay to drink coffee at night?")) == frozenset()
+
+
+def test_prompt_holds_only_the_needed_sections():
+    core = build_system_prompt(frozenset())
+    recipe = build_system_prompt(frozenset({RECIPE}))
+    plan = build_system_prompt(frozenset({MEAL_PLAN}))
+    full = full_system_prompt()
+
+    assert "Recipe Format" not in core and "HTML" not in core
+    assert "I'm here to help with nutrition-related questions." in core
+    assert "Recipe Format" in recipe and "Meal Plan Format" not in recipe and "semantic elements" in recipe
+    # Meal plans embed recipes, so the recipe format comes along.
+    assert plan.index("Meal Plan Format") < plan.index("Recipe Format")
+    assert all(name in full for name in ("Meal Plan Format", "Recipe Format", "Grocery List Format"))
+    assert len(core) < len(recipe) < len(plan) < len(full)
+
+
+def test_stats_report_average_tokens_saved():
+    stats = PromptStats()
+    stats.record(frozenset())
+    stats.record(frozenset({MEAL_PLAN, RECIPE, GROCERY_LIST}))
+    snapshot = stats.snapshot()
+    assert snapshot["prompts"] == 2 and snapshot[MEAL_PLAN] == 1
+    assert snapshot["tokens_saved"] > 0
+    assert snapshot["avg_tokens_saved"] == snapshot["tokens_saved"] / 2
@@ -0,0 +1,112 @@
+import pytest
+
+from backend.shared_state import MemoryState
+from backend.usage import UsageMeter, current_scope, rows_to_history, summarize, trim_history, usage_scope
+
+
+def turn(role, chars):
+    return {"role": role, "parts": ["x" * chars]}
+
+
+def test_rows_to_history_orders_oldest_first_and_skips_other_roles():
+    rows = [{"role": "model", "content": "b"}, {"role": "system", "content": "x"}, {"role": "user"}]
+    assert rows_to_history(rows) == [{"role": "user", "parts": [""]}, {"role": "model", "parts": ["b"]}]
+
+
+def test_trim_history_drops_oldest_turns_and_starts_on_user():
+    history = [turn("user", 400), turn("model", 400), turn("user", 400), turn("model", 400), turn("user", 40)]
+    trimmed = trim_history(history, 250)
+    assert trimmed == history[2:]
+    assert trim_history(history, 0) == history
+    assert trim_history([turn("user", 10_000)], 10) == [turn("user", 10_000)]
+
+
+def test_scope_is_restored_after_block():
+    with usage_scope("u1", "c1"):
+        with usage_scope("u2", None):
+            assert current_scope() == ("u2", None)
+        assert current_scope() == ("u1", "c1")
+    assert current_scope() == (None, None)
+
+
+def test_meter_aggregates_and_batches_rows():
+    written = []
+    meter = UsageMeter(written.append, MemoryState())
+    with usage_scope("u1", "c1"):
+        meter.record(0, "chat", 100, 50)
+        meter.record(0, "chat", 10, 5)
+        meter.record(1, "profile", 20, 2)
+
+    assert meter.flush() == 2
+    assert meter.flush() == 0
+    [batch] = written
+    chat = next(row for row in batch if row["kind"] == "chat")
+    assert (chat["prompt_tokens"], chat["output_tokens"], chat["calls"]) == (110, 55, 2)
+    assert meter.used_today("u1") == 187
+
+
+def test_used_today_is_seeded_once_from_stored_rows():
+    reads = []
+
+    def reader(user_id, day):
+        reads.append(user_id)
+        return 500
+
+    state = MemoryState()
+    meter = UsageMeter(lambda rows: None, state, reader=reader)
+    with usage_scope("u1", "c1"):
+        meter.record(0, "chat", 30, 10)
+    # The 40 tokens just recorded aren't stored yet; the restart lost none of the 500 stored ones.
+    assert meter.used_today("u1") == 500
+    with usage_scope("u1", "c1"):
+        meter.record(0, "chat", 60, 40)
+    assert meter.used_today("u1") == 600
+    # Another worker sharing the state doesn't seed again.
+    assert UsageMeter(lambda rows: None, state, reader=reader).used_today("u1") == 600
+    assert reads == ["u1"]
+
+
+def test_failed_seed_read_is_retried():
+    calls = []
+
+    def reader(user_id, day):
+        calls.append(user_id)
+        if len(calls) == 1:
+            raise RuntimeError("database unavailable")
+        return 70
+
+    meter = UsageMeter(lambda rows: None, MemoryState(), reader=reader)
+    with pytest.raises(RuntimeError):
+        meter.used_today("u1")
+    assert meter.used_today("u1") == 70
+
+
+def test_failed_flush_keeps_rows_for_next_time():
+    attempts = []
+
+    def flaky(rows):
+        attempts.append(rows)
+        if len(attempts) == 1:
+            raise RuntimeError("db down")
+
+    meter = UsageMeter(flaky, MemoryState())
+    with usage_scope("u1", None):
+        meter.record(0, "chat", 1, 1)
+    with pytest.raises(RuntimeError):
+        meter.flush()
+    with usage_scope("u1", None):
+        meter.record(0, "chat", 1, 1)
+    meter.flush()
+    assert attempts[1][0]["calls"] == 2
+
+
+def test_summarize_groups_rows():
+    rows = [
+        {"day": "2024-01-01", "conversation_id": "c1", "kind": "chat", "prompt_tokens": 10, "output_tokens": 5, "calls": 1},
+        {"day": "2024-01-02", "conversation_id": None, "kind": "profile", "prompt_tokens": 3, "output_tokens": 1, "calls": 1},
+    ]
+    summary = summarize(rows)
+    assert (summary["prompt_tokens"], summary["calls"]) == (13, 2)
+    assert list(summary["by_day"]) == ["2024-01-01", "2024-01-02"]
+    assert list(summary["by_conversation"]) == ["c1"]
+    assert summary["by_kind"]["profile"]["output_tokens"] == 1
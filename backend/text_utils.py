@@ -0,0 +1,17 @@
+import html
+import re
+
+_BLOCK_TAG_RE = re.compile(r"<\s*(?:br|/?p|/?li|/?ul|/?ol|/?h[1-6]|/?section|/?div|/?tr|/?table)\b[^>]*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+
+
+def html_to_text(content: str) -> str:
+    """Strip HTML markup from a model reply, keeping block elements on their own lines."""
+    if "<" not in content:
+        return content
+    text = _BLOCK_TAG_RE.sub("\n", content)
+    text = _TAG_RE.sub("", text)
+    text = html.unescape(text)
+    lines = (line.strip() for line in text.splitlines())
+    return _BLANK_LINES_RE.sub("\n", "\n".join(lines)).strip()
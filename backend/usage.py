@@ -0,0 +1,243 @@
+"""
+Token accounting for Gemini calls.
+
+Every successful generation reports its `usage_metadata` here. Calls are
+attributed to the user/conversation of the current chat turn through a
+context variable, so the generation helpers keep their signatures. Usage is
+aggregated in memory per (day, user, conversation, key, kind) and written in
+batches; daily per-user and per-key totals are also kept in the shared state
+so budgets hold across workers. When that state starts empty (a restart with
+memory://, a flushed Redis), a user's counter is seeded once per day from the
+stored rows.
+"""
+import contextvars
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from backend.shared_state import SharedState
+
+USAGE_TABLE = "token_usage"
+CHARS_PER_TOKEN = 4
+DAY_SECONDS = 24 * 60 * 60
+
+_scope: contextvars.ContextVar = contextvars.ContextVar("usage_scope", default=(None, None))
+
+
+@contextmanager
+def usage_scope(user_id: Optional[str], conversation_id: Optional[str]) -> Iterator[None]:
+    """Attribute Gemini calls made inside the block to this user and conversation."""
+    token = _scope.set((user_id, conversation_id))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def current_scope() -> Tuple[Optional[str], Optional[str]]:
+    return _scope.get()
+
+
+def utc_day(now: Optional[datetime] = None) -> str:
+    return (now or datetime.now(timezone.utc)).date().isoformat()
+
+
+def seconds_until_utc_midnight(now: Optional[datetime] = None) -> int:
+    now = now or datetime.now(timezone.utc)
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+    return max(int((tomorrow - now).total_seconds()), 1)
+
+
+def usage_from_response(response: Any) -> Tuple[int, int]:
+    """(prompt_tokens, output_tokens) from a Gemini response; zeros when it carries no usage_metadata."""
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return 0, 0
+    prompt = getattr(metadata, "prompt_token_count", 0) or 0
+    output = getattr(metadata, "candidates_token_count", 0) or 0
+    return int(prompt), int(output)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def rows_to_history(rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Newest-first message rows to oldest-first Gemini contents; rows with another role are skipped."""
+    return [
+        {"role": row["role"], "parts": [row.get("content", "")]}
+        for row in reversed(list(rows))
+        if row.get("role") in ("user", "model")
+    ]
+
+
+def trim_history(history: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+    """
+    Drop the oldest turns until the estimated prompt size fits `max_tokens`.
+    The newest message is always kept, and the result starts with a user turn.
+    """
+    if max_tokens <= 0 or not history:
+        return history
+    sizes = [sum(estimate_tokens(str(part)) for part in turn.get("parts", [])) for turn in history]
+    total = sum(sizes)
+    start = 0
+    while total > max_tokens and start < len(history) - 1:
+        total -= sizes[start]
+        start += 1
+    while start < len(history) - 1 and history[start].get("role") != "user":
+        start += 1
+    return history[start:]
+
+
+class UsageMeter:
+    """
+    Aggregates token usage in memory and hands batches of rows to `writer`
+    every `flush_interval` seconds (or once `max_pending` groups pile up).
+    A failed write keeps its rows for the next flush. `reader(user_id, day)`
+    returns the stored token total used to seed `used_today`.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[List[Dict[str, Any]]], None],
+        state: SharedState,
+        flush_interval: float = 10.0,
+        max_pending: int = 500,
+        reader: Optional[Callable[[str, str], int]] = None,
+    ):
+        self.writer = writer
+        self.state = state
+        self.reader = reader
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[Tuple, List[int]] = defaultdict(lambda: [0, 0, 0])
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, key_index: Optional[int], kind: str, prompt_tokens: int, output_tokens: int) -> None:
+        user_id, conversation_id = current_scope()
+        day = utc_day()
+        with self._lock:
+            totals = self._pending[(day, user_id, conversation_id, key_index, kind)]
+            totals[0] += prompt_tokens
+            totals[1] += output_tokens
+            totals[2] += 1
+            backlog = len(self._pending)
+        total = prompt_tokens + output_tokens
+        if total:
+            if user_id:
+                self.state.incr(f"user_tokens:{user_id}:{day}", total, ttl_seconds=2 * DAY_SECONDS)
+            if key_index is not None:
+                self.state.incr(f"key_tokens:{key_index}:{day}", total, ttl_seconds=2 * DAY_SECONDS)
+        self._ensure_flusher()
+        if backlog >= self.max_pending:
+            self._wake.set()
+
+    def record_response(self, response: Any, key_index: Optional[int], kind: str) -> None:
+        prompt_tokens, output_tokens = usage_from_response(response)
+        self.record(key_index, kind, prompt_tokens, output_tokens)
+
+    def used_today(self, user_id: str) -> int:
+        day = utc_day()
+        counter = f"user_tokens:{user_id}:{day}"
+        if self.reader is not None and self.state.put_value(
+            f"user_tokens_seeded:{user_id}:{day}", "1", 2 * DAY_SECONDS, only_if_absent=True
+        ):
+            # First look at this user today since the shared state was created: whatever the
+            # counter holds so far is either still pending or already among the stored rows.
+            try:
+                stored = self.reader(user_id, day)
+            except Exception:
+                self.state.delete_value(f"user_tokens_seeded:{user_id}:{day}")
+                raise
+            missing = stored - self.state.get(counter)
+            if missing > 0:
+                return self.state.incr(counter, missing, ttl_seconds=2 * DAY_SECONDS)
+        return self.state.get(counter)
+
+    def key_tokens_today(self, n_keys: int) -> Dict[int, int]:
+        day = utc_day()
+        return {key_index: self.state.get(f"key_tokens:{key_index}:{day}") for key_index in range(n_keys)}
+
+    def pending_rows(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = list(self._pending.items())
+        return [_row(key, totals) for key, totals in items if user_id is None or key[1] == user_id]
+
+    def flush(self) -> int:
+        """Write everything aggregated so far; returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, defaultdict(lambda: [0, 0, 0])
+            if not batch:
+                return 0
+            rows = [_row(key, totals) for key, totals in batch.items()]
+            try:
+                self.writer(rows)
+            except Exception:
+                with self._lock:
+                    for key, totals in batch.items():
+                        merged = self._pending[key]
+                        for position, value in enumerate(totals):
+                            merged[position] += value
+                raise
+            return len(rows)
+
+    def _ensure_flusher(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as exc:
+                print("Token usage flush failed:", exc)
+
+
+def _row(key: Tuple, totals: List[int]) -> Dict[str, Any]:
+    day, user_id, conversation_id, key_index, kind = key
+    return {
+        "day": day,
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "key_index": key_index,
+        "kind": kind,
+        "prompt_tokens": totals[0],
+        "output_tokens": totals[1],
+        "calls": totals[2],
+    }
+
+
+def summarize(rows: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Totals overall, per day, per conversation and per kind from `token_usage` rows."""
+    summary: Dict[str, Any] = {"prompt_tokens": 0, "output_tokens": 0, "calls": 0}
+    by_day: Dict[str, Dict[str, int]] = defaultdict(lambda: {"prompt_tokens": 0, "output_tokens": 0, "calls": 0})
+    by_conversation: Dict[str, Dict[str, int]] = defaultdict(lambda: {"prompt_tokens": 0, "output_tokens": 0, "calls": 0})
+    by_kind: Dict[str, Dict[str, int]] = defaultdict(lambda: {"prompt_tokens": 0, "output_tokens": 0, "calls": 0})
+    for row in rows:
+        groups = [summary, by_day[row["day"]], by_kind[row["kind"]]]
+        if row.get("conversation_id"):
+            groups.append(by_conversation[row["conversation_id"]])
+        for group in groups:
+            group["prompt_tokens"] += row.get("prompt_tokens") or 0
+            group["output_tokens"] += row.get("output_tokens") or 0
+            group["calls"] += row.get("calls") or 0
+    summary["by_day"] = dict(sorted(by_day.items()))
+    summary["by_conversation"] = dict(by_conversation)
+    summary["by_kind"] = dict(by_kind)
+    return summary
+
+
+def days_back(days: int, today: Optional[date] = None) -> str:
+    return ((today or datetime.now(timezone.utc).date()) - timedelta(days=max(days, 1) - 1)).isoformat()
@@ -1,9 +1,38 @@
-import os, json
+"""
+EasyDiet console client.
+
+Interactive:   python cli.py
+Batch:         python cli.py --batch prompts.txt --concurrency 4
+               cat prompts.txt | python cli.py
+
+Set EASYDIET_TOKEN to a Supabase access token (sent as the Bearer token).
+In batch mode each non-empty line is sent as its own conversation and a
+timing line (time to first chunk, total) is printed per prompt.
+"""
+import os, sys, json, time, argparse, threading, uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 
 API_BASE = os.environ.get("EASYDIET_API_BASE", "http://localhost:8000")
+API_TOKEN = os.environ.get("EASYDIET_TOKEN", "")
 STATE_FILE = Path(".chat_state.json")
+TIMEOUT = (10, 180)  # connect, read (between streamed chunks)
+SEND_ATTEMPTS = 3
+
+_local = threading.local()
+
+def session():
+    """One keep-alive session per thread, so every request reuses its connection."""
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = requests.Session()
+        s.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        if API_TOKEN: s.headers["Authorization"] = f"Bearer {API_TOKEN}"
+        _local.session = s
+    return s
 
 def load_state():
     if STATE_FILE.exists():
@@ -14,21 +43,58 @@ def load_state():
 def save_state(state):
     STATE_FILE.write_text(json.dumps(state), encoding="utf-8")
 
-def send_chat(message, cid=None):
+def stream_chat(message, cid=None, on_text=None):
+    """
+    POST /api/chat/stream; call on_text per chunk and return (done_event, seconds_to_first_chunk).
+    Dropped connections, 429 and 5xx are retried with the same Idempotency-Key, so a
+    retry joins or replays the original turn instead of generating it again.
+    """
+    key = uuid.uuid4().hex
+    started = time.perf_counter()
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            return _stream_once(message, cid, on_text, key, started)
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.Timeout) as e:
+            error = e
+        except requests.HTTPError as e:
+            if e.response.status_code != 429 and e.response.status_code < 500: raise
+            error = e
+        if attempt == SEND_ATTEMPTS: raise error
+        print(f"(connection problem, retrying {attempt}/{SEND_ATTEMPTS - 1})", file=sys.stderr)
+        time.sleep(0.5 * 2 ** (attempt - 1))
+
+def _stream_once(message, cid, on_text, key, started):
     body = {"message": message}
     if cid: body["conversation_id"] = cid
-    r = requests.post(f"{API_BASE}/api/chat", json=body, timeout=120)
-    r.raise_for_status()
-    return r.json()
+    first = None
+    headers = {"Idempotency-Key": key}
+    with session().post(f"{API_BASE}/api/chat/stream", json=body, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line: continue
+            event = json.loads(line)
+            if event["type"] == "deferred":
+                print("(server is busy; the reply was queued and will arrive here)", file=sys.stderr)
+                continue
+            if event["type"] == "status": continue
+            if first is None: first = time.perf_counter() - started
+            if event["type"] == "delta":
+                if on_text: on_text(event["text"])
+            elif event["type"] == "done":
+                return event, first
+            else:
+                raise RuntimeError(event.get("detail") or "stream failed")
+    # The connection dropped mid-reply; the turn itself keeps running on the server.
+    raise requests.ConnectionError("stream ended before the reply finished")
 
 def show_history(cid):
-    r = requests.get(f"{API_BASE}/api/history/{cid}", timeout=30)
+    r = session().get(f"{API_BASE}/api/conversations/{cid}/messages", timeout=TIMEOUT)
     r.raise_for_status()
     for turn in r.json():
         print(f"[{turn['role']}] {turn['parts'][0]}")
         print()
 
-def main():
+def interactive():
     print(f"EasyDiet Console Chat  (API={API_BASE})")
     print("Commands: /new  /history  /exit")
     state = load_state()
@@ -39,27 +105,82 @@ def main():
             msg = input("> ").strip()
         except (EOFError, KeyboardInterrupt):
             print(); break
-        
+
         if not msg: continue
         if msg == "/exit": break
         if msg == "/new":
             cid = None; state["conversation_id"] = None; save_state(state)
             print("(new conversation)\n"); continue
         if msg == "/history":
-            if cid: show_history(cid)
-            else: print("(no conversation yet)\n")
+            try:
+                if cid: show_history(cid)
+                else: print("(no conversation yet)\n")
+            except requests.HTTPError as e:
+                print("HTTP error:", e.response.text)
             continue
 
         try:
-            data = send_chat(msg, cid)
-            cid = data["conversation_id"]
+            print("AI: ", end="", flush=True)
+            streamed = []
+            def on_text(text):
+                streamed.append(text); print(text, end="", flush=True)
+            done, _ = stream_chat(msg, cid, on_text)
+            cid = done["conversation_id"]
             state["conversation_id"] = cid; save_state(state)
-            print("AI:", data["reply"])
-            print()
+            # The server may adjust the reply after streaming (nutrition check); show the final text then.
+            if done["reply"] != "".join(streamed):
+                print("\n(updated)", done["reply"], end="")
+            print("\n")
         except requests.HTTPError as e:
-            print("HTTP error:", e.response.text)
+            print("\nHTTP error:", e.response.text)
         except Exception as e:
-            print("Error:", str(e))
+            print("\nError:", str(e))
+
+def run_one(n, prompt):
+    started = time.perf_counter()
+    try:
+        done, first = stream_chat(prompt)
+        return n, prompt, done, first, time.perf_counter() - started, None
+    except requests.HTTPError as e:
+        return n, prompt, None, None, time.perf_counter() - started, f"HTTP {e.response.status_code}: {e.response.text}"
+    except Exception as e:
+        return n, prompt, None, None, time.perf_counter() - started, str(e)
+
+def batch(lines, concurrency, as_json):
+    prompts = [line.strip() for line in lines if line.strip()]
+    started = time.perf_counter()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        futures = [pool.submit(run_one, n, p) for n, p in enumerate(prompts, 1)]
+        for future in as_completed(futures):
+            n, prompt, done, first, total, error = future.result()
+            failures += error is not None
+            if as_json:
+                print(json.dumps({"n": n, "prompt": prompt, "ok": error is None, "first_chunk_s": first,
+                                  "total_s": round(total, 3), "error": error, **(done or {})}), flush=True)
+                continue
+            ttfc = f"{first:.2f}s" if first is not None else "-"
+            status = "ok" if error is None else f"FAILED {error}"
+            print(f"#{n} first={ttfc} total={total:.2f}s {status}  {prompt[:60]}", flush=True)
+            if done: print(done["reply"], "\n", flush=True)
+    print(f"{len(prompts)} prompts, {failures} failed, {time.perf_counter() - started:.2f}s wall", file=sys.stderr)
+    return 1 if failures else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EasyDiet console chat")
+    parser.add_argument("--batch", metavar="FILE", help="send each line of FILE ('-' for stdin) as its own conversation")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel conversations in batch mode")
+    parser.add_argument("--json", action="store_true", help="batch mode: one JSON result per line")
+    args = parser.parse_args(argv)
+
+    if args.batch is None and not sys.stdin.isatty():
+        args.batch = "-"
+    if args.batch is None:
+        interactive(); return 0
+    if args.batch == "-":
+        return batch(sys.stdin.readlines(), args.concurrency, args.json)
+    with open(args.batch, "r", encoding="utf-8") as f:
+        return batch(f.readlines(), args.concurrency, args.json)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
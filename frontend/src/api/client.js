@@ -1,10 +1,13 @@
 const API_BASE = import.meta.env.VITE_API_BASE || 'http://localhost:8000'
 
-async function request(path, { method = 'GET', body, session } = {}) {
+async function request(path, { method = 'GET', body, session, idempotencyKey } = {}) {
   const headers = { 'Content-Type': 'application/json' }
   if (session?.access_token) {
     headers.Authorization = `Bearer ${session.access_token}`
   }
+  if (idempotencyKey) {
+    headers['Idempotency-Key'] = idempotencyKey
+  }
 
   const response = await fetch(`${API_BASE}${path}`, {
     method,
@@ -14,17 +17,54 @@ async function request(path, { method = 'GET', body, session } = {}) {
 
   if (!response.ok) {
     const text = await response.text()
-    throw new Error(text || 'Request failed')
+    const error = new Error(text || 'Request failed')
+    error.status = response.status
+    throw error
   }
   return response.json()
 }
 
+const SEND_ATTEMPTS = 3
+
+// Network failures, 429 and 5xx may have happened after the server started the turn.
+function isRetryable(error) {
+  return error.status === undefined || error.status === 429 || error.status >= 500
+}
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms))
+
+// A 202 from /api/chat means the reply was queued until Gemini has capacity again.
+async function waitForChatJob(session, job) {
+  let current = job
+  while (current.status === 'queued' || current.status === 'running') {
+    current = await request(`/api/chat/jobs/${current.job_id}?wait=25`, { session })
+  }
+  if (current.status !== 'done') {
+    throw new Error(current.error || 'Reply failed')
+  }
+  return current.result
+}
+
 export const api = {
+  bootstrap: (session, conversationId) =>
+    request(`/api/bootstrap${conversationId ? `?conversation_id=${encodeURIComponent(conversationId)}` : ''}`, { session }),
   getProfile: (session) => request('/api/profile', { session }),
   updateProfile: (session, payload) => request('/api/profile', { method: 'PUT', session, body: payload }),
   listConversations: (session) => request('/api/conversations', { session }),
   createConversation: (session, payload) => request('/api/conversations', { method: 'POST', session, body: payload }),
   deleteConversation: (session, conversationId) => request(`/api/conversations/${conversationId}`, { method: 'DELETE', session }),
   getMessages: (session, conversationId) => request(`/api/conversations/${conversationId}/messages`, { session }),
-  sendMessage: (session, payload) => request('/api/chat', { method: 'POST', session, body: payload }),
+  // One idempotencyKey per logical message: retries reuse it, so the server joins or
+  // replays the first attempt instead of generating (and storing) the turn twice.
+  sendMessage: async (session, payload, idempotencyKey = crypto.randomUUID?.()) => {
+    for (let attempt = 1; ; attempt += 1) {
+      try {
+        const response = await request('/api/chat', { method: 'POST', session, body: payload, idempotencyKey })
+        return response.job_id ? waitForChatJob(session, response) : response
+      } catch (error) {
+        if (!idempotencyKey || attempt >= SEND_ATTEMPTS || !isRetryable(error)) throw error
+        await sleep(500 * 2 ** (attempt - 1))
+      }
+    }
+  },
 }
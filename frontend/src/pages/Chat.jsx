@@ -1,5 +1,5 @@
 import { useCallback, useEffect, useMemo, useRef, useState } from 'react'
-import { useNavigate, useParams } from 'react-router-dom'
+import { Link, useNavigate, useParams } from 'react-router-dom'
 import DOMPurify from 'dompurify'
 import Navbar from '../components/Navbar'
 import { api } from '../api/client'
@@ -16,16 +16,32 @@ function normalizeMessages(history) {
   }))
 }
 
+function profileIsEmpty(profile) {
+  if (!profile) return false
+  const hasText = (value) => Boolean(value && String(value).trim())
+  const hasItems = (value) => Array.isArray(value) && value.length > 0
+  return !hasText(profile.fitness_goals)
+    && !hasText(profile.dietary_restrictions)
+    && !hasItems(profile.allergens)
+    && !hasItems(profile.diets)
+}
+
 function Chat() {
   const { chatId } = useParams()
   const navigate = useNavigate()
   const { session } = useAuth()
   const [messages, setMessages] = useState([])
   const [conversations, setConversations] = useState([])
+  const [profile, setProfile] = useState(null)
   const [input, setInput] = useState('')
   const [status, setStatus] = useState('idle')
   const [sidebarLoading, setSidebarLoading] = useState(true)
   const autoSelectAttempted = useRef(false)
+  const initialChatId = useRef(chatId)
+  const currentChatId = useRef(chatId)
+  const bootstrapTarget = useRef(null)
+  // Conversation whose messages came with the bootstrap response, so the route change to it doesn't refetch them.
+  const preloadedChatId = useRef(null)
 
   const loadConversations = useCallback(async () => {
     if (!session) return
@@ -38,10 +54,6 @@ function Chat() {
     }
   }, [session])
 
-  useEffect(() => {
-    loadConversations()
-  }, [loadConversations])
-
   useEffect(() => {
     if (chatId) {
       localStorage.setItem(LAST_CHAT_KEY, chatId)
@@ -61,8 +73,57 @@ function Chat() {
     }
   }, [session])
 
+  // First paint: profile, conversation list and the open chat's messages in one request.
   useEffect(() => {
+    if (!session) return
+    let cancelled = false
+    // On /chat the last open chat is the one auto-selected below, so ask for its messages right away.
+    const targetId = initialChatId.current || localStorage.getItem(LAST_CHAT_KEY)
+    bootstrapTarget.current = targetId
+    setSidebarLoading(true)
+    api.bootstrap(session, targetId)
+      .then((data) => {
+        if (cancelled) return
+        setConversations(data.conversations)
+        setProfile(data.profile)
+        const activeId = data.active_conversation_id
+        if (!initialChatId.current) {
+          // Nothing in the URL: the chat the server returned messages for (the last one, or the newest)
+          // is the one auto-selected below.
+          if (!activeId || currentChatId.current) return
+          preloadedChatId.current = activeId
+          setMessages(normalizeMessages(data.messages))
+          setStatus('ready')
+          return
+        }
+        if (currentChatId.current !== targetId) return
+        if (activeId === targetId) {
+          setMessages(normalizeMessages(data.messages))
+          setStatus('ready')
+        } else {
+          loadMessages(targetId)
+        }
+      })
+      .catch((error) => {
+        if (!cancelled) setStatus(error.message)
+      })
+      .finally(() => {
+        bootstrapTarget.current = null
+        if (!cancelled) setSidebarLoading(false)
+      })
+    return () => {
+      cancelled = true
+    }
+  }, [session, loadMessages])
+
+  useEffect(() => {
+    currentChatId.current = chatId
     if (chatId) {
+      if (preloadedChatId.current === chatId) {
+        preloadedChatId.current = null
+        return
+      }
+      if (bootstrapTarget.current === chatId) return
       loadMessages(chatId)
     } else {
       setMessages([])
@@ -78,7 +139,7 @@ function Chat() {
     }
     const stored = localStorage.getItem(LAST_CHAT_KEY)
     const storedConversation = conversations.find((conv) => conv.id === stored)
-    const targetId = storedConversation?.id || conversations[0]?.id
+    const targetId = preloadedChatId.current || storedConversation?.id || conversations[0]?.id
     if (targetId) {
       autoSelectAttempted.current = true
       navigate(`/chat/${targetId}`, { replace: true })
@@ -106,7 +167,8 @@ function Chat() {
     const conversationId = chatId || (await createConversation(true))
     if (!conversationId) return
 
-    const userMessage = { id: crypto.randomUUID?.() || Date.now(), sender: 'user', text: trimmed }
+    const messageId = crypto.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`
+    const userMessage = { id: messageId, sender: 'user', text: trimmed }
     setMessages((prev) => [...prev, userMessage])
     setInput('')
     setStatus('sending')
@@ -115,7 +177,7 @@ function Chat() {
       const response = await api.sendMessage(session, {
         message: trimmed,
         conversation_id: conversationId,
-      })
+      }, messageId)
       await loadMessages(conversationId)
       if (response.conversation_id && response.conversation_id !== chatId) {
         navigate(`/chat/${response.conversation_id}`, { replace: true })
@@ -198,6 +260,11 @@ function Chat() {
             <img src={mascot} alt="EasyDiet mascot" className="mascot-logo" />
             {currentTitle}
           </h2>
+          {profileIsEmpty(profile) && (
+            <p className="chat-profile-hint">
+              Replies are generic until you <Link to="/profile">add your goals and dietary restrictions</Link>.
+            </p>
+          )}
           {status !== 'ready' && status !== 'sending' && status !== 'idle' && status !== 'loading' && (
             <p style={{ color: 'red' }}>{status}</p>
           )}